@@ -4,6 +4,7 @@ from astropy.stats import mad_std as mad
 
 from astroNN.config import MAGIC_NUMBER
 from astroNN.models.base_master_nn import NeuralNetMaster
+from astroNN.shared.dict_tools import to_iterable
 
 
 def target_name_conversion(targetname):
@@ -178,11 +179,16 @@ class ASPCAP_plots(NeuralNetMaster):
 
         print("Finished plotting residues")
 
-    def jacobian_aspcap(self, jacobian=None, dr=14):
+    def jacobian_aspcap(self, jacobian=None, dr=14, x=None, targetname=None, windows_only=False):
         """
         NAME: cal_jacobian
         PURPOSE: calculate jacobian
         INPUT:
+            jacobian (ndarray): (Optional) Mean jacobian to plot, calculated from x if not provided
+            dr (int): APOGEE data release
+            x (ndarray): (Optional) Spectra to calculate mean jacobian of if jacobian is not provided
+            targetname (list): (Optional) Names of outputs to plot, default to all outputs
+            windows_only (bool): Only calculate jacobian of pixels in ASPCAP windows of the element of each output
         OUTPUT:
         HISTORY:
             2017-Nov-20 Henry Leung
@@ -190,13 +196,27 @@ class ASPCAP_plots(NeuralNetMaster):
         import pylab as plt
         import numpy as np
         import matplotlib.ticker as ticker
-        from astroNN.apogee.chips import wavelength_solution, chips_split
+        from astroNN.apogee.chips import wavelength_solution, chips_split, aspcap_mask
         from urllib.request import urlopen
         from urllib.error import HTTPError
         import pandas as pd
 
+        targetname = self.targetname if targetname is None else to_iterable(targetname)
         if jacobian is None:
-            raise ValueError('Please provide jacobian to plot')
+            if x is None:
+                raise ValueError('Please provide jacobian or data to calculate jacobian to plot')
+            # only calculate jacobian of outputs (and pixels in windows) to plot
+            if windows_only:
+                jacobian = np.full((len(targetname), np.prod(np.shape(x)[1:])), np.nan)
+                for j, name in enumerate(targetname):
+                    mask = aspcap_mask(name, dr=dr)
+                    if mask is None:  # not an element with ASPCAP windows
+                        mask = np.ones(jacobian.shape[1], dtype=bool)
+                    jacobian[j, mask] = self.jacobian(x, mean_output=True, outputs=[name], inputs=mask)
+            else:
+                jacobian = self.jacobian(x, mean_output=True, outputs=targetname)
+            jacobian = jacobian.reshape(len(targetname), -1)
+
         if len(jacobian.shape) == 3:
             jacobian = np.mean(jacobian, axis=-1)
         elif len(jacobian.shape) == 2:
@@ -213,10 +233,10 @@ class ASPCAP_plots(NeuralNetMaster):
         if not os.path.exists(path):
             os.makedirs(path)
 
-        fullname = self.targetname
+        fullname = targetname
         lambda_blue, lambda_green, lambda_red = wavelength_solution(dr=dr)
 
-        for j in range(self._labels_shape['output']):
+        for j in range(len(targetname)):
             fig = plt.figure(figsize=(45, 30), dpi=150)
             scale = np.max(np.abs((jacobian[j, :])))
             scale_2 = np.min((jacobian[j, :]))
@@ -244,19 +264,19 @@ class ASPCAP_plots(NeuralNetMaster):
             try:
                 if dr == 14:
                     url = f"https://svn.sdss.org/public/repo/apogee/idlwrap/trunk/lib/l31c/" \
-                          f"{aspcap_windows_url_correction(self.targetname[j])}.mask"
+                          f"{aspcap_windows_url_correction(targetname[j])}.mask"
                     df = np.array(pd.read_csv(urlopen(url), header=None, sep='\t'))
                 else:
                     raise ValueError('Only support DR14')
                 aspcap_windows = df * scale
                 aspcap_windows = aspcap_windows.T  # Fix the shape to the one I expect
                 aspcap_blue, aspcap_green, aspcap_red = chips_split(aspcap_windows, dr=dr)
-                print(f'Found {aspcap_windows_url_correction(self.targetname[j])} ASPCAP window at: {url}')
+                print(f'Found {aspcap_windows_url_correction(targetname[j])} ASPCAP window at: {url}')
                 ax1.plot(lambda_blue, aspcap_blue[0], linewidth=0.9, label='ASPCAP windows')
                 ax2.plot(lambda_green, aspcap_green[0], linewidth=0.9, label='ASPCAP windows')
                 ax3.plot(lambda_red, aspcap_red[0], linewidth=0.9, label='ASPCAP windows')
             except HTTPError:
-                print(f'No ASPCAP window data for {aspcap_windows_url_correction(self.targetname[j])}')
+                print(f'No ASPCAP window data for {aspcap_windows_url_correction(targetname[j])}')
             tick_spacing = 50
             ax1.xaxis.set_major_locator(ticker.MultipleLocator(tick_spacing))
             ax2.xaxis.set_major_locator(ticker.MultipleLocator(tick_spacing / 1.5))
@@ -274,6 +294,6 @@ class ASPCAP_plots(NeuralNetMaster):
             ax1.legend(loc='best', fontsize=40)
             plt.tight_layout()
             plt.subplots_adjust(left=0.05)
-            plt.savefig(path + f'/{self.targetname[j]}_jacobian.png')
+            plt.savefig(path + f'/{targetname[j]}_jacobian.png')
             plt.close('all')
             plt.clf()
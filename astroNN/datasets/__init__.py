@@ -2,5 +2,6 @@ from astroNN.datasets.apogee_distances import load_apogee_distances
 from astroNN.datasets.apogee_rc import load_apogee_rc
 from astroNN.datasets.galaxy10 import load_data as load_galaxy10
 from astroNN.datasets.h5 import H5Compiler
+from astroNN.datasets.h5 import H5DatasetView
 from astroNN.datasets.h5 import H5Loader
 from astroNN.datasets.xmatch import xmatch
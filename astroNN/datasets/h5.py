@@ -2,9 +2,11 @@
 #   astroNN.datasets.h5: compile h5 files for NN
 # ---------------------------------------------------------#
 
+import operator
 import os
 import time
 from functools import reduce
+from multiprocessing import Pool
 
 import h5py
 import numpy as np
@@ -19,12 +21,27 @@ from astroNN.datasets.xmatch import xmatch
 from astroNN.gaia import mag_to_fakemag, extinction_correction
 from astroNN.gaia.downloader import gaiadr2_parallax, anderson_2017_parallax
 from astroNN.gaia.gaia_shared import gaia_env
+from astroNN.shared.downloader_tools import filehash
 
 currentdir = os.getcwd()
+_READ_BLOCK_NBYTES = 32 * 1024 ** 2  # read h5 datasets in blocks of roughly this size
+_FILTER_OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, '==': operator.eq,
+                     '!=': operator.ne}
 _APOGEE_DATA = apogee_env()
 _GAIA_DATA = gaia_env()
 
 
+# name in h5 dataset, column in allStar, index of the column (None if the column is 1D)
+_ALLSTAR_COLUMNS = [('RA', 'RA', None), ('DEC', 'DEC', None), ('Kmag', 'K', None), ('AK_TARG', 'AK_TARG', None)]
+_ASPCAP_LABELS = [('teff', 'PARAM', 0), ('logg', 'PARAM', 1), ('M', 'PARAM', 3), ('alpha', 'PARAM', 6)] + \
+                 [(elem, 'X_H', i) for i, elem in enumerate(['C', 'C1', 'N', 'O', 'Na', 'Mg', 'Al', 'Si', 'P', 'S',
+                                                             'K', 'Ca', 'Ti', 'Ti2', 'V', 'Cr', 'Mn', 'Fe', 'Co',
+                                                             'Ni', 'Cu', 'Ge', 'Ce', 'Rb', 'Y', 'Nd'])]
+_ASPCAP_LABELS_ERR = [('teff_err', 'TEFF_ERR', None), ('logg_err', 'LOGG_ERR', None), ('M_err', 'M_H_ERR', None),
+                      ('alpha_err', 'ALPHA_M_ERR', None)] + \
+                     [(f'{name}_err', 'X_H_ERR', k) for name, column, k in _ASPCAP_LABELS if column == 'X_H']
+
+
 def h5name_check(h5name):
     if h5name is None:
         raise ValueError('Please specify the dataset name using filename="..."')
@@ -36,7 +53,7 @@ class H5Compiler(object):
     A class for compiling h5 dataset for Keras to use
     """
 
-    def __init__(self):
+    def __init__(self, n_workers=1):
         self.apogee_dr = None  # APOGEE DR to use, Default is 14
         self.gaia_dr = None  # Gaia DR to use, Default is 1
         self.starflagcut = True  # True to filter out ASPCAP star flagged spectra
@@ -57,6 +74,19 @@ class H5Compiler(object):
         self.use_anderson_2017 = False
         self.use_err = True  # Whether to include error information in h5 dataset
         self.continuum = True  # True to do continuum normalization, False to use aspcap normalized spectra
+        self.n_workers = n_workers  # Number of processes to read and normalize spectra, 1 to run serially
+        self.block_size = 1000  # Number of rows to hold in memory before writing them to the h5 dataset
+        # 'w' to compile from scratch, 'resume' to continue an interrupted compile, 'update' to only process new or
+        # changed stars of an existing h5 dataset
+        self.mode = 'w'
+        self.compression = None  # Compression filter of spectra, None, 'lzf', 'gzip' or 'blosc' (requires hdf5plugin)
+        self.compression_opts = None  # Compression settings, e.g. level 0-9 for 'gzip' or a dict for 'blosc'
+        self.shuffle = False  # True to shuffle bytes before compression, usually improves compression of float
+        self.chunk_rows = None  # Number of rows per chunk of spectra, e.g. the training batch size, None for auto
+        # Storage type of spectra and spectra_err, 'float32', 'float16' or 'uint16' (scaled integer)
+        self.spectra_dtype = 'float32'
+        self.spectra_range = (0., 2.)  # Range of spectra representable by 'uint16', values outside will be clipped
+        self.spectra_err_range = (0., 1.)  # Range of spectra_err representable by 'uint16'
 
     def load_allstar(self):
         self.apogee_dr = apogee_default_dr(dr=self.apogee_dr)
@@ -109,6 +139,119 @@ class H5Compiler(object):
         return apogee_continuum(spectra=spectra, spectra_err=spectra_err, cont_mask=self.cont_mask, deg=2,
                                 dr=self.apogee_dr, bitmask=bitmask, target_bit=[0, 1, 2, 3, 4, 5, 6, 7, 12])
 
+    def spectra_path(self, d_args):
+        """
+        Locate (and download if needed) the spectra file of a single star
+
+        :param d_args: keywords to locate the spectra file, passed to ``combined_spectra`` or ``visit_spectra``
+        :type d_args: dict
+        :return: full file path, False if cannot be found
+        :rtype: Union[str, bool]
+        """
+        if not self.continuum:
+            return combined_spectra(**d_args)
+        else:
+            return visit_spectra(**d_args)
+
+    def star_spectra(self, path):
+        """
+        Read the spectra of a single star and process them the same way as they will be stored in the h5 dataset
+
+        :param path: full path of the spectra file returned by ``spectra_path()``
+        :type path: str
+        :return: spectra, spectra error, SNR and number of rows
+        :rtype: tuple
+        """
+        nvisits = 1
+        if not self.continuum:
+            combined_file = fits.open(path)
+            _spec = combined_file[1].data  # Pseudo-continuum normalized flux
+            _spec_err = combined_file[2].data  # Spectrum error array
+            _spec = gap_delete(_spec, dr=self.apogee_dr)  # Delete the gap between sensors
+            _spec_err = gap_delete(_spec_err, dr=self.apogee_dr)
+            inSNR = combined_file[0].header['SNR']
+            combined_file.close()
+        else:
+            apstar_file = fits.open(path)
+            nvisits = apstar_file[0].header['NVISITS']
+            if nvisits == 1:
+                _spec = apstar_file[1].data
+                _spec_err = apstar_file[2].data
+                _spec_mask = apstar_file[3].data
+                inSNR = np.ones(nvisits)
+                inSNR[0] = apstar_file[0].header['SNR']
+            else:
+                _spec = apstar_file[1].data[1:]
+                _spec_err = apstar_file[2].data[1:]
+                _spec_mask = apstar_file[3].data[1:]
+                inSNR = np.ones(nvisits + 1)
+                inSNR[0] = apstar_file[0].header['SNR']
+                for i in range(nvisits):
+                    inSNR[i + 1] = apstar_file[0].header[f'SNRVIS{i + 1}']
+
+                # Deal with spectra thats all zeros flux
+                ii = 0
+                while ii < _spec.shape[0]:
+                    if np.count_nonzero(_spec[ii]) == 0:
+                        nvisits -= 1
+                        _spec = np.delete(_spec, ii, 0)
+                        _spec_err = np.delete(_spec_err, ii, 0)
+                        _spec_mask = np.delete(_spec_mask, ii, 0)
+                        inSNR = np.delete(inSNR, ii, 0)
+                        ii -= 1
+                    ii += 1
+
+                # Just for the sake of program to work, the real nvisits still nvisits
+                nvisits += 1
+
+            # Normalize spectra and Set some bitmask to 0
+            _spec, _spec_err = self.apstar_normalization(_spec, _spec_err, _spec_mask)
+            apstar_file.close()
+
+        return _spec, _spec_err, inSNR, nvisits
+
+    def _d_args(self, hdulist, index):
+        apogee_id = hdulist[1].data['APOGEE_ID'][index]
+        if self.apogee_dr <= 15:
+            location_id = hdulist[1].data['LOCATION_ID'][index]
+            d_args = {'dr': self.apogee_dr, 'location': location_id, 'apogee': apogee_id, 'verbose': 0}
+        else:
+            field_id = hdulist[1].data['FIELD'][index]
+            telescope_id = hdulist[1].data['TELESCOPE'][index]
+            d_args = {'dr': self.apogee_dr, 'field': field_id, 'telescope': telescope_id, 'apogee': apogee_id,
+                      'verbose': 0}
+        return d_args
+
+    def _star_entry(self, d_args):
+        """
+        Checksum of the spectra file and the result of ``star_spectra()`` of a single star, or None as the result if
+        the file cannot be found
+        """
+        path = self.spectra_path(d_args)
+        if path is False:
+            return '', None
+        return filehash(path, algorithm='sha1'), self.star_spectra(path)
+
+    def _star_checksum(self, d_args):
+        path = self.spectra_path(d_args)
+        return '' if path is False else filehash(path, algorithm='sha1')
+
+    def _ordered_map(self, func, hdulist, indices):
+        """
+        Yield the result of ``func(d_args)`` for every allStar index in order, fanned out to ``n_workers`` processes
+        if requested
+        """
+        d_args_list = [self._d_args(hdulist, index) for index in indices]
+
+        n_workers = os.cpu_count() if self.n_workers is None else self.n_workers
+        if n_workers > 1 and len(d_args_list) > 0:
+            with Pool(n_workers) as pool:
+                # imap keeps allStar order so the merged result is identical to the serial one
+                chunksize = max(1, len(d_args_list) // (4 * n_workers))
+                yield from pool.imap(func, d_args_list, chunksize=chunksize)
+        else:
+            yield from map(func, d_args_list)
+
     def compile(self):
         h5name_check(self.filename)
 
@@ -117,349 +260,117 @@ class H5Compiler(object):
 
         info = chips_pix_info(dr=self.apogee_dr)
         total_pix = (info[1] - info[0]) + (info[3] - info[2]) + (info[5] - info[4])
-        default_length = 500000
-
-        spec = np.zeros((default_length, total_pix), dtype=np.float32)
-        spec_err = np.zeros((default_length, total_pix), dtype=np.float32)
-        RA = np.zeros(default_length, dtype=np.float32)
-        DEC = np.zeros(default_length, dtype=np.float32)
-        SNR = np.zeros(default_length, dtype=np.float32)
-        individual_flag = np.zeros(default_length, dtype=np.float32)
-        Kmag = np.zeros(default_length, dtype=np.float32)
-        AK_TARG = np.zeros(default_length, dtype=np.float32)
-
-        # Data array
-        teff = np.zeros(default_length, dtype=np.float32)
-        logg = np.zeros(default_length, dtype=np.float32)
-        MH = np.zeros(default_length, dtype=np.float32)
-        alpha_M = np.zeros(default_length, dtype=np.float32)
-        C = np.zeros(default_length, dtype=np.float32)
-        C1 = np.zeros(default_length, dtype=np.float32)
-        N = np.zeros(default_length, dtype=np.float32)
-        O = np.zeros(default_length, dtype=np.float32)
-        Na = np.zeros(default_length, dtype=np.float32)
-        Mg = np.zeros(default_length, dtype=np.float32)
-        Al = np.zeros(default_length, dtype=np.float32)
-        Si = np.zeros(default_length, dtype=np.float32)
-        P = np.zeros(default_length, dtype=np.float32)
-        S = np.zeros(default_length, dtype=np.float32)
-        K = np.zeros(default_length, dtype=np.float32)
-        Ca = np.zeros(default_length, dtype=np.float32)
-        Ti = np.zeros(default_length, dtype=np.float32)
-        Ti2 = np.zeros(default_length, dtype=np.float32)
-        V = np.zeros(default_length, dtype=np.float32)
-        Cr = np.zeros(default_length, dtype=np.float32)
-        Mn = np.zeros(default_length, dtype=np.float32)
-        Fe = np.zeros(default_length, dtype=np.float32)
-        Co = np.zeros(default_length, dtype=np.float32)
-        Ni = np.zeros(default_length, dtype=np.float32)
-        Cu = np.zeros(default_length, dtype=np.float32)
-        Ge = np.zeros(default_length, dtype=np.float32)
-        Ce = np.zeros(default_length, dtype=np.float32)
-        Rb = np.zeros(default_length, dtype=np.float32)
-        Y = np.zeros(default_length, dtype=np.float32)
-        Nd = np.zeros(default_length, dtype=np.float32)
-        parallax = np.zeros(default_length, dtype=np.float32)
-        fakemag = np.zeros(default_length, dtype=np.float32)
-
-        # Error array
-        teff_err = np.zeros(default_length, dtype=np.float32)
-        logg_err = np.zeros(default_length, dtype=np.float32)
-        MH_err = np.zeros(default_length, dtype=np.float32)
-        alpha_M_err = np.zeros(default_length, dtype=np.float32)
-        C_err = np.zeros(default_length, dtype=np.float32)
-        C1_err = np.zeros(default_length, dtype=np.float32)
-        N_err = np.zeros(default_length, dtype=np.float32)
-        O_err = np.zeros(default_length, dtype=np.float32)
-        Na_err = np.zeros(default_length, dtype=np.float32)
-        Mg_err = np.zeros(default_length, dtype=np.float32)
-        Al_err = np.zeros(default_length, dtype=np.float32)
-        Si_err = np.zeros(default_length, dtype=np.float32)
-        P_err = np.zeros(default_length, dtype=np.float32)
-        S_err = np.zeros(default_length, dtype=np.float32)
-        K_err = np.zeros(default_length, dtype=np.float32)
-        Ca_err = np.zeros(default_length, dtype=np.float32)
-        Ti_err = np.zeros(default_length, dtype=np.float32)
-        Ti2_err = np.zeros(default_length, dtype=np.float32)
-        V_err = np.zeros(default_length, dtype=np.float32)
-        Cr_err = np.zeros(default_length, dtype=np.float32)
-        Mn_err = np.zeros(default_length, dtype=np.float32)
-        Fe_err = np.zeros(default_length, dtype=np.float32)
-        Co_err = np.zeros(default_length, dtype=np.float32)
-        Ni_err = np.zeros(default_length, dtype=np.float32)
-        Cu_err = np.zeros(default_length, dtype=np.float32)
-        Ge_err = np.zeros(default_length, dtype=np.float32)
-        Ce_err = np.zeros(default_length, dtype=np.float32)
-        Rb_err = np.zeros(default_length, dtype=np.float32)
-        Y_err = np.zeros(default_length, dtype=np.float32)
-        Nd_err = np.zeros(default_length, dtype=np.float32)
-        parallax_err = np.zeros(default_length, dtype=np.float32)
-        fakemag_err = np.zeros(default_length, dtype=np.float32)
-
-        array_counter = 0
-
-        start_time = time.time()
 
         # provide a cont mask so no need to read every loop
         if self.cont_mask is None:
             maskpath = os.path.join(astroNN.data.datapath(), f'dr{self.apogee_dr}_contmask.npy')
             self.cont_mask = np.load(maskpath)
 
-        for counter, index in enumerate(indices):
-            nvisits = 1
-            apogee_id = hdulist[1].data['APOGEE_ID'][index]
-            if self.apogee_dr <= 15:
-                location_id = hdulist[1].data['LOCATION_ID'][index]
-                d_args = {'dr': self.apogee_dr, 'location': location_id, 'apogee': apogee_id, 'verbose': 0}
-            else:
-                field_id = hdulist[1].data['FIELD'][index]
-                telescope_id = hdulist[1].data['TELESCOPE'][index]
-                d_args = {'dr': self.apogee_dr, 'field': field_id, 'telescope': telescope_id, 'apogee': apogee_id,
-                          'verbose': 0}
+        h5path = f'{self.filename}.h5'
+        settings = {'apogee_dr': self.apogee_dr, 'continuum': self.continuum, 'spectra_only': self.spectra_only,
+                    'use_err': self.use_err, 'spectra_dtype': self.spectra_dtype,
+                    'spectra_range': list(self.spectra_range), 'spectra_err_range': list(self.spectra_err_range)}
+        old_h5f = None
+        reusable = {}  # stars whose rows can be copied from the existing h5 dataset in update mode
+        if self.mode == 'w' or not os.path.isfile(h5path):
+            print(f'Creating {h5path}')
+            h5f = h5py.File(h5path, 'w')
+            manifest = _H5Manifest(h5f, settings)
+        elif self.mode == 'resume':
+            print(f'Resuming {h5path}')
+            h5f = h5py.File(h5path, 'a')
+            manifest = _H5Manifest(h5f, settings)
+            if not np.array_equal(manifest.allstar_index, indices[:len(manifest)]):
+                h5f.close()
+                raise ValueError(f'Stars in {h5path} do not match the current filtering, use mode="update" instead')
+            # not complete until the resumed compile finishes
+            manifest.complete = False
+        elif self.mode == 'update':
+            print(f'Updating {h5path}')
+            old_h5f = h5py.File(h5path, 'r')
+            old_stars = _H5Manifest(old_h5f, settings).stars()
+            candidates = [index for index in indices if index in old_stars]
+            checksums = self._ordered_map(self._star_checksum, hdulist, candidates)
+            reusable = {index: old_stars[index] for index, checksum in zip(candidates, checksums)
+                        if checksum == old_stars[index][2]}
+            print(f'{len(reusable)} of {indices.shape[0]} stars are unchanged')
+            h5f = h5py.File(f'{h5path}.tmp', 'w')
+            manifest = _H5Manifest(h5f, settings)
+        else:
+            raise ValueError(f'Unknown mode={self.mode}, only "w", "resume" and "update" are supported')
+
+        writer = _H5BlockWriter(h5f, block_size=self.block_size, length=manifest.rows)
+        layout = _spectra_layout(total_pix, chunk_rows=self.chunk_rows, compression=self.compression,
+                                 compression_opts=self.compression_opts, shuffle=self.shuffle)
+        spec_dtype, spec_attrs = _spectra_codec(self.spectra_dtype, self.spectra_range)
+        spec_err_dtype, spec_err_attrs = _spectra_codec(self.spectra_dtype, self.spectra_err_range)
+        writer.add_dataset('spectra', shape=(total_pix,), dtype=spec_dtype, **layout)
+        writer.add_dataset('spectra_err', shape=(total_pix,), dtype=spec_err_dtype, **layout)
+        h5f['spectra'].attrs.update(spec_attrs)
+        h5f['spectra_err'].attrs.update(spec_err_attrs)
+        writer.add_dataset('in_flag')
+
+        if self.spectra_only is not True:
+            writer.add_dataset('SNR')
+
+        start = len(manifest)  # number of stars already committed if resuming
+        stars = self._ordered_map(self._star_entry, hdulist,
+                                  [index for index in indices[start:] if index not in reusable])
+
+        start_time = time.time()
+
+        for counter, index in enumerate(indices[start:], start=start):
             if counter % 100 == 0:
                 print(f'Completed {counter + 1} of {indices.shape[0]}, {(time.time() - start_time):.{2}f}s elapsed')
-            if not self.continuum:
-                path = combined_spectra(**d_args)
-                if path is False:
-                    # if path is not found then we should skip
-                    continue
-                combined_file = fits.open(path)
-                _spec = combined_file[1].data  # Pseudo-continuum normalized flux
-                _spec_err = combined_file[2].data  # Spectrum error array
-                _spec = gap_delete(_spec, dr=self.apogee_dr)  # Delete the gap between sensors
-                _spec_err = gap_delete(_spec_err, dr=self.apogee_dr)
-                inSNR = combined_file[0].header['SNR']
-                combined_file.close()
+            if index in reusable:
+                first, nvisits, checksum = reusable[index]
+                rows = {name: old_h5f[name][first:first + nvisits] for name in ['spectra', 'spectra_err', 'in_flag']}
+                if self.spectra_only is not True:
+                    rows['SNR'] = old_h5f['SNR'][first:first + nvisits]
             else:
-                path = visit_spectra(**d_args)
-                if path is False:
+                checksum, star = next(stars)
+                if star is None:
                     # if path is not found then we should skip
+                    manifest.add(index, 0, checksum)
                     continue
-                apstar_file = fits.open(path)
-                nvisits = apstar_file[0].header['NVISITS']
-                if nvisits == 1:
-                    _spec = apstar_file[1].data
-                    _spec_err = apstar_file[2].data
-                    _spec_mask = apstar_file[3].data
-                    inSNR = np.ones(nvisits)
-                    inSNR[0] = apstar_file[0].header['SNR']
-                else:
-                    _spec = apstar_file[1].data[1:]
-                    _spec_err = apstar_file[2].data[1:]
-                    _spec_mask = apstar_file[3].data[1:]
-                    inSNR = np.ones(nvisits + 1)
-                    inSNR[0] = apstar_file[0].header['SNR']
-                    for i in range(nvisits):
-                        inSNR[i + 1] = apstar_file[0].header[f'SNRVIS{i + 1}']
-
-                    # Deal with spectra thats all zeros flux
-                    ii = 0
-                    while ii < _spec.shape[0]:
-                        if np.count_nonzero(_spec[ii]) == 0:
-                            nvisits -= 1
-                            _spec = np.delete(_spec, ii, 0)
-                            _spec_err = np.delete(_spec_err, ii, 0)
-                            _spec_mask = np.delete(_spec_mask, ii, 0)
-                            inSNR = np.delete(inSNR, ii, 0)
-                            ii -= 1
-                        ii += 1
-
-                    # Just for the sake of program to work, the real nvisits still nvisits
-                    nvisits += 1
-
-                # Normalize spectra and Set some bitmask to 0
-                _spec, _spec_err = self.apstar_normalization(_spec, _spec_err, _spec_mask)
-                apstar_file.close()
+                _spec, _spec_err, inSNR, nvisits = star
 
-            if nvisits == 1:
-                individual_flag[array_counter:array_counter + nvisits] = 0
-            else:
-                individual_flag[array_counter:array_counter + 1] = 0
-                individual_flag[array_counter + 1:array_counter + nvisits] = 1
-            spec[array_counter:array_counter + nvisits, :] = _spec
-            spec_err[array_counter:array_counter + nvisits, :] = _spec_err
-            SNR[array_counter:array_counter + nvisits] = inSNR
-            RA[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['RA'][index], nvisits)
-            DEC[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['DEC'][index], nvisits)
-            parallax[array_counter:array_counter + nvisits] = np.tile(-9999, nvisits)
-            parallax_err[array_counter:array_counter + nvisits] = np.tile(-9999, nvisits)
-            fakemag[array_counter:array_counter + nvisits] = np.tile(-9999, nvisits)
-            fakemag_err[array_counter:array_counter + nvisits] = np.tile(-9999, nvisits)
-            Kmag[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['K'][index], nvisits)
-            AK_TARG[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['AK_TARG'][index], nvisits)
-
-            if self.spectra_only is not True:
-                teff[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['PARAM'][index, 0], nvisits)
-                logg[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['PARAM'][index, 1], nvisits)
-                MH[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['PARAM'][index, 3], nvisits)
-                alpha_M[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['PARAM'][index, 6],
-                                                                         nvisits)
-                C[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 0], nvisits)
-                C1[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 1], nvisits)
-                N[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 2], nvisits)
-                O[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 3], nvisits)
-                Na[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 4], nvisits)
-                Mg[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 5], nvisits)
-                Al[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 6], nvisits)
-                Si[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 7], nvisits)
-                P[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 8], nvisits)
-                S[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 9], nvisits)
-                K[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 10], nvisits)
-                Ca[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 11], nvisits)
-                Ti[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 12], nvisits)
-                Ti2[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 13], nvisits)
-                V[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 14], nvisits)
-                Cr[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 15], nvisits)
-                Mn[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 16], nvisits)
-                Fe[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 17], nvisits)
-                Co[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 18], nvisits)
-                Ni[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 19], nvisits)
-                Cu[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 20], nvisits)
-                Ge[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 21], nvisits)
-                Ce[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 22], nvisits)
-                Rb[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 23], nvisits)
-                Y[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 24], nvisits)
-                Nd[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H'][index, 25], nvisits)
-
-                if self.use_err is True:
-                    teff_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['TEFF_ERR'][index],
-                                                                              nvisits)
-                    logg_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['LOGG_ERR'][index],
-                                                                              nvisits)
-                    MH_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['M_H_ERR'][index],
-                                                                            nvisits)
-                    alpha_M_err[array_counter:array_counter + nvisits] = np.tile(
-                        hdulist[1].data['ALPHA_M_ERR'][index]
-                        , nvisits)
-                    C_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 0],
-                                                                           nvisits)
-                    C1_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 1],
-                                                                            nvisits)
-                    N_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 2],
-                                                                           nvisits)
-                    O_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 3],
-                                                                           nvisits)
-                    Na_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 4],
-                                                                            nvisits)
-                    Mg_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 5],
-                                                                            nvisits)
-                    Al_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 6],
-                                                                            nvisits)
-                    Si_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 7],
-                                                                            nvisits)
-                    P_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 8],
-                                                                           nvisits)
-                    S_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 9],
-                                                                           nvisits)
-                    K_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 10],
-                                                                           nvisits)
-                    Ca_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 11],
-                                                                            nvisits)
-                    Ti_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 12],
-                                                                            nvisits)
-                    Ti2_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 13],
-                                                                             nvisits)
-                    V_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 14],
-                                                                           nvisits)
-                    Cr_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 15],
-                                                                            nvisits)
-                    Mn_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 16],
-                                                                            nvisits)
-                    Fe_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 17],
-                                                                            nvisits)
-                    Co_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 18],
-                                                                            nvisits)
-                    Ni_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 19],
-                                                                            nvisits)
-                    Cu_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 20],
-                                                                            nvisits)
-                    Ge_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 21],
-                                                                            nvisits)
-                    Ce_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 22],
-                                                                            nvisits)
-                    Rb_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 23],
-                                                                            nvisits)
-                    Y_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 24],
-                                                                           nvisits)
-                    Nd_err[array_counter:array_counter + nvisits] = np.tile(hdulist[1].data['X_H_ERR'][index, 25],
-                                                                            nvisits)
-            array_counter += nvisits
-
-        spec = spec[0:array_counter]
-        spec_err = spec_err[0:array_counter]
-        individual_flag = individual_flag[0:array_counter]
-        RA = RA[0:array_counter]
-        DEC = DEC[0:array_counter]
-        SNR = SNR[0:array_counter]
+                individual_flag = np.ones(nvisits, dtype=np.float32)
+                individual_flag[0] = 0  # the first row is always the combined spectra
+                rows = {'spectra': _encode_spectra(_spec, spec_dtype, spec_attrs),
+                        'spectra_err': _encode_spectra(_spec_err, spec_err_dtype, spec_err_attrs),
+                        'in_flag': individual_flag}
+                if self.spectra_only is not True:
+                    rows['SNR'] = inSNR
+
+            manifest.add(index, nvisits, checksum)
+            writer.append(rows, nvisits)
+            # record every star whose rows are all on disk, so we can resume from here
+            manifest.commit(writer.length)
+
+        writer.flush()
+        manifest.commit(writer.length)
+        _create_dataset(h5f, 'index', data=indices)
 
         if self.spectra_only is not True:
-            teff = teff[0:array_counter]
-            logg = logg[0:array_counter]
-            Kmag = Kmag[0:array_counter]
-            AK_TARG = AK_TARG[0:array_counter]
-            MH = MH[0:array_counter]
-            alpha_M = alpha_M[0:array_counter]
-            C = C[0:array_counter]
-            C1 = C1[0:array_counter]
-            N = N[0:array_counter]
-            O = O[0:array_counter]
-            Na = Na[0:array_counter]
-            Mg = Mg[0:array_counter]
-            Al = Al[0:array_counter]
-            Si = Si[0:array_counter]
-            P = P[0:array_counter]
-            S = S[0:array_counter]
-            K = K[0:array_counter]
-            Ca = Ca[0:array_counter]
-            Ti = Ti[0:array_counter]
-            Ti2 = Ti2[0:array_counter]
-            V = V[0:array_counter]
-            Cr = Cr[0:array_counter]
-            Mn = Mn[0:array_counter]
-            Fe = Fe[0:array_counter]
-            Co = Co[0:array_counter]
-            Ni = Ni[0:array_counter]
-            Cu = Cu[0:array_counter]
-            Ge = Ge[0:array_counter]
-            Ce = Ce[0:array_counter]
-            Rb = Rb[0:array_counter]
-            Y = Y[0:array_counter]
-            Nd = Nd[0:array_counter]
-            parallax = parallax[0:array_counter]
-            fakemag = fakemag[0:array_counter]
-
-            teff_err = teff_err[0:array_counter]
-            logg_err = logg_err[0:array_counter]
-            MH_err = MH_err[0:array_counter]
-            alpha_M_err = alpha_M_err[0:array_counter]
-            C_err = C_err[0:array_counter]
-            C1_err = C1_err[0:array_counter]
-            N_err = N_err[0:array_counter]
-            O_err = O_err[0:array_counter]
-            Na_err = Na_err[0:array_counter]
-            Mg_err = Mg_err[0:array_counter]
-            Al_err = Al_err[0:array_counter]
-            Si_err = Si_err[0:array_counter]
-            P_err = P_err[0:array_counter]
-            S_err = S_err[0:array_counter]
-            K_err = K_err[0:array_counter]
-            Ca_err = Ca_err[0:array_counter]
-            Ti_err = Ti_err[0:array_counter]
-            Ti2_err = Ti2_err[0:array_counter]
-            V_err = V_err[0:array_counter]
-            Cr_err = Cr_err[0:array_counter]
-            Mn_err = Mn_err[0:array_counter]
-            Fe_err = Fe_err[0:array_counter]
-            Co_err = Co_err[0:array_counter]
-            Ni_err = Ni_err[0:array_counter]
-            Cu_err = Cu_err[0:array_counter]
-            Ge_err = Ge_err[0:array_counter]
-            Ce_err = Ce_err[0:array_counter]
-            Rb_err = Rb_err[0:array_counter]
-            Y_err = Y_err[0:array_counter]
-            Nd_err = Nd_err[0:array_counter]
-            parallax_err = parallax_err[0:array_counter]
-            fakemag_err = fakemag_err[0:array_counter]
+            # gather labels of all stars at once and expand them to one row per spectrum
+            allstar_index, nrows = manifest.allstar_index, manifest.nrows
+            label_columns = _ALLSTAR_COLUMNS + _ASPCAP_LABELS
+            if self.use_err is True:
+                label_columns = label_columns + _ASPCAP_LABELS_ERR
+            gathered = {}
+            for column in dict.fromkeys(column for name, column, k in label_columns):
+                gathered[column] = hdulist[1].data[column][allstar_index]
+            for name, column, k in label_columns:
+                label = gathered[column] if k is None else gathered[column][:, k]
+                _create_dataset(h5f, name, data=np.repeat(label, nrows).astype(np.float32))
+            del gathered
+
+            RA, DEC, Kmag, AK_TARG = h5f['RA'][()], h5f['DEC'][()], h5f['Kmag'][()], h5f['AK_TARG'][()]
+            parallax = np.full(writer.length, -9999, dtype=np.float32)
+            parallax_err = np.full(writer.length, -9999, dtype=np.float32)
+            fakemag = np.full(writer.length, -9999, dtype=np.float32)
+            fakemag_err = np.full(writer.length, -9999, dtype=np.float32)
 
             if self.use_esa_gaia is True:
                 gaia_ra, gaia_dec, gaia_parallax, gaia_err = gaiadr2_parallax(cuts=True, keepdims=False)
@@ -478,89 +389,390 @@ class H5Compiler(object):
                 fakemag[m1], fakemag_err[m1] = mag_to_fakemag(extinction_correction(Kmag[m1], AK_TARG[m1]),
                                                               parallax[m1], parallax_err[m1])
 
-        print(f'Creating {self.filename}.h5')
-        h5f = h5py.File(f'{self.filename}.h5', 'w')
-        h5f.create_dataset('spectra', data=spec)
-        h5f.create_dataset('spectra_err', data=spec_err)
-        h5f.create_dataset('in_flag', data=individual_flag)
-        h5f.create_dataset('index', data=indices)
-
-        if self.spectra_only is not True:
-            h5f.create_dataset('SNR', data=SNR)
-            h5f.create_dataset('RA', data=RA)
-            h5f.create_dataset('DEC', data=DEC)
-            h5f.create_dataset('Kmag', data=Kmag)
-            h5f.create_dataset('AK_TARG', data=AK_TARG)
-            h5f.create_dataset('teff', data=teff)
-            h5f.create_dataset('logg', data=logg)
-            h5f.create_dataset('M', data=MH)
-            h5f.create_dataset('alpha', data=alpha_M)
-            h5f.create_dataset('C', data=C)
-            h5f.create_dataset('C1', data=C1)
-            h5f.create_dataset('N', data=N)
-            h5f.create_dataset('O', data=O)
-            h5f.create_dataset('Na', data=Na)
-            h5f.create_dataset('Mg', data=Mg)
-            h5f.create_dataset('Al', data=Al)
-            h5f.create_dataset('Si', data=Si)
-            h5f.create_dataset('P', data=P)
-            h5f.create_dataset('S', data=S)
-            h5f.create_dataset('K', data=K)
-            h5f.create_dataset('Ca', data=Ca)
-            h5f.create_dataset('Ti', data=Ti)
-            h5f.create_dataset('Ti2', data=Ti2)
-            h5f.create_dataset('V', data=V)
-            h5f.create_dataset('Cr', data=Cr)
-            h5f.create_dataset('Mn', data=Mn)
-            h5f.create_dataset('Fe', data=Fe)
-            h5f.create_dataset('Co', data=Co)
-            h5f.create_dataset('Ni', data=Ni)
-            h5f.create_dataset('Cu', data=Cu)
-            h5f.create_dataset('Ge', data=Ge)
-            h5f.create_dataset('Ce', data=Ce)
-            h5f.create_dataset('Rb', data=Rb)
-            h5f.create_dataset('Y', data=Y)
-            h5f.create_dataset('Nd', data=Nd)
-            h5f.create_dataset('parallax', data=parallax)
-            h5f.create_dataset('fakemag', data=fakemag)
-
+            _create_dataset(h5f, 'parallax', data=parallax)
+            _create_dataset(h5f, 'fakemag', data=fakemag)
             if self.use_err is True:
-                h5f.create_dataset('AK_TARG_err', data=np.zeros_like(AK_TARG))
-                h5f.create_dataset('teff_err', data=teff_err)
-                h5f.create_dataset('logg_err', data=logg_err)
-                h5f.create_dataset('M_err', data=MH_err)
-                h5f.create_dataset('alpha_err', data=alpha_M_err)
-                h5f.create_dataset('C_err', data=C_err)
-                h5f.create_dataset('C1_err', data=C1_err)
-                h5f.create_dataset('N_err', data=N_err)
-                h5f.create_dataset('O_err', data=O_err)
-                h5f.create_dataset('Na_err', data=Na_err)
-                h5f.create_dataset('Mg_err', data=Mg_err)
-                h5f.create_dataset('Al_err', data=Al_err)
-                h5f.create_dataset('Si_err', data=Si_err)
-                h5f.create_dataset('P_err', data=P_err)
-                h5f.create_dataset('S_err', data=S_err)
-                h5f.create_dataset('K_err', data=K_err)
-                h5f.create_dataset('Ca_err', data=Ca_err)
-                h5f.create_dataset('Ti_err', data=Ti_err)
-                h5f.create_dataset('Ti2_err', data=Ti2_err)
-                h5f.create_dataset('V_err', data=V_err)
-                h5f.create_dataset('Cr_err', data=Cr_err)
-                h5f.create_dataset('Mn_err', data=Mn_err)
-                h5f.create_dataset('Fe_err', data=Fe_err)
-                h5f.create_dataset('Co_err', data=Co_err)
-                h5f.create_dataset('Ni_err', data=Ni_err)
-                h5f.create_dataset('Cu_err', data=Cu_err)
-                h5f.create_dataset('Ge_err', data=Ge_err)
-                h5f.create_dataset('Ce_err', data=Ce_err)
-                h5f.create_dataset('Rb_err', data=Rb_err)
-                h5f.create_dataset('Y_err', data=Y_err)
-                h5f.create_dataset('Nd_err', data=Nd_err)
-                h5f.create_dataset('parallax_err', data=parallax_err)
-                h5f.create_dataset('fakemag_err', data=fakemag_err)
+                _create_dataset(h5f, 'AK_TARG_err', data=np.zeros_like(AK_TARG))
+                _create_dataset(h5f, 'parallax_err', data=parallax_err)
+                _create_dataset(h5f, 'fakemag_err', data=fakemag_err)
 
+        manifest.complete = True
         h5f.close()
-        print(f'Successfully created {self.filename}.h5 in {currentdir}')
+        if old_h5f is not None:
+            old_h5f.close()
+            os.replace(f'{h5path}.tmp', h5path)
+        print(f'Successfully created {h5path} in {currentdir}')
+
+
+def _spectra_layout(total_pix, chunk_rows=None, compression=None, compression_opts=None, shuffle=False):
+    """
+    Chunk shape and filters to be passed to ``h5py.Group.create_dataset`` for spectra
+
+    :param total_pix: number of pixels of a spectrum
+    :type total_pix: int
+    :param chunk_rows: number of rows per chunk, None to let h5py guess
+    :type chunk_rows: Union[NoneType, int]
+    :param compression: None, 'lzf', 'gzip' or 'blosc'
+    :type compression: Union[NoneType, str]
+    :param compression_opts: compression settings, level for 'gzip' or keywords of ``hdf5plugin.Blosc`` for 'blosc'
+    :type compression_opts: Union[NoneType, int, dict]
+    :param shuffle: whether to apply byte shuffle filter
+    :type shuffle: bool
+    :return: keywords of create_dataset
+    :rtype: dict
+    """
+    # chunks span full rows so a batch of spectra never needs to read part of other rows
+    layout = {'chunks': True if chunk_rows is None else (chunk_rows, total_pix), 'shuffle': shuffle}
+    if compression == 'blosc':
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError('hdf5plugin is required for blosc compression, you can install it by '
+                              '"pip install hdf5plugin"')
+        layout.update(hdf5plugin.Blosc(**(compression_opts if compression_opts is not None else {})))
+    elif compression in ['lzf', 'gzip']:
+        layout.update({'compression': compression, 'compression_opts': compression_opts})
+    elif compression is not None:
+        raise ValueError(f'Unknown compression={compression}, only None, "lzf", "gzip" and "blosc" are supported')
+    return layout
+
+
+def _spectra_codec(spectra_dtype, value_range=None):
+    """
+    Storage type and the attributes needed to decode spectra stored as ``spectra_dtype``
+
+    :param spectra_dtype: 'float32', 'float16' or 'uint16'
+    :type spectra_dtype: str
+    :param value_range: (low, high) of values representable by 'uint16'
+    :type value_range: Union[NoneType, tuple]
+    :return: numpy dtype and attributes of the h5 dataset
+    :rtype: tuple
+    """
+    if spectra_dtype == 'float32':
+        return np.dtype(np.float32), {}
+    elif spectra_dtype == 'float16':
+        return np.dtype(np.float16), {}
+    elif spectra_dtype == 'uint16':
+        low, high = value_range
+        if not high > low:
+            raise ValueError(f'Invalid value_range={value_range}, high has to be larger than low')
+        # stored = round((value - offset) / scale)
+        return np.dtype(np.uint16), {'scale': (high - low) / np.iinfo(np.uint16).max, 'offset': low}
+    else:
+        raise ValueError(f'Unknown spectra_dtype={spectra_dtype}, only "float32", "float16" and "uint16" are '
+                         f'supported')
+
+
+def _encode_spectra(data, dtype, attrs):
+    """
+    Encode float spectra to the storage type returned by ``_spectra_codec()``, values outside the representable
+    range are clipped
+    """
+    if 'scale' in attrs:
+        data = (np.asarray(data, dtype=np.float64) - attrs['offset']) / attrs['scale']
+        return np.rint(np.clip(data, 0, np.iinfo(dtype).max)).astype(dtype)
+    elif dtype == np.float16:
+        # large errors of bad pixels would overflow to inf
+        finfo = np.finfo(np.float16)
+        return np.clip(data, finfo.min, finfo.max).astype(dtype)
+    else:
+        return np.asarray(data, dtype=dtype)
+
+
+def _decode_spectra(data, attrs):
+    """
+    Decode spectra read from a h5 dataset with attributes ``attrs`` back to float32, inplace if data is float32
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if 'scale' in attrs:
+        data *= np.float32(attrs['scale'])
+        data += np.float32(attrs['offset'])
+    return data
+
+
+def _create_dataset(h5f, name, data):
+    # the dataset could already exist if we are resuming a compile
+    if name in h5f:
+        del h5f[name]
+    # no timestamps in object headers so the same stars always produce the same bytes on disk
+    h5f.create_dataset(name, data=data, track_times=False)
+
+
+class _H5Manifest(object):
+    """
+    | Record of stars compiled into a h5 dataset by ``H5Compiler``, stored in the ``manifest`` group of the h5 file
+    | The allStar index, number of rows and the checksum of spectra file of every star are committed once all of its
+    | rows are on disk, so an interrupted compile can be resumed and a compiled dataset can be updated incrementally
+
+    """
+
+    def __init__(self, h5f, settings):
+        if 'manifest' not in h5f:
+            if h5f.mode == 'r':
+                raise ValueError(f'{h5f.filename} has no compile manifest, please compile it again with mode="w"')
+            gcpl = h5py.h5p.create(h5py.h5p.GROUP_CREATE)
+            gcpl.set_obj_track_times(False)
+            group = h5py.Group(h5py.h5g.create(h5f.id, b'manifest', gcpl=gcpl))
+            for name, dtype in [('allstar_index', np.int64), ('nrows', np.int64), ('checksum', 'S40')]:
+                group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True, track_times=False)
+            group.attrs.update(settings)
+            group.attrs['complete'] = False
+        self.group = h5f['manifest']
+
+        for key, value in settings.items():
+            if not np.array_equal(self.group.attrs[key], value):
+                raise ValueError(f'{h5f.filename} was compiled with {key}={self.group.attrs[key]} but {key}={value} '
+                                 f'now, please compile it again with mode="w"')
+
+        self.rows = int(np.sum(self.group['nrows'][()]))  # number of rows of committed stars
+        self._pending = []
+
+    def __len__(self):
+        return self.group['allstar_index'].shape[0]
+
+    @property
+    def allstar_index(self):
+        return self.group['allstar_index'][()]
+
+    @property
+    def nrows(self):
+        return self.group['nrows'][()]
+
+    @property
+    def complete(self):
+        return bool(self.group.attrs['complete'])
+
+    @complete.setter
+    def complete(self, value):
+        self.group.attrs['complete'] = value
+        self.group.file.flush()
+
+    def stars(self):
+        """
+        :return: allStar index to (first row, number of rows, checksum) of every committed star
+        :rtype: dict
+        """
+        nrows = self.nrows
+        first_rows = np.cumsum(nrows) - nrows
+        return {index: (first_row, n, checksum.decode()) for index, first_row, n, checksum in
+                zip(self.allstar_index, first_rows, nrows, self.group['checksum'][()])}
+
+    def add(self, index, nrows, checksum):
+        self._pending.append((index, nrows, checksum))
+
+    def commit(self, length):
+        """
+        Commit pending stars whose rows are all within the first ``length`` rows on disk
+        """
+        num, end = 0, self.rows
+        for index, nrows, checksum in self._pending:
+            if end + nrows > length:
+                break
+            end += nrows
+            num += 1
+        if num == 0:
+            return None
+
+        committed = len(self)
+        for counter, (name, dtype) in enumerate([('allstar_index', np.int64), ('nrows', np.int64),
+                                                  ('checksum', 'S40')]):
+            dataset = self.group[name]
+            dataset.resize(committed + num, axis=0)
+            dataset[committed:] = np.array([star[counter] for star in self._pending[:num]], dtype=dtype)
+        del self._pending[:num]
+        self.rows = end
+        self.group.file.flush()
+
+
+class _H5BlockWriter(object):
+    """
+    Append rows to resizable, chunked datasets in a h5 file through a fixed size in-memory block, so memory usage
+    is bounded by the block size instead of the number of rows
+
+    """
+
+    def __init__(self, h5f, block_size=1000, length=0):
+        self.h5f = h5f
+        self.block_size = block_size
+        self.length = length  # number of rows already written to disk
+        self._buffers = {}
+        self._counter = 0  # number of rows in the current block
+
+    def add_dataset(self, name, shape=(), dtype=np.float32, chunks=True, **kwargs):
+        """
+        Add a dataset to be written, ``kwargs`` are passed to ``h5py.Group.create_dataset`` like filters
+        """
+        self._buffers[name] = np.zeros((self.block_size,) + shape, dtype=dtype)
+        if name in self.h5f:
+            # resuming, discard any row after the last committed one
+            self.h5f[name].resize(self.length, axis=0)
+        else:
+            # no timestamps in object headers so the same stars always produce the same bytes on disk
+            self.h5f.create_dataset(name, shape=(self.length,) + shape, maxshape=(None,) + shape, dtype=dtype,
+                                    chunks=chunks, track_times=False, **kwargs)
+
+    def append(self, rows, nrows):
+        """
+        Append rows to the block, scalars will be broadcasted to all rows. Flush to disk whenever the block is full
+        """
+        start = 0
+        while start < nrows:
+            n = min(nrows - start, self.block_size - self._counter)
+            for name, value in rows.items():
+                value = value[start:start + n] if np.ndim(value) > 0 else value
+                self._buffers[name][self._counter:self._counter + n] = value
+            self._counter += n
+            start += n
+            if self._counter == self.block_size:
+                self.flush()
+
+    def flush(self):
+        if self._counter == 0:
+            return None
+        for name, buffer in self._buffers.items():
+            dataset = self.h5f[name]
+            dataset.resize(self.length + self._counter, axis=0)
+            dataset[self.length:] = buffer[:self._counter]
+        self.length += self._counter
+        self._counter = 0
+        self.h5f.flush()
+
+
+class H5DatasetView(object):
+    """
+    | Lazy, read-only view of rows of a dataset in h5 files, behaves like a numpy array for indexing
+    | Only the rows indexed are read from disk, in sorted order so every chunk is visited once, hence it can be passed
+    | to astroNN data generators in place of a numpy array to train on h5 datasets larger than memory
+    | If multiple h5 files are given, their datasets are viewed as concatenated and rows are read from the right file
+
+    :param h5path: path to the h5 file or list of paths
+    :type h5path: Union[str, list]
+    :param name: name of the dataset in the h5 file
+    :type name: str
+    :param index: row indices of the (concatenated) dataset in this view, None to view all rows
+    :type index: Union[NoneType, ndarray]
+    :param rdcc_nbytes: size of chunk cache in bytes of the h5 file
+    :type rdcc_nbytes: int
+    """
+
+    def __init__(self, h5path, name, index=None, rdcc_nbytes=64 * 1024 ** 2):
+        self.h5path = h5path
+        self.name = name
+        self.rdcc_nbytes = rdcc_nbytes
+        self._h5paths = [h5path] if isinstance(h5path, str) else list(h5path)
+        self._attrs, lengths, row_shapes, dtypes, chunk_rows = [], [], [], [], []
+        for path in self._h5paths:
+            with h5py.File(path, 'r') as F:
+                self._attrs.append(dict(F[self.name].attrs))
+                lengths.append(F[self.name].shape[0])
+                row_shapes.append(F[self.name].shape[1:])
+                dtypes.append(F[self.name].dtype)
+                chunk_rows.append(None if F[self.name].chunks is None else F[self.name].chunks[0])
+        if len(set(row_shapes)) > 1:
+            raise ValueError(f'Dataset "{name}" has different shape {row_shapes} in {self._h5paths}')
+        self._row_shape = row_shapes[0]
+        self._storage_dtype = dtypes[0]
+        self.chunk_rows = chunk_rows[0]  # number of rows per chunk of the first file, None if not chunked
+        self._offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)  # first row of every file
+        self.index = np.arange(self._offsets[-1]) if index is None else np.asarray(index, dtype=np.int64)
+        self._h5f = None
+        self._pid = None
+
+    @property
+    def shape(self):
+        return (self.index.shape[0],) + self._row_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32) if self.name in ['spectra', 'spectra_err'] else self._storage_dtype
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        rows = self.index[key[0]]
+        if np.ndim(rows) == 0:
+            return self.read(np.array([rows]))[0][key[1:]]
+        return self.read(rows)[(slice(None),) + key[1:]]
+
+    def __array__(self, dtype=None):
+        data = self.read(self.index)
+        return data if dtype is None else data.astype(dtype)
+
+    def __getstate__(self):
+        # h5py file object cannot be pickled, it will be opened again in the new process
+        state = self.__dict__.copy()
+        state['_h5f'] = None
+        return state
+
+    def subset(self, index):
+        """
+        View of a subset of rows of this view without reading anything
+
+        :param index: indices (or boolean mask) of rows of this view
+        :type index: Union[ndarray, slice]
+        :return: the view
+        :rtype: H5DatasetView
+        """
+        view = H5DatasetView.__new__(H5DatasetView)
+        view.__dict__.update(self.__getstate__())
+        view.index = self.index[index]
+        return view
+
+    def read(self, rows):
+        """
+        Read rows of the h5 dataset, rows are read in contiguous runs in sorted order and returned in the order given
+
+        :param rows: row indices of the (concatenated) h5 dataset, not of this view, negative indices count from the end
+        :type rows: ndarray
+        :return: the rows, spectra are decoded to float32
+        :rtype: ndarray
+        :raises IndexError: if any row is out of range of the (concatenated) h5 dataset
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        num_rows = self._offsets[-1]
+        if rows.size > 0 and (rows.min() < -num_rows or rows.max() >= num_rows):
+            raise IndexError(f'Row indices are out of range of dataset "{self.name}" with {num_rows} rows')
+        rows = np.where(rows < 0, rows + num_rows, rows)
+        unique, inverse = np.unique(rows, return_inverse=True)
+        data = np.empty((unique.shape[0],) + self._row_shape, dtype=self.dtype)
+        # unique rows are sorted so rows of every file are contiguous in data
+        bounds = np.searchsorted(unique, self._offsets)
+        for i in range(len(self._h5paths)):
+            if bounds[i] == bounds[i + 1]:
+                continue
+            dataset = self._dataset(i)
+            local = unique[bounds[i]:bounds[i + 1]] - self._offsets[i]
+            breaks = np.flatnonzero(np.diff(local) != 1) + 1
+            for start, run in zip(np.concatenate(([0], breaks)) + bounds[i], np.split(local, breaks)):
+                # HDF5 converts stored type to the type of data
+                dataset.read_direct(data, np.s_[run[0]:run[-1] + 1], np.s_[start:start + run.shape[0]])
+            if self.name in ['spectra', 'spectra_err']:
+                _decode_spectra(data[bounds[i]:bounds[i + 1]], self._attrs[i])
+        if unique.shape[0] != rows.shape[0] or np.any(unique != rows):
+            data = data[inverse.reshape(rows.shape)]
+        return data
+
+    def close(self):
+        if self._h5f is not None:
+            for h5f in self._h5f:
+                if h5f is not None:
+                    h5f.close()
+            self._h5f = None
+
+    def _dataset(self, i):
+        # h5 file opened before forking cannot be used in the child process
+        if self._h5f is None or self._pid != os.getpid():
+            self._h5f = [None] * len(self._h5paths)
+            self._pid = os.getpid()
+        if self._h5f[i] is None:
+            self._h5f[i] = h5py.File(self._h5paths[i], 'r', rdcc_nbytes=self.rdcc_nbytes)
+        return self._h5f[i][self.name]
 
 
 class H5Loader(object):
@@ -571,73 +783,121 @@ class H5Loader(object):
         self.load_combined = True
         self.load_err = False
         self.exclude9999 = False
-
-        if os.path.isfile(os.path.join(self.currentdir, self.filename)) is True:
-            self.h5path = os.path.join(self.currentdir, self.filename)
-        elif os.path.isfile(os.path.join(self.currentdir, (self.filename + '.h5'))) is True:
-            self.h5path = os.path.join(self.currentdir, (self.filename + '.h5'))
-        else:
-            raise FileNotFoundError(f'Cannot find {os.path.join(self.currentdir, self.filename)}')
+        self.lazy = False  # True to return spectra as H5DatasetView which only reads the rows indexed from disk
+        # list of (dataset name, operator, value) to select rows, e.g. [('SNR', '>', 200), ('teff', '<', 5500)]
+        self.filters = None
+        self._allowed_cache = None  # (settings, allowed mask, allowed index) of the last load_allowed_mask()
+
+        # multiple compiled h5 datasets are loaded as if they were concatenated
+        self._h5paths = []
+        for filename in ([self.filename] if isinstance(self.filename, str) else self.filename):
+            if os.path.isfile(os.path.join(self.currentdir, filename)) is True:
+                self._h5paths.append(os.path.join(self.currentdir, filename))
+            elif os.path.isfile(os.path.join(self.currentdir, (filename + '.h5'))) is True:
+                self._h5paths.append(os.path.join(self.currentdir, (filename + '.h5')))
+            else:
+                raise FileNotFoundError(f'Cannot find {os.path.join(self.currentdir, filename)}')
+        self.h5path = self._h5paths[0] if isinstance(self.filename, str) else self._h5paths
 
         self.target = target_conversion(self.target)
 
-    def load_allowed_index(self):
-        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
-            if self.exclude9999 is True:
-                index_not9999 = None
-                for counter, tg in enumerate(self.target):
-                    if index_not9999 is None:
-                        index_not9999 = np.arange(F[f'{tg}'].shape[0])
-                    temp_index = np.where(np.array(F[f'{tg}']) != -9999)[0]
-                    index_not9999 = reduce(np.intersect1d, (index_not9999, temp_index))
-
-                in_flag = index_not9999
-                if self.load_combined is True:
-                    in_flag = np.where(np.array(F['in_flag']) == 0)[0]
-                elif self.load_combined is False:
-                    in_flag = np.where(np.array(F['in_flag']) == 1)[0]
-
-                allowed_index = reduce(np.intersect1d, (index_not9999, in_flag))
-
-            else:
-                in_flag = []
-                if self.load_combined is True:
-                    in_flag = np.where(np.array(F['in_flag']) == 0)[0]
-                elif self.load_combined is False:
-                    in_flag = np.where(np.array(F['in_flag']) == 1)[0]
+    def load_allowed_mask(self):
+        """
+        Boolean mask of rows to be loaded, computed once and cached until ``target``, ``exclude9999``,
+        ``load_combined``, ``filters`` or the h5 file changes. ``filters`` are evaluated block by block on disk
 
-                allowed_index = in_flag
+        :return: boolean mask of all rows in the h5 dataset
+        :rtype: ndarray[bool]
+        """
+        filters = [] if self.filters is None else [tuple(f) for f in self.filters]
+        key = (tuple(np.atleast_1d(self.target).tolist()), self.exclude9999, self.load_combined, tuple(filters),
+               tuple(os.path.getmtime(path) for path in self._h5paths))
+        if self._allowed_cache is None or self._allowed_cache[0] != key:
+            if self.exclude9999 is True:
+                filters = filters + [(tg, '!=', -9999) for tg in self.target]
+            masks = []
+            for path in self._h5paths:
+                with h5py.File(path, 'r') as F:  # ensure the file will be cleaned up
+                    in_flag = F['in_flag'][()]
+                    if self.load_combined is True:
+                        mask = (in_flag == 0)
+                    elif self.load_combined is False:
+                        mask = (in_flag == 1)
+                    else:
+                        mask = np.ones(in_flag.shape[0], dtype=bool)
+                    _filter_mask(F, mask, filters)
+                masks.append(mask)
+            mask = np.concatenate(masks)
+            self._allowed_cache = (key, mask, np.flatnonzero(mask))
+        return self._allowed_cache[1]
 
-            F.close()
+    def load_allowed_index(self):
+        """
+        Indices of rows to be loaded, see ``load_allowed_mask()``
 
-        return allowed_index
+        :return: indices of rows
+        :rtype: ndarray
+        """
+        self.load_allowed_mask()
+        return self._allowed_cache[2]
 
     def load(self):
         allowed_index = self.load_allowed_index()
-        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
-            allowed_index_list = allowed_index.tolist()
-            spectra = np.array(F['spectra'])[allowed_index_list]
-            spectra_err = np.array(F['spectra_err'])[allowed_index_list]
-
-            y = np.array((spectra.shape[1]))
-            y_err = np.array((spectra.shape[1]))
-            for counter, tg in enumerate(self.target):
-                temp = np.array(F[f'{tg}'])[allowed_index_list]
-                if counter == 0:
-                    y = temp[:]
-                else:
-                    y = np.column_stack((y, temp[:]))
-                if self.load_err is True:
-                    temp_err = np.array(F[f'{tg}_err'])[allowed_index_list]
-                    if counter == 0:
-                        y_err = temp_err[:]
-                    else:
-                        y_err = np.column_stack((y_err, temp_err[:]))
+        # only read spectra_err if needed
+        names = ['spectra', 'spectra_err'] if self.load_err is True else ['spectra']
+        if self.lazy is True:
+            spectra = [H5DatasetView(self.h5path, name, index=allowed_index) for name in names]
+            columns = {}
+        else:
+            columns = self.load_columns(names)
+            spectra = [columns[name] for name in names]
+
+        columns.update(self.load_columns([f'{tg}{suffix}' for tg in self.target for suffix in
+                                          (['', '_err'] if self.load_err is True else [''])]))
+        y = [columns[f'{tg}'] for tg in self.target]
+        y = y[0] if len(y) == 1 else np.column_stack(y)
 
         if self.load_err is True:
-            return spectra, y, spectra_err, y_err
+            y_err = [columns[f'{tg}_err'] for tg in self.target]
+            y_err = y_err[0] if len(y_err) == 1 else np.column_stack(y_err)
+            return spectra[0], y, spectra[1], y_err
         else:
-            return spectra, y
+            return spectra[0], y
+
+    def load_columns(self, names):
+        """
+        Load datasets in the h5 file of the rows to be loaded, only the blocks of rows containing any of them are
+        read from disk
+
+        :param names: names of datasets to load
+        :type names: list
+        :return: dataset name to the loaded array
+        :rtype: dict
+        """
+        allowed_mask = self.load_allowed_mask()
+        h5fs = [h5py.File(path, 'r') for path in self._h5paths]
+        try:
+            columns = {}
+            for name in names:
+                datasets = [h5f[f'{name}'] for h5f in h5fs]
+                if len(set(dataset.shape[1:] for dataset in datasets)) > 1:
+                    raise ValueError(f'Dataset "{name}" has different shape in {self._h5paths}')
+                dtype = np.float32 if name in ['spectra', 'spectra_err'] else datasets[0].dtype
+                # rows of every file are read directly into their place in the output, no concatenated copy
+                columns[name] = np.empty((np.count_nonzero(allowed_mask),) + datasets[0].shape[1:], dtype=dtype)
+                first_row, filled = 0, 0
+                for dataset in datasets:
+                    mask = allowed_mask[first_row:first_row + dataset.shape[0]]
+                    out = columns[name][filled:filled + np.count_nonzero(mask)]
+                    _read_masked(dataset, mask, out=out)
+                    if name in ['spectra', 'spectra_err']:
+                        _decode_spectra(out, dataset.attrs)
+                    first_row += dataset.shape[0]
+                    filled += out.shape[0]
+        finally:
+            for h5f in h5fs:
+                h5f.close()
+        return columns
 
     def load_entry(self, name):
         """
@@ -652,10 +912,75 @@ class H5Loader(object):
         HISTORY:
             2018-Feb-08 - Written - Henry Leung (University of Toronto)
         """
-        allowed_index = self.load_allowed_index()
-        allowed_index_list = allowed_index.tolist()
-        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
-            return np.array(F[f'{name}'])[allowed_index_list]
+        return self.load_columns([name])[name]
+
+
+def _block_rows(dataset):
+    """
+    Number of rows to read at once from a h5 dataset, a multiple of chunk rows so every chunk is read once
+    """
+    row_nbytes = max(1, dataset.dtype.itemsize * int(np.prod(dataset.shape[1:])))
+    rows = max(1, _READ_BLOCK_NBYTES // row_nbytes)
+    if dataset.chunks is not None:
+        rows = max(1, rows // dataset.chunks[0]) * dataset.chunks[0]
+    return rows
+
+
+def _filter_mask(h5f, mask, filters):
+    """
+    Evaluate ``filters`` on datasets in ``h5f`` block by block and update ``mask`` inplace. Blocks without any row
+    selected by ``mask`` are not read
+
+    :param h5f: h5 file
+    :type h5f: h5py.File
+    :param mask: boolean mask of rows
+    :type mask: ndarray[bool]
+    :param filters: list of (dataset name, operator, value) where operator is one of '<', '<=', '>', '>=', '==', '!='
+    :type filters: list
+    """
+    for name, op, value in filters:
+        if op not in _FILTER_OPERATORS:
+            raise ValueError(f'Unknown operator "{op}" in filters, only {list(_FILTER_OPERATORS)} are supported')
+        if name not in h5f or h5f[name].ndim != 1 or h5f[name].shape[0] != mask.shape[0]:
+            raise ValueError(f'Filter can only be applied to a 1D dataset with one value per row but got "{name}"')
+    if len(filters) == 0:
+        return None
+    block_rows = min(_block_rows(h5f[name]) for name, op, value in filters)
+    for start in range(0, mask.shape[0], block_rows):
+        block = mask[start:start + block_rows]  # a view so mask is updated inplace
+        for name, op, value in filters:
+            if not np.any(block):
+                break
+            block &= _FILTER_OPERATORS[op](h5f[name][start:start + block_rows], value)
+
+
+def _read_masked(dataset, mask, out=None):
+    """
+    Read rows of a h5 dataset selected by a boolean mask block by block, blocks without any row selected are not read
+
+    :param dataset: h5 dataset
+    :type dataset: h5py.Dataset
+    :param mask: boolean mask of rows
+    :type mask: ndarray[bool]
+    :param out: array to read into, None to allocate a new one
+    :type out: Union[NoneType, ndarray]
+    :return: selected rows
+    :rtype: ndarray
+    """
+    data = np.empty((np.count_nonzero(mask),) + dataset.shape[1:], dtype=dataset.dtype) if out is None else out
+    block_rows = _block_rows(dataset)
+    filled = 0
+    for start in range(0, mask.shape[0], block_rows):
+        selected = np.flatnonzero(mask[start:start + block_rows])
+        if selected.shape[0] == 0:
+            continue
+        first, last = start + selected[0], start + selected[-1] + 1
+        if selected.shape[0] == last - first:
+            dataset.read_direct(data, np.s_[first:last], np.s_[filled:filled + selected.shape[0]])
+        else:
+            data[filled:filled + selected.shape[0]] = dataset[first:last][selected - selected[0]]
+        filled += selected.shape[0]
+    return data
 
 
 def target_conversion(target):
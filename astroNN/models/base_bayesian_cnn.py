@@ -11,15 +11,16 @@ from astroNN.config import _astroNN_MODEL_NAME
 from astroNN.datasets import H5Loader
 from astroNN.models.base_master_nn import NeuralNetMaster
 from astroNN.nn.callbacks import VirutalCSVLogger
-from astroNN.nn.layers import FastMCInference
+from astroNN.nn.layers import FastMCInference, MomentPropagation
 from astroNN.nn.losses import mean_absolute_error, mean_error, mean_squared_error
 from astroNN.nn.metrics import categorical_accuracy, binary_accuracy
 from astroNN.nn.numpy import sigmoid
-from astroNN.nn.utilities import Normalizer
+from astroNN.nn.utilities import Normalizer, NormalizedView
 from astroNN.nn.utilities.generator import GeneratorMaster
 from astroNN.shared.custom_warnings import deprecated
 from astroNN.shared.nn_tools import gpu_availability
 from astroNN.shared.dict_tools import dict_np_to_dict_list, list_to_dict
+from astroNN.shared.result_cache import cached_result
 
 from astroNN.nn.losses import bayesian_binary_crossentropy_wrapper, bayesian_binary_crossentropy_var_wrapper
 from astroNN.nn.losses import bayesian_categorical_crossentropy_wrapper, bayesian_categorical_crossentropy_var_wrapper
@@ -46,19 +47,21 @@ class BayesianCNNDataGenerator(GeneratorMaster):
     :type data: list
     :param manual_reset: Whether need to reset the generator manually, usually it is handled by tensorflow
     :type manual_reset: bool
+    :param idx: Indices of data to generate from, None to use all data
+    :type idx: Union[NoneType, ndarray]
     :History:
         | 2017-Dec-02 - Written - Henry Leung (University of Toronto)
         | 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
     """
 
-    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset=False):
+    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset=False, idx=None):
         super().__init__(batch_size=batch_size, shuffle=shuffle, steps_per_epoch=steps_per_epoch, data=data,
-                         manual_reset=manual_reset)
+                         manual_reset=manual_reset, idx=idx)
         self.inputs = self.data[0]
         self.labels = self.data[1]
 
         # initial idx
-        self.idx_list = self._get_exploration_order(range(self.inputs['input'].shape[0]))
+        self.idx_list = self._get_exploration_order(self._data_idx(self.inputs['input'].shape[0]))
 
     def _data_generation(self, inputs, labels, idx_list_temp):
         x = self.input_d_checking(inputs, idx_list_temp)
@@ -68,15 +71,16 @@ class BayesianCNNDataGenerator(GeneratorMaster):
             y.update({name: labels[name][idx_list_temp]})
         return x, y
 
+    def _get_batch(self, idx_list_temp):
+        return self._data_generation(self.inputs, self.labels, idx_list_temp)
+
     def __getitem__(self, index):
-        x, y = self._data_generation(self.inputs,
-                                     self.labels,
-                                     self.idx_list[index * self.batch_size: (index + 1) * self.batch_size])
+        x, y = self._prefetched_batch(index)
         return x, y
 
     def on_epoch_end(self):
         # shuffle the list when epoch ends for the next epoch
-        self.idx_list = self._get_exploration_order(range(self.inputs['input'].shape[0]))
+        self.idx_list = self._get_exploration_order(self._data_idx(self.inputs['input'].shape[0]))
 
 
 class BayesianCNNPredDataGenerator(GeneratorMaster):
@@ -91,18 +95,22 @@ class BayesianCNNPredDataGenerator(GeneratorMaster):
     :type data: list
     :param manual_reset: Whether need to reset the generator manually, usually it is handled by tensorflow
     :type manual_reset: bool
+    :param pad_last: Whether to pad the last batch to batch_size by repeating its last data
+    :type pad_last: bool
+    :param idx: Indices of data to generate from, None to use all data
+    :type idx: Union[NoneType, ndarray]
     :History:
         | 2017-Dec-02 - Written - Henry Leung (University of Toronto)
         | 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
     """
 
-    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset=False):
+    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset=False, pad_last=False, idx=None):
         super().__init__(batch_size=batch_size, shuffle=shuffle, steps_per_epoch=steps_per_epoch, data=data,
-                         manual_reset=manual_reset)
+                         manual_reset=manual_reset, idx=idx, pad_last=pad_last)
         self.inputs = self.data[0]
 
         # initial idx
-        self.idx_list = self._get_exploration_order(range(self.inputs[list(self.inputs.keys())[0]].shape[0]))
+        self.idx_list = self._get_exploration_order(self._data_idx(self.inputs[list(self.inputs.keys())[0]].shape[0]))
         self.current_idx = 0
 
     def _data_generation(self, inputs, idx_list_temp):
@@ -110,13 +118,16 @@ class BayesianCNNPredDataGenerator(GeneratorMaster):
         x = self.input_d_checking(inputs, idx_list_temp)
         return x
 
+    def _get_batch(self, idx_list_temp):
+        return self._data_generation(self.inputs, idx_list_temp)
+
     def __getitem__(self, index):
-        x = self._data_generation(self.inputs, self.idx_list[index * self.batch_size: (index + 1) * self.batch_size])
+        x = self._prefetched_batch(index)
         return x
 
     def on_epoch_end(self):
         # shuffle the list when epoch ends for the next epoch
-        self.idx_list = self._get_exploration_order(range(self.inputs[list(self.inputs.keys())[0]].shape[0]))
+        self.idx_list = self._get_exploration_order(self._data_idx(self.inputs[list(self.inputs.keys())[0]].shape[0]))
 
 
 class BayesianCNNBase(NeuralNetMaster, ABC):
@@ -147,6 +158,16 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         self.dropout_rate = 0.2
         self.length_scale = 3  # prior length scale
         self.mc_num = 100  # increased to 100 due to high performance VI on GPU implemented on 14 April 2018 (Henry)
+        # number of Monte Carlo passes to run at once with running mean and variance, None to run all mc_num at once
+        self.mc_chunk_size = None
+        # stop Monte Carlo passes of a data once standard error of the mean of every output is below mc_tol (in
+        # normalized unit), passes are done in rounds of mc_chunk_size (or 10) up to mc_num, None to always do mc_num
+        self.mc_tol = None
+        # approximate Monte Carlo inference deterministically in a single pass by propagating mean and variance
+        self.moment_propagation = False
+        # identifier of Monte Carlo draw of results cached by result_cache, cached Monte Carlo results are frozen so
+        # the same draw is returned for the same data until it is changed
+        self.mc_draw = 0
         self.val_size = 0.1
         self.disable_dropout = False
 
@@ -157,6 +178,10 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         self.labels_norm_mode = 2
 
         self.keras_model_predict = None
+        # FastMCInference models reused by test() so they are only built and traced once for the same
+        # mc_num, mc_chunk_size and model
+        self._mc_inference_models = {}
+        self._mc_inference_key = None
 
     def pre_training_checklist_child(self, input_data, labels):
         input_data, labels = self.pre_training_checklist_master(input_data, labels)
@@ -166,17 +191,24 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            # uncertainties are normalized separately below, so they are not normalized inplace by input normalizer
+            norm_data = self._normalize_inputs(input_data, inplace_names=['input'])
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(labels)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = self._normalize_inputs(input_data, calc=False, inplace_names=['input'])
             norm_labels = self.labels_normalizer.normalize(labels, calc=False)
 
         # No need to care about Magic number as loss function looks for magic num in y_true only
-        norm_data.update({"input_err": (input_data['input_err'] / self.input_std['input']),
-                          "labels_err": input_data['labels_err'] / self.labels_std['output']})
+        for name, std in [('input_err', self.input_std['input']), ('labels_err', self.labels_std['output'])]:
+            if self._out_of_core(input_data):
+                norm_data.update({name: NormalizedView(input_data[name], std=std, magic=False)})
+            elif self.inplace_normalization and input_data[name].dtype == np.float32 and \
+                    input_data[name].flags.writeable:
+                norm_data.update({name: np.divide(input_data[name], std, out=input_data[name])})
+            else:
+                norm_data.update({name: input_data[name] / std})
         norm_labels.update({"variance_output": norm_labels['output']})
 
         if self.keras_model is None:  # only compile if there is no keras_model, e.g. fine-tuning does not required
@@ -184,34 +216,32 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
 
         self.train_idx, self.val_idx = train_test_split(np.arange(self.num_train + self.val_num),
                                                         test_size=self.val_size)
-
-        norm_data_training = {}
-        norm_data_val = {}
-        norm_labels_training = {}
-        norm_labels_val = {}
-        for name in norm_data.keys():
-            norm_data_training.update({name: norm_data[name][self.train_idx]})
-            norm_data_val.update({name: norm_data[name][self.val_idx]})
-        for name in norm_labels.keys():
-            norm_labels_training.update({name: norm_labels[name][self.train_idx]})
-            norm_labels_val.update({name: norm_labels[name][self.val_idx]})
+        out_of_core = self._out_of_core(norm_data)
+        if out_of_core:
+            # read out-of-core data in the order on disk
+            self.train_idx, self.val_idx = np.sort(self.train_idx), np.sort(self.val_idx)
 
         self.inv_model_precision = (2 * self.num_train * self.l2) / (self.length_scale ** 2 * (1 - self.dropout_rate))
 
+        # generators take the whole data with indices of the split, so the split is not copied from data
         self.training_generator = BayesianCNNDataGenerator(batch_size=self.batch_size,
                                                            shuffle=True,
                                                            steps_per_epoch=self.num_train // self.batch_size,
-                                                           data=[norm_data_training,
-                                                                 norm_labels_training],
-                                                           manual_reset=False)
+                                                           data=[norm_data, norm_labels],
+                                                           manual_reset=False,
+                                                           idx=self.train_idx)
 
         val_batchsize = self.batch_size if len(self.val_idx) > self.batch_size else len(self.val_idx)
         self.validation_generator = BayesianCNNDataGenerator(batch_size=val_batchsize,
                                                              shuffle=False,
                                                              steps_per_epoch=max(self.val_num // self.batch_size, 1),
-                                                             data=[norm_data_val,
-                                                                   norm_labels_val],
-                                                             manual_reset=True)
+                                                             data=[norm_data, norm_labels],
+                                                             manual_reset=True,
+                                                             idx=self.val_idx)
+
+        if out_of_core:
+            self._setup_out_of_core_generator(self.training_generator, norm_data)
+            self._setup_out_of_core_generator(self.validation_generator, norm_data)
 
         return norm_data, norm_labels
 
@@ -337,7 +367,11 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
             | 2018-Apr-12 - Updated - Henry Leung (University of Toronto)
         """
         if inputs_err is None:
-            inputs_err = np.zeros_like(input_data)
+            if isinstance(input_data, np.ndarray):
+                inputs_err = np.zeros_like(input_data)
+            else:  # out-of-core input data, do not allocate zeros of the same size in memory
+                inputs_err = np.broadcast_to(np.zeros((1,) + input_data.shape[1:], dtype=np.float32),
+                                             input_data.shape)
 
         if labels_err is None:
             labels_err = np.zeros_like(labels)
@@ -365,12 +399,20 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
 
         start_time = time.time()
 
-        self.history = self.keras_model.fit(self.training_generator,
-                                            validation_data=self.validation_generator,
-                                            epochs=self.max_epochs, verbose=self.verbose,
-                                            workers=os.cpu_count(),
-                                            callbacks=self.__callbacks,
-                                            use_multiprocessing=MULTIPROCESS_FLAG)
+        try:
+            self.history = self.keras_model.fit(self._data_pipeline(self.training_generator),
+                                                validation_data=self._data_pipeline(self.validation_generator),
+                                                epochs=self.max_epochs, verbose=self.verbose,
+                                                workers=self.training_generator.workers,
+                                                max_queue_size=self.training_generator.max_queue_size,
+                                                callbacks=self.__callbacks,
+                                                # generator worker processes cannot start in tensorflow workers
+                                                use_multiprocessing=MULTIPROCESS_FLAG and self.n_workers == 0,
+                                                # generators shuffle data, request batches in order to read ahead
+                                                shuffle=False)
+        finally:
+            self.training_generator.close()
+            self.validation_generator.close()
 
         print(f'Completed Training, {(time.time() - start_time):.{2}f}s in total')
 
@@ -400,7 +442,11 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         self.has_model_check()
 
         if inputs_err is None:
-            inputs_err = np.zeros_like(input_data)
+            if isinstance(input_data, np.ndarray):
+                inputs_err = np.zeros_like(input_data)
+            else:  # out-of-core input data, do not allocate zeros of the same size in memory
+                inputs_err = np.broadcast_to(np.zeros((1,) + input_data.shape[1:], dtype=np.float32),
+                                             input_data.shape)
 
         if labels_err is None:
             labels_err = np.zeros_like(labels)
@@ -437,7 +483,8 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         score = self.keras_model.fit(fit_generator,
                                      epochs=1,
                                      verbose=self.verbose,
-                                     workers=os.cpu_count(),
+                                     workers=fit_generator.workers,
+                                     max_queue_size=fit_generator.max_queue_size,
                                      use_multiprocessing=MULTIPROCESS_FLAG)
 
         print(f'Completed Training on Batch, {(time.time() - start_time):.{2}f}s in total')
@@ -483,6 +530,7 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         with open(self.fullfilepath + '/astroNN_model_parameter.json', 'w') as f:
             json.dump(data, f, indent=4, sort_keys=True)
 
+    @cached_result
     def test(self, input_data, inputs_err=None):
         """
         Test model, High performance version designed for fast variational inference on GPU
@@ -491,14 +539,14 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         :type input_data: ndarray
         :param inputs_err: Error for input_data, same shape with input_data.
         :type inputs_err: Union([NoneType, ndarray])
-        :return: prediction and prediction uncertainty
+        :return: prediction and prediction uncertainty, with number of Monte Carlo passes of each data in 'mc_num'
         :History:
             | 2018-Jan-06 - Written - Henry Leung (University of Toronto)
             | 2018-Apr-12 - Updated - Henry Leung (University of Toronto)
         """
         self.has_model_check()
 
-        if gpu_availability() is False and self.mc_num > 25:
+        if gpu_availability() is False and self.mc_num > 25 and self.moment_propagation is False:
             warnings.warn(f'You are using CPU version Tensorflow, doing {self.mc_num} times Monte Carlo Inference can '
                           f'potentially be very slow! \n '
                           f'A possible fix is to decrease the mc_num parameter of the model to do less MC Inference \n'
@@ -508,7 +556,11 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
 
                 # if no error array then just zeros
         if inputs_err is None:
-            inputs_err = np.zeros_like(input_data)
+            if isinstance(input_data, np.ndarray):
+                inputs_err = np.zeros_like(input_data)
+            else:  # out-of-core input data, do not allocate zeros of the same size in memory
+                inputs_err = np.broadcast_to(np.zeros((1,) + input_data.shape[1:], dtype=np.float32),
+                                             input_data.shape)
         else:
             inputs_err = np.atleast_2d(inputs_err)
             inputs_err /= self.input_std['input']
@@ -517,7 +569,7 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         input_data = self.pre_testing_checklist_master(input_data)
 
         if self.input_normalizer is not None:
-            input_array = self.input_normalizer.normalize(input_data, calc=False)
+            input_array = self._normalize_inputs(input_data, calc=False, inplace_names=[])
         else:
             # Prevent shallow copy issue
             input_array = np.array(input_data)
@@ -526,48 +578,17 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
 
         total_test_num = input_data['input'].shape[0]  # Number of testing data
 
-        # for number of training data smaller than batch_size
-        if total_test_num < self.batch_size:
-            batch_size = total_test_num
-        else:
-            batch_size = self.batch_size
-
-        # Due to the nature of how generator works, no overlapped prediction
-        data_gen_shape = (total_test_num // batch_size) * batch_size
-        remainder_shape = total_test_num - data_gen_shape  # Remainder from generator
-
-        norm_data_main = {}
-        norm_data_remainder = {}
-        for name in input_array.keys():
-            norm_data_main.update({name: input_array[name][:data_gen_shape]})
-            norm_data_remainder.update({name: input_array[name][data_gen_shape:]})
-
         start_time = time.time()
         print("Starting Dropout Variational Inference")
 
-        # Data Generator for prediction
-        prediction_generator = BayesianCNNPredDataGenerator(batch_size=batch_size,
-                                                            shuffle=False,
-                                                            steps_per_epoch=data_gen_shape // batch_size,
-                                                            data=[norm_data_main])
-
-        new = FastMCInference(self.mc_num)(self.keras_model_predict)
-
-        result = np.asarray(new.predict(prediction_generator))
-
-        if remainder_shape != 0:  # deal with remainder
-            remainder_generator = BayesianCNNPredDataGenerator(batch_size=remainder_shape,
-                                                               shuffle=False,
-                                                               steps_per_epoch=1,
-                                                               data=[norm_data_remainder])
-            remainder_result = np.asarray(new.predict(remainder_generator))
-            if remainder_shape == 1:
-                remainder_result = np.expand_dims(remainder_result, axis=0)
-            result = np.concatenate((result, remainder_result))
-
-        # in case only 1 test data point, in such case we need to add a dimension
-        if result.ndim < 3 and batch_size == 1:
-            result = np.expand_dims(result, axis=0)
+        if self.moment_propagation is True:
+            result = self._mc_predict(input_array, None)
+            mc_num_used = np.zeros(total_test_num, dtype=int)
+        elif self.mc_tol is None:
+            result = self._mc_predict(input_array, self.mc_num)
+            mc_num_used = np.full(total_test_num, self.mc_num)
+        else:
+            result, mc_num_used = self._adaptive_mc_predict(input_array)
 
         half_first_dim = result.shape[1] // 2  # result.shape[1] is guarantee an even number, otherwise sth is wrong
 
@@ -576,8 +597,12 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         predictions_var = np.exp(result[:, half_first_dim:, 0]) * (
                 self.labels_std['output'] ** 2)  # predictive uncertainty
 
-        print(f'Completed Dropout Variational Inference with {self.mc_num} forward passes, '
-              f'{(time.time() - start_time):.{2}f}s elapsed')
+        if self.moment_propagation is True:
+            print(f'Completed Dropout Variational Inference with moment propagation, '
+                  f'{(time.time() - start_time):.{2}f}s elapsed')
+        else:
+            print(f'Completed Dropout Variational Inference with {np.mean(mc_num_used):.{1}f} forward passes on '
+                  f'average, {(time.time() - start_time):.{2}f}s elapsed')
 
         if self.labels_normalizer is not None:
             predictions = self.labels_normalizer.denormalize(
@@ -597,35 +622,127 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
             predictive_uncertainty = np.sqrt(predictions_var)
 
         elif self.task == 'classification':
-            # we want entropy for classification uncertainty
-            predicted_class = np.argmax(predictions, axis=1)
-            mc_dropout_uncertainty = np.ones_like(predicted_class, dtype=float)
-            predictive_uncertainty = np.ones_like(predicted_class, dtype=float)
-
-            # center variance
-            predictions_var -= 1.
-            for i in range(predicted_class.shape[0]):
-                all_prediction = np.array(predictions[i, :])
-                mc_dropout_uncertainty[i] = - np.sum(all_prediction * np.log(all_prediction))
-                predictive_uncertainty[i] = predictions_var[i, predicted_class[i]]
-
+            predictions, mc_dropout_uncertainty, predictive_uncertainty = self._classification_uncertainty(
+                predictions, predictions_var)
             pred_uncertainty = mc_dropout_uncertainty + predictive_uncertainty
-            # We only want the predicted class back
-            predictions = predicted_class
 
         elif self.task == 'binary_classification':
-            # we want entropy for classification uncertainty, so need prediction in logits space
-            mc_dropout_uncertainty = - np.sum(predictions * np.log(predictions), axis=0)
-            # need to activate before round to int so that the prediction is always 0 or 1
-            predictions = np.rint(sigmoid(predictions))
-            predictive_uncertainty = predictions_var
-            pred_uncertainty = mc_dropout_uncertainty + predictions_var
+            predictions, mc_dropout_uncertainty, predictive_uncertainty = self._binary_classification_uncertainty(
+                predictions, predictions_var)
+            pred_uncertainty = mc_dropout_uncertainty + predictive_uncertainty
 
         else:
             raise AttributeError('Unknown Task')
 
         return predictions, {'total': pred_uncertainty, 'model': mc_dropout_uncertainty,
-                             'predictive': predictive_uncertainty}
+                             'predictive': predictive_uncertainty, 'mc_num': mc_num_used}
+
+    def _result_cache_identity(self):
+        return super()._result_cache_identity() + (self.mc_num, self.mc_chunk_size, self.mc_tol,
+                                                   self.moment_propagation, self.mc_draw)
+
+    @staticmethod
+    def _classification_uncertainty(predictions, predictions_var):
+        """
+        Predicted class, entropy as model uncertainty and centered variance of the predicted class as predictive
+        uncertainty of classification
+
+        :return: predicted class, model uncertainty and predictive uncertainty
+        """
+        # we want entropy for classification uncertainty
+        predicted_class = np.argmax(predictions, axis=1)
+        mc_dropout_uncertainty = - np.sum(predictions * np.log(predictions), axis=1)
+        # center variance
+        predictive_uncertainty = np.take_along_axis(predictions_var, predicted_class[:, np.newaxis], axis=1)[:, 0] - 1.
+        # We only want the predicted class back
+        return predicted_class, mc_dropout_uncertainty, predictive_uncertainty
+
+    @staticmethod
+    def _binary_classification_uncertainty(predictions, predictions_var):
+        """
+        Predicted class, entropy of every output over all data as model uncertainty and variance as predictive
+        uncertainty of binary classification
+
+        :return: predicted class, model uncertainty and predictive uncertainty
+        """
+        # we want entropy for classification uncertainty, so need prediction in logits space
+        mc_dropout_uncertainty = - np.sum(predictions * np.log(predictions), axis=0)
+        # need to activate before round to int so that the prediction is always 0 or 1
+        return np.rint(sigmoid(predictions)), mc_dropout_uncertainty, predictions_var
+
+    def _fast_mc_model(self, mc_num):
+        """
+        FastMCInference model of keras_model_predict doing mc_num Monte Carlo passes (or MomentPropagation model if
+        mc_num is None), built once and reused
+        """
+        if self._mc_inference_key != id(self.keras_model_predict):
+            self._mc_inference_models = {}
+            self._mc_inference_key = id(self.keras_model_predict)
+        if mc_num is None:
+            key = None
+            if key not in self._mc_inference_models:
+                self._mc_inference_models[key] = MomentPropagation()(self.keras_model_predict)
+        else:
+            key = (mc_num, self.mc_chunk_size)
+            if key not in self._mc_inference_models:
+                self._mc_inference_models[key] = FastMCInference(
+                    mc_num, chunk_size=self.mc_chunk_size)(self.keras_model_predict)
+        return self._mc_inference_models[key]
+
+    def _mc_predict(self, input_array, mc_num, idx=None):
+        """
+        Mean and variance of mc_num Monte Carlo passes (or moment propagation if mc_num is None) of normalized data (or
+        data at idx) in a single padded pass
+        """
+        total_test_num = input_array['input'].shape[0] if idx is None else len(idx)
+        # Data Generator for prediction, the last batch is padded so every batch has the same shape
+        prediction_generator = BayesianCNNPredDataGenerator(batch_size=self.batch_size,
+                                                            shuffle=False,
+                                                            steps_per_epoch=int(np.ceil(total_test_num /
+                                                                                        self.batch_size)),
+                                                            data=[input_array],
+                                                            pad_last=True,
+                                                            idx=idx)
+
+        result = np.asarray(self._run_pipeline(self._fast_mc_model(mc_num).predict, prediction_generator))
+
+        # in case only 1 test data point, in such case we need to add a dimension
+        if result.ndim < 3 and self.batch_size == 1:
+            result = np.expand_dims(result, axis=0)
+        return result[:total_test_num]
+
+    def _adaptive_mc_predict(self, input_array):
+        """
+        Monte Carlo passes in rounds until standard error of the mean of every output of a data is below mc_tol or
+        mc_num passes are done, only unconverged data are inferred in the next round
+
+        :return: mean and variance like _mc_predict and number of Monte Carlo passes of each data
+        """
+        total_test_num = input_array['input'].shape[0]
+        round_num = min(self.mc_chunk_size or 10, self.mc_num)
+        mc_num_used = np.zeros(total_test_num, dtype=int)
+        mean, m2 = None, None
+        active = np.arange(total_test_num)
+
+        while active.size > 0:
+            # every unconverged data has done the same number of passes
+            n = min(round_num, self.mc_num - mc_num_used[active[0]])
+            result = self._mc_predict(input_array, n, idx=active)
+            if mean is None:
+                mean, m2 = np.zeros(result.shape[:-1]), np.zeros(result.shape[:-1])
+            # merge mean and variance of this round with Welford's algorithm
+            count = mc_num_used[active, np.newaxis].astype(float)
+            delta = result[..., 0] - mean[active]
+            mean[active] += delta * (n / (count + n))
+            m2[active] += result[..., 1] * n + delta ** 2 * (count * n / (count + n))
+            mc_num_used[active] += n
+
+            std_err = np.sqrt(m2[active]) / mc_num_used[active, np.newaxis]
+            active = active[(np.max(std_err, axis=1) >= self.mc_tol) & (mc_num_used[active] < self.mc_num)]
+            print(f'{total_test_num - active.size} of {total_test_num} data done after '
+                  f'{np.max(mc_num_used)} forward passes')
+
+        return np.stack((mean, m2 / mc_num_used[:, np.newaxis]), axis=-1), mc_num_used
 
     def evaluate(self, input_data, labels, inputs_err=None, labels_err=None):
         """
@@ -646,7 +763,11 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
         self.has_model_check()
 
         if inputs_err is None:
-            inputs_err = np.zeros_like(input_data)
+            if isinstance(input_data, np.ndarray):
+                inputs_err = np.zeros_like(input_data)
+            else:  # out-of-core input data, do not allocate zeros of the same size in memory
+                inputs_err = np.broadcast_to(np.zeros((1,) + input_data.shape[1:], dtype=np.float32),
+                                             input_data.shape)
 
         if labels_err is None:
             labels_err = np.zeros_like(labels)
@@ -687,7 +808,7 @@ class BayesianCNNBase(NeuralNetMaster, ABC):
                                                       data=[norm_data,
                                                             norm_labels])
 
-        scores = self.keras_model.evaluate(evaluate_generator)
+        scores = self._run_pipeline(self.keras_model.evaluate, evaluate_generator)
         if isinstance(scores, float):  # make sure scores is iterable
             scores = list(str(scores))
         outputname = self.keras_model.output_names
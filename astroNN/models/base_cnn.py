@@ -15,6 +15,7 @@ from astroNN.nn.metrics import categorical_accuracy, binary_accuracy
 from astroNN.nn.utilities import Normalizer
 from astroNN.nn.utilities.generator import GeneratorMaster
 from astroNN.shared.dict_tools import dict_np_to_dict_list, list_to_dict
+from astroNN.shared.result_cache import cached_result
 from sklearn.model_selection import train_test_split
 
 regularizers = tfk.regularizers
@@ -34,19 +35,21 @@ class CNNDataGenerator(GeneratorMaster):
     :type data: list
     :param manual_reset: Whether need to reset the generator manually, usually it is handled by tensorflow
     :type manual_reset: bool
+    :param idx: Indices of data to generate from, None to use all data
+    :type idx: Union[NoneType, ndarray]
     :History:
         | 2017-Dec-02 - Written - Henry Leung (University of Toronto)
         | 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
     """
 
-    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset=False):
+    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset=False, idx=None):
         super().__init__(batch_size=batch_size, shuffle=shuffle, steps_per_epoch=steps_per_epoch, data=data,
-                         manual_reset=manual_reset)
+                         manual_reset=manual_reset, idx=idx)
         self.inputs = self.data[0]
         self.labels = self.data[1]
 
         # initial idx
-        self.idx_list = self._get_exploration_order(range(self.inputs['input'].shape[0]))
+        self.idx_list = self._get_exploration_order(self._data_idx(self.inputs['input'].shape[0]))
 
     def _data_generation(self, inputs, labels, idx_list_temp):
         x = self.input_d_checking(inputs, idx_list_temp)
@@ -55,15 +58,16 @@ class CNNDataGenerator(GeneratorMaster):
             y.update({name: labels[name][idx_list_temp]})
         return x, y
 
+    def _get_batch(self, idx_list_temp):
+        return self._data_generation(self.inputs, self.labels, idx_list_temp)
+
     def __getitem__(self, index):
-        x, y = self._data_generation(self.inputs,
-                                     self.labels,
-                                     self.idx_list[index * self.batch_size: (index + 1) * self.batch_size])
+        x, y = self._prefetched_batch(index)
         return x, y
 
     def on_epoch_end(self):
         # shuffle the list when epoch ends for the next epoch
-        self.idx_list = self._get_exploration_order(range(self.inputs['input'].shape[0]))
+        self.idx_list = self._get_exploration_order(self._data_idx(self.inputs['input'].shape[0]))
 
 
 class CNNPredDataGenerator(GeneratorMaster):
@@ -78,14 +82,16 @@ class CNNPredDataGenerator(GeneratorMaster):
     :type data: list
     :param manual_reset: Whether need to reset the generator manually, usually it is handled by tensorflow
     :type manual_reset: bool
+    :param pad_last: Whether to pad the last batch to batch_size by repeating its last data
+    :type pad_last: bool
     :History:
         | 2017-Dec-02 - Written - Henry Leung (University of Toronto)
         | 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
     """
 
-    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset=False):
+    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset=False, pad_last=False):
         super().__init__(batch_size=batch_size, shuffle=shuffle, steps_per_epoch=steps_per_epoch, data=data,
-                         manual_reset=manual_reset)
+                         manual_reset=manual_reset, pad_last=pad_last)
         self.inputs = self.data[0]
 
         # initial idx
@@ -96,8 +102,11 @@ class CNNPredDataGenerator(GeneratorMaster):
         x = self.input_d_checking(inputs, idx_list_temp)
         return x
 
+    def _get_batch(self, idx_list_temp):
+        return self._data_generation(self.inputs, idx_list_temp)
+
     def __getitem__(self, index):
-        x = self._data_generation(self.inputs, self.idx_list[index * self.batch_size: (index + 1) * self.batch_size])
+        x = self._prefetched_batch(index)
         return x
 
     def on_epoch_end(self):
@@ -201,44 +210,44 @@ class CNNBase(NeuralNetMaster, ABC):
         if self.input_normalizer is None:
             self.input_normalizer = Normalizer(mode=self.input_norm_mode)
             self.labels_normalizer = Normalizer(mode=self.labels_norm_mode)
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self._normalize_inputs(input_data)
             self.input_mean, self.input_std = self.input_normalizer.mean_labels, self.input_normalizer.std_labels
             norm_labels = self.labels_normalizer.normalize(labels)
             self.labels_mean, self.labels_std = self.labels_normalizer.mean_labels, self.labels_normalizer.std_labels
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
+            norm_data = self._normalize_inputs(input_data, calc=False)
             norm_labels = self.labels_normalizer.normalize(labels, calc=False)
         if self.keras_model is None:  # only compile if there is no keras_model, e.g. fine-tuning does not required
             self.compile()
 
         self.train_idx, self.val_idx = train_test_split(np.arange(self.num_train + self.val_num),
                                                         test_size=self.val_size)
+        out_of_core = self._out_of_core(norm_data)
+        if out_of_core:
+            # read out-of-core data in the order on disk
+            self.train_idx, self.val_idx = np.sort(self.train_idx), np.sort(self.val_idx)
 
-        norm_data_training = {}
-        norm_data_val = {}
-        norm_labels_training = {}
-        norm_labels_val = {}
-        for name in norm_data.keys():
-            norm_data_training.update({name: norm_data[name][self.train_idx]})
-            norm_data_val.update({name: norm_data[name][self.val_idx]})
-        for name in norm_labels.keys():
-            norm_labels_training.update({name: norm_labels[name][self.train_idx]})
-            norm_labels_val.update({name: norm_labels[name][self.val_idx]})
-
+        # generators take the whole data with indices of the split, so the split is not copied from data
         self.training_generator = CNNDataGenerator(
             batch_size=self.batch_size,
             shuffle=True,
             steps_per_epoch=self.num_train // self.batch_size,
-            data=[norm_data_training, norm_labels_training],
-            manual_reset=False)
+            data=[norm_data, norm_labels],
+            manual_reset=False,
+            idx=self.train_idx)
 
         val_batchsize = self.batch_size if len(self.val_idx) > self.batch_size else len(self.val_idx)
         self.validation_generator = CNNDataGenerator(
             batch_size=val_batchsize,
             shuffle=False,
             steps_per_epoch=max(self.val_num // self.batch_size, 1),
-            data=[norm_data_val, norm_labels_val],
-            manual_reset=True)
+            data=[norm_data, norm_labels],
+            manual_reset=True,
+            idx=self.val_idx)
+
+        if out_of_core:
+            self._setup_out_of_core_generator(self.training_generator, norm_data)
+            self._setup_out_of_core_generator(self.validation_generator, norm_data)
 
         return input_data, labels
 
@@ -277,12 +286,20 @@ class CNNBase(NeuralNetMaster, ABC):
 
         start_time = time.time()
 
-        self.history = self.keras_model.fit(x=self.training_generator,
-                                            validation_data=self.validation_generator,
-                                            epochs=self.max_epochs, verbose=self.verbose,
-                                            workers=os.cpu_count(),
-                                            callbacks=self.__callbacks,
-                                            use_multiprocessing=MULTIPROCESS_FLAG)
+        try:
+            self.history = self.keras_model.fit(x=self._data_pipeline(self.training_generator),
+                                                validation_data=self._data_pipeline(self.validation_generator),
+                                                epochs=self.max_epochs, verbose=self.verbose,
+                                                workers=self.training_generator.workers,
+                                                max_queue_size=self.training_generator.max_queue_size,
+                                                callbacks=self.__callbacks,
+                                                # generator worker processes cannot start in tensorflow workers
+                                                use_multiprocessing=MULTIPROCESS_FLAG and self.n_workers == 0,
+                                                # generators shuffle data, request batches in order to read ahead
+                                                shuffle=False)
+        finally:
+            self.training_generator.close()
+            self.validation_generator.close()
 
         print(f'Completed Training, {(time.time() - start_time):.{2}f}s in total')
 
@@ -331,7 +348,8 @@ class CNNBase(NeuralNetMaster, ABC):
         scores = self.keras_model.fit(x=fit_generator,
                                       epochs=1,
                                       verbose=self.verbose,
-                                      workers=os.cpu_count(),
+                                      workers=fit_generator.workers,
+                                      max_queue_size=fit_generator.max_queue_size,
                                       use_multiprocessing=MULTIPROCESS_FLAG)
 
         print(f'Completed Training on Batch, {(time.time() - start_time):.{2}f}s in total')
@@ -375,6 +393,7 @@ class CNNBase(NeuralNetMaster, ABC):
         with open(self.fullfilepath + '/astroNN_model_parameter.json', 'w') as f:
             json.dump(data, f, indent=4, sort_keys=True)
 
+    @cached_result
     def test(self, input_data):
         """
         Use the neural network to do inference
@@ -388,43 +407,23 @@ class CNNBase(NeuralNetMaster, ABC):
         self.has_model_check()
         input_data = self.pre_testing_checklist_master(input_data)
 
-        input_array = self.input_normalizer.normalize(input_data, calc=False)
+        input_array = self._normalize_inputs(input_data, calc=False, inplace_names=[])
         total_test_num = input_data['input'].shape[0]  # Number of testing data
 
-        # for number of training data smaller than batch_size
-        if total_test_num < self.batch_size:
-            self.batch_size = total_test_num
-
-        # Due to the nature of how generator works, no overlapped prediction
-        data_gen_shape = (total_test_num // self.batch_size) * self.batch_size
-        remainder_shape = total_test_num - data_gen_shape  # Remainder from generator
-
         # TODO: named output????
         predictions = np.zeros((total_test_num, self._labels_shape['output']))
 
-        norm_data_main = {}
-        norm_data_remainder = {}
-        for name in input_array.keys():
-            norm_data_main.update({name: input_array[name][:data_gen_shape]})
-            norm_data_remainder.update({name: input_array[name][data_gen_shape:]})
-
         start_time = time.time()
         print("Starting Inference")
 
-        # Data Generator for prediction
+        # Data Generator for prediction, the last batch is padded so every batch has the same shape
         prediction_generator = CNNPredDataGenerator(batch_size=self.batch_size,
                                                     shuffle=False,
-                                                    steps_per_epoch=total_test_num // self.batch_size,
-                                                    data=[norm_data_main])
-        predictions[:data_gen_shape] = np.asarray(self.keras_model.predict(prediction_generator))
-
-        if remainder_shape != 0:
-            # assume its caused by mono images, so need to expand dim by 1
-            for name in input_array.keys():
-                if len(norm_data_remainder[name][0].shape) != len(self._input_shape[name]):
-                    norm_data_remainder.update({name: np.expand_dims(norm_data_remainder[name], axis=-1)})
-            result = self.keras_model.predict(norm_data_remainder)
-            predictions[data_gen_shape:] = result.reshape((remainder_shape, self._labels_shape['output']))
+                                                    steps_per_epoch=int(np.ceil(total_test_num / self.batch_size)),
+                                                    data=[input_array],
+                                                    pad_last=True)
+        result = np.asarray(self._run_pipeline(self.keras_model.predict, prediction_generator))
+        predictions[:] = result[:total_test_num].reshape((total_test_num, self._labels_shape['output']))
 
         if self.labels_normalizer is not None:
             predictions = self.labels_normalizer.denormalize(list_to_dict(self.keras_model.output_names, predictions))
@@ -477,7 +476,7 @@ class CNNBase(NeuralNetMaster, ABC):
                                               steps_per_epoch=steps,
                                               data=[norm_data, norm_labels])
 
-        scores = self.keras_model.evaluate(evaluate_generator)
+        scores = self._run_pipeline(self.keras_model.evaluate, evaluate_generator)
         if isinstance(scores, float):  # make sure scores is iterable
             scores = list(str(scores))
         outputname = self.keras_model.output_names
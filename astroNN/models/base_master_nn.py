@@ -18,11 +18,48 @@ from astroNN.config import _astroNN_MODEL_NAME
 from astroNN.config import cpu_gpu_check
 from astroNN.shared.custom_warnings import deprecated
 from astroNN.shared.nn_tools import folder_runnum
-from astroNN.shared.dict_tools import dict_np_to_dict_list, list_to_dict
+from astroNN.shared.dict_tools import dict_np_to_dict_list, list_to_dict, to_iterable
+from astroNN.nn.layers import MCConcreteDropout, MCDropout, MCGaussianDropout
+from astroNN.nn.utilities.normalizer import NormalizedView
+from astroNN.shared.result_cache import cached_result
 
 epsilon, plot_model = tfk.backend.epsilon, tfk.utils.plot_model
 
 
+def _select_outputs(outputs, output_idx):
+    """
+    Select outputs by indices to calculate gradient of, None for all outputs
+    """
+    return outputs if output_idx is None else tf.gather(outputs, output_idx, axis=1)
+
+
+def _select_inputs(gradient, input_idx, output_rank=1):
+    """
+    Select gradient to flattened input of a data by indices, None for all inputs, output_rank is the number of output
+    dimensions of a data between the data axis and input dimensions of gradient
+    """
+    if input_idx is None:
+        return gradient
+    gradient = tf.reshape(gradient, tf.concat([tf.shape(gradient)[:1 + output_rank], [-1]], axis=0))
+    return tf.gather(gradient, input_idx, axis=1 + output_rank)
+
+
+def _stochastic(model):
+    """
+    Whether any layer of the model is Monte Carlo dropout so every call of the model gives a different output
+    """
+    return any(isinstance(layer, (MCDropout, MCGaussianDropout, MCConcreteDropout)) and not layer.disable_layer
+               for layer in model.submodules)
+
+
+def _unit_vector(x_batch, i):
+    """
+    Unit vector of the i-th element of flattened input of every data in a batch
+    """
+    unit = tf.reshape(tf.one_hot(i, tf.size(x_batch[0]), dtype=x_batch.dtype), tf.shape(x_batch)[1:])
+    return tf.broadcast_to(unit, tf.shape(x_batch))
+
+
 class NeuralNetMaster(ABC):
     """
     Top-level class for an astroNN neural network
@@ -95,11 +132,25 @@ class NeuralNetMaster(ABC):
         self.metrics = None
         self.callbacks = None
         self.__callbacks = None  # for internal default callbacks usage only
+        # tf.function of gradient calculation by method and selection of outputs and inputs, traced once and reused
+        self._gradient_functions = {}
 
         self.input_normalizer = None
         self.labels_normalizer = None
         self.training_generator = None
         self.validation_generator = None
+        self.data_pipeline = 'sequence'  # 'sequence' to feed data by tensorflow Sequence or 'tf.data' by tf.data
+        self.shuffle_seed = None  # random seed of shuffling data by 'tf.data' pipeline, None to be random
+        # number of worker processes to assemble batches for 'sequence' pipeline from data shared with them, 0 to use
+        # threads only
+        self.n_workers = 0
+        # number of random data to calculate input normalization if input data are out-of-core like H5DatasetView,
+        # None to calculate on all data chunk by chunk
+        self.normalizer_sample_size = None
+        # True to normalize in-memory float32 input data inplace to save memory, input data will be overwritten
+        self.inplace_normalization = False
+        # ResultCache (or True for the default one) to cache results of test(), jacobian() and hessian() on disk
+        self.result_cache = None
 
         self.input_norm_mode = None
         self.labels_norm_mode = None
@@ -144,6 +195,103 @@ class NeuralNetMaster(ABC):
         if self.has_model is False:
             raise AttributeError("No model found in this instance, the common problem is you did not train a model")
 
+    def _data_pipeline(self, generator):
+        """
+        Data to be passed to tensorflow keras model, either the astroNN data generator itself (with ``n_workers``
+        worker processes) or its ``tf.data`` pipeline depending on ``data_pipeline``
+
+        :param generator: astroNN data generator
+        :type generator: astroNN.nn.utilities.generator.GeneratorMaster
+        :return: data for tensorflow keras model
+        :rtype: Union[astroNN.nn.utilities.generator.GeneratorMaster, tf.data.Dataset]
+        """
+        if self.data_pipeline == 'sequence':
+            generator.n_workers = self.n_workers
+            return generator
+        elif self.data_pipeline == 'tf.data':
+            return generator.tf_dataset(seed=self.shuffle_seed)
+        else:
+            raise ValueError(f'Unknown data_pipeline={self.data_pipeline}, only "sequence" and "tf.data" are supported')
+
+    def _run_pipeline(self, keras_func, generator):
+        """
+        Run tensorflow keras function like ``predict()`` on data of the generator, background thread or worker
+        processes of the generator are stopped and their shared memory is released even if it raises
+
+        :param keras_func: tensorflow keras function taking data as the first argument
+        :type keras_func: function
+        :param generator: astroNN data generator
+        :type generator: astroNN.nn.utilities.generator.GeneratorMaster
+        :return: result of keras_func
+        """
+        try:
+            return keras_func(self._data_pipeline(generator))
+        finally:
+            generator.close()
+
+    @staticmethod
+    def _out_of_core(data):
+        """
+        Whether any of named data is out-of-core (i.e. not a numpy array) like ``astroNN.datasets.H5DatasetView``
+        """
+        return any(not isinstance(data[name], np.ndarray) for name in data.keys())
+
+    def _normalize_inputs(self, input_data, calc=True, inplace_names=None):
+        """
+        | Normalize named input data by input normalizer
+        | In-memory input data are normalized inplace if ``inplace_normalization`` is True
+        | Out-of-core input data are normalized lazily by ``NormalizedView`` when batches are read, and normalization
+        | is calculated chunk by chunk by ``Normalizer.partial_fit()`` on all data or ``normalizer_sample_size``
+        | random data
+
+        :param input_data: named input data
+        :type input_data: dict
+        :param calc: whether to calculate normalization or use the existing one
+        :type calc: bool
+        :param inplace_names: names of input data can be normalized inplace, None for all
+        :type inplace_names: Union[NoneType, list]
+        :return: normalized input data
+        :rtype: dict
+        """
+        if not self._out_of_core(input_data):
+            inplace = self.inplace_normalization and (list(input_data.keys()) if inplace_names is None else
+                                                      inplace_names)
+            return self.input_normalizer.normalize(input_data, calc=calc, inplace=inplace)
+
+        if calc is True:
+            num_data = input_data['input'].shape[0]
+            if self.normalizer_sample_size is None or self.normalizer_sample_size >= num_data:
+                sample_idx = np.arange(num_data)
+                contiguous = True
+            else:
+                sample_idx = np.sort(np.random.choice(num_data, self.normalizer_sample_size, replace=False))
+                contiguous = False
+            # read blocks of whole h5 chunks to bound memory usage
+            chunk_rows = getattr(getattr(input_data['input'], 'data', input_data['input']), 'chunk_rows', None) or 1
+            block_size = chunk_rows * max(1, 4096 // chunk_rows)
+            self.input_normalizer.reset()
+            for start in range(0, sample_idx.shape[0], block_size):
+                block_idx = sample_idx[start:start + block_size]
+                if contiguous:
+                    block_idx = slice(block_idx[0], block_idx[-1] + 1)
+                self.input_normalizer.partial_fit({name: np.asarray(input_data[name][block_idx])
+                                                   for name in input_data.keys()})
+        if self.input_normalizer._custom_norm_func is not None:
+            raise ValueError('Normalization with custom function is not supported for out-of-core input data')
+        return {name: NormalizedView(input_data[name], mean=self.input_normalizer.mean_labels[name],
+                                     std=self.input_normalizer.std_labels[name]) for name in input_data.keys()}
+
+    def _setup_out_of_core_generator(self, generator, data):
+        """
+        Setup generator to read out-of-core data efficiently, shuffle in blocks of chunks of h5 dataset and read
+        batches ahead in a background thread
+        """
+        generator.prefetch = 2
+        chunk_rows = getattr(getattr(data['input'], 'data', data['input']), 'chunk_rows', None)
+        if generator.shuffle is True and chunk_rows is not None:
+            generator.shuffle_block = chunk_rows
+            generator.on_epoch_end()  # exploration order of the first epoch with shuffle_block
+
     def custom_train_step(self, *args):
         raise NotImplementedError
 
@@ -234,9 +382,10 @@ class NeuralNetMaster(ABC):
 
     def pre_testing_checklist_master(self, input_data):
         if type(input_data) is not dict:
-            input_data = {self.input_names[0]: np.atleast_2d(input_data)}
-        else:
-            for name in input_data.keys():
+            input_data = {self.input_names[0]: input_data}
+        for name in input_data.keys():
+            # out-of-core data like astroNN.datasets.H5DatasetView are read batch by batch, not loaded here
+            if not hasattr(input_data[name], 'shape') or isinstance(input_data[name], (np.ndarray, np.generic)):
                 input_data.update({name: np.atleast_2d(input_data[name])})
         return input_data
 
@@ -338,7 +487,8 @@ class NeuralNetMaster(ABC):
                           UserWarning)
             pass
 
-    def hessian(self, x=None, mean_output=False, mc_num=1, denormalize=False):
+    @cached_result
+    def hessian(self, x=None, mean_output=False, mc_num=1, denormalize=False, batch_size=None):
         """
         | Calculate the hessian of output to input
         |
@@ -347,6 +497,8 @@ class NeuralNetMaster(ABC):
         |
         | The hessians can be all zeros and the common cause is you did not use any activation or
         | activation that is still too linear in some sense like ReLU.
+        |
+        | Full hessian scales as the square of input size, use hessian_diag() for large input like spectra
 
         :param x: Input Data
         :type x: ndarray
@@ -356,6 +508,8 @@ class NeuralNetMaster(ABC):
         :type mc_num: int
         :param denormalize: De-normalize diagonal part of Hessian
         :type denormalize: bool
+        :param batch_size: Number of data to calculate hessian at once, None to use batch_size of the neural network
+        :type batch_size: Union[NoneType, int]
         :return: An array of Hessian
         :rtype: ndarray
         :History: 2018-Jun-14 - Written - Henry Leung (University of Toronto)
@@ -365,28 +519,171 @@ class NeuralNetMaster(ABC):
         if x is None:
             raise ValueError('Please provide data to calculate the jacobian')
 
-        if mc_num < 1 or isinstance(mc_num, float):
-            raise ValueError('mc_num must be a positive integer')
+        def batch_hessian(model, x_batch):
+            with tf.GradientTape(watch_accessed_variables=False) as tape:
+                tape.watch(x_batch)
+                with tf.GradientTape(watch_accessed_variables=False) as dtape:
+                    dtape.watch(x_batch)
+                    temp = model(x_batch)
+                jacobian = dtape.batch_jacobian(temp, x_batch)
+            return tape.batch_jacobian(jacobian, x_batch)
 
-        if self.input_normalizer is not None:
-            x_data = self.input_normalizer.normalize({"input": x}, calc=False)
-            x_data = x_data['input']
-        else:
-            # Prevent shallow copy issue
-            x_data = np.array(x)
-            x_data -= self.input_mean
-            x_data /= self.input_std
+        start_time = time.time()
+
+        hessians_master = self._collect_gradient(
+            self._gradient_batches(x, batch_hessian, mc_num=mc_num, batch_size=batch_size, key=('hessian',)),
+            mean_output=mean_output,
+            denormalize=self._denormalize_hessian if denormalize else None)
+
+        if np.all(hessians_master == 0.):  # warn user about not so linear activation like ReLU will get all zeros
+            warnings.warn(
+                'The hessians is detected to be all zeros. The common cause is you did not use any activation or '
+                'activation that is still too linear in some sense like ReLU.', UserWarning)
+
+        print(f'Finished hessian calculation, {(time.time() - start_time):.{2}f} seconds elapsed')
+        return hessians_master
+
+    @cached_result
+    def hessian_diag(self, x=None, mean_output=False, mc_num=1, denormalize=False, n_samples=10, batch_size=None,
+                     out=None, outputs=None, inputs=None):
+        """
+        | Calculate the diagonal part of hessian of output to input with hessian-vector products
+        |
+        | Diagonal is estimated by Hutchinson's method with n_samples random Rademacher vectors v as the mean of
+        | v * (Hv), or calculated exactly with every unit vectors if n_samples is None which needs as many
+        | hessian-vector products as the input size. Hessian-vector products are calculated by forward-mode over
+        | reverse-mode differentiation of each output without jacobian, so memory only scales with input size
+        | instead of the number of outputs times input size for jacobian or its square for full hessian.
+        |
+        | Please notice that the de-normalize (if True) assumes the output depends on the input data first orderly
+        | in which the hessians does not depends on input scaling and only depends on output scaling
+
+        :param x: Input Data
+        :type x: ndarray
+        :param mean_output: False to get all hessian diagonal, True to get the mean
+        :type mean_output: boolean
+        :param mc_num: Number of monte carlo integration
+        :type mc_num: int
+        :param denormalize: De-normalize Hessian diagonal
+        :type denormalize: bool
+        :param n_samples: Number of random vectors of Hutchinson's method, None to calculate the diagonal exactly
+        :type n_samples: Union[NoneType, int]
+        :param batch_size: Number of data to calculate at once, None to use batch_size of the neural network
+        :type batch_size: Union[NoneType, int]
+        :param out: Array to write hessian diagonal of all data to if mean_output=False, None to allocate a new array
+        :type out: Union[NoneType, ndarray]
+        :param outputs: Indices or names in targetname of outputs to calculate, None for all outputs
+        :type outputs: Union[NoneType, int, str, list]
+        :param inputs: Indices or boolean mask of flattened input of a data to calculate, None for all inputs
+        :type inputs: Union[NoneType, ndarray]
+        :return: An array of Hessian diagonal with the same shape as jacobian
+        :rtype: ndarray
+        """
+        self.has_model_check()
+
+        if x is None:
+            raise ValueError('Please provide data to calculate the hessian')
+
+        if n_samples is not None and (n_samples < 1 or isinstance(n_samples, float)):
+            raise ValueError('n_samples must be a positive integer or None')
+
+        output_idx, input_idx = self._output_idx(outputs), self._input_idx(inputs)
+
+        def hessian_vector_product(model, x_batch, v):
+            # forward-over-backward, hessian-vector product is the jvp of gradient of each output so jacobian of all
+            # outputs is never calculated, gradient of the sum over data is the gradient of every data
+            num_outputs = int(np.prod(model.output_shape[1:])) if output_idx is None else len(output_idx)
+            with tf.autodiff.ForwardAccumulator(x_batch, v) as acc:
+                with tf.GradientTape(persistent=True, watch_accessed_variables=False) as tape:
+                    tape.watch(x_batch)
+                    temp = tf.reshape(_select_outputs(model(x_batch), output_idx), [tf.shape(x_batch)[0], -1])
+                    temp = [temp[:, i] for i in range(num_outputs)]
+                gradients = [tape.gradient(output, x_batch, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+                             for output in temp]
+            del tape
+            return tf.stack([acc.jvp(gradient, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+                             for gradient in gradients], axis=1)
+
+        def probe(x_batch, i):
+            if n_samples is None:  # unit vector of the i-th (selected) input element of every data
+                return _unit_vector(x_batch, i if input_idx is None else tf.gather(input_idx, i))
+            else:  # Rademacher random vector, only on selected input elements
+                v = tf.cast(tf.random.uniform(tf.shape(x_batch), 0, 2, dtype=tf.int32) * 2 - 1, x_batch.dtype)
+                if input_idx is not None:
+                    v *= tf.reshape(tf.scatter_nd(input_idx[:, tf.newaxis], tf.ones(len(input_idx), x_batch.dtype),
+                                                  tf.size(x_batch[0])[tf.newaxis]), tf.shape(x_batch)[1:])
+                return v
+
+        def batch_hessian_diag(model, x_batch):
+            if n_samples is not None:
+                num_probes = n_samples
+            else:
+                num_probes = tf.size(x_batch[0]) if input_idx is None else len(input_idx)
+            v = probe(x_batch, 0)
+            diag = hessian_vector_product(model, x_batch, v) * tf.expand_dims(v, 1)
+            for i in tf.range(1, num_probes):
+                v = probe(x_batch, i)
+                diag += hessian_vector_product(model, x_batch, v) * tf.expand_dims(v, 1)
+            return _select_inputs(diag if n_samples is None else diag / n_samples, input_idx)
+
+        start_time = time.time()
+
+        hessians_master = self._collect_gradient(
+            self._gradient_batches(x, batch_hessian_diag, mc_num=mc_num, batch_size=batch_size,
+                                   key=('hessian_diag', n_samples) + self._selection_key(output_idx, input_idx)),
+            mean_output=mean_output, out=out,
+            denormalize=(lambda hessian: self._denormalize_hessian(hessian, output_idx)) if denormalize else None)
+
+        print(f'Finished hessian diagonal calculation, {(time.time() - start_time):.{2}f} seconds elapsed')
+        return hessians_master
+
+    def _output_idx(self, outputs):
+        """
+        Indices of outputs from indices or names in targetname, None for all outputs
+        """
+        if outputs is None:
+            return None
+        return [self.targetname.index(output) if isinstance(output, str) else output
+                for output in to_iterable(outputs)]
+
+    @staticmethod
+    def _input_idx(inputs):
+        """
+        Indices of flattened input of a data from indices or boolean mask, None for all inputs
+        """
+        if inputs is None:
+            return None
+        inputs = np.asarray(inputs)
+        return np.flatnonzero(inputs) if inputs.dtype == bool else inputs.astype(np.int64).ravel()
+
+    @staticmethod
+    def _selection_key(output_idx, input_idx):
+        """
+        Hashable key of selected outputs and inputs
+        """
+        return (None if output_idx is None else tuple(output_idx),
+                None if input_idx is None else (len(input_idx), input_idx.tobytes()))
+
+    def _result_cache_identity(self):
+        """
+        Everything of the neural network its results depend on to identify cached results
+        """
+        self.has_model_check()
+        return (self.__class__.__name__, self.keras_model.get_weights(), self.input_mean, self.input_std,
+                self.labels_mean, self.labels_std, self.targetname, self.task)
 
-        _model = None
+    def _gradient_model(self):
+        """
+        Prediction model and its input shape expectation to calculate gradient of output to input
+
+        :return: model and input shape expectation
+        :rtype: tuple
+        """
         try:
-            input_tens = self.keras_model_predict.get_layer("input").input
-            output_tens = self.keras_model_predict.get_layer("output").output
             input_shape_expectation = self.keras_model_predict.get_layer("input").input_shape
             output_shape_expectation = self.keras_model_predict.get_layer("output").output_shape
             _model = self.keras_model_predict
         except AttributeError:
-            input_tens = self.keras_model.get_layer("input").input
-            output_tens = self.keras_model.get_layer("output").output
             input_shape_expectation = self.keras_model.get_layer("input").input_shape
             output_shape_expectation = self.keras_model.get_layer("output").output_shape
             _model = self.keras_model
@@ -396,72 +693,114 @@ class NeuralNetMaster(ABC):
 
         if len(input_shape_expectation) == 1:
             input_shape_expectation = input_shape_expectation[0]
-
-        # just in case only 1 data point is provided and mess up the shape issue
-        if len(input_shape_expectation) == 3:
-            x_data = np.atleast_3d(x_data)
-        elif len(input_shape_expectation) == 4:
-            if len(x_data.shape) < 4:
-                x_data = x_data[:, :, :, np.newaxis]
-        else:
+        if len(input_shape_expectation) not in [3, 4]:
             raise ValueError('Input data shape do not match neural network expectation')
 
-        total_num = x_data.shape[0]
-
         input_dim = len(np.squeeze(np.ones(input_shape_expectation[1:])).shape)
         output_dim = len(np.squeeze(np.ones(output_shape_expectation[1:])).shape)
         if input_dim > 3 or output_dim > 3:
             raise ValueError("Unsupported data dimension")
 
-        xtensor = tf.Variable(x_data)
-
-        with tf.GradientTape(watch_accessed_variables=False) as tape:
-            tape.watch(xtensor)
-            with tf.GradientTape() as dtape:
-                dtape.watch(xtensor)
-                temp = _model(xtensor)
-            jacobian = tf.squeeze(dtape.batch_jacobian(temp, xtensor))
+        return _model, input_shape_expectation
 
-        start_time = time.time()
+    def _gradient_batches(self, x, gradient_func, mc_num=1, batch_size=None, key=None):
+        """
+        Normalize data and calculate gradient of output to input batch by batch, averaged over mc_num Monte Carlo
 
-        hessian = tf.squeeze(tape.batch_jacobian(jacobian, xtensor))
+        :param x: Input Data
+        :type x: ndarray
+        :param gradient_func: function of (model, normalized batch of data) to calculate gradient of a batch
+        :type gradient_func: function
+        :param mc_num: Number of monte carlo integration
+        :type mc_num: int
+        :param batch_size: Number of data to calculate at once, None to use batch_size of the neural network
+        :type batch_size: Union[NoneType, int]
+        :param key: key of gradient_func with everything it depends on, to reuse its tf.function across calls
+        :type key: Union[NoneType, tuple]
+        :return: generator of (start index, end index, number of data, gradient of the batch as ndarray)
+        :rtype: generator
+        """
+        if mc_num < 1 or isinstance(mc_num, float):
+            raise ValueError('mc_num must be a positive integer')
 
-        if np.all(hessian == 0.):  # warn user about not so linear activation like ReLU will get all zeros
-            warnings.warn(
-                'The hessians is detected to be all zeros. The common cause is you did not use any activation or '
-                'activation that is still too linear in some sense like ReLU.', UserWarning)
+        _model, input_shape_expectation = self._gradient_model()
+        batch_size = self.batch_size if batch_size is None else batch_size
 
-        if mean_output is True:
-            hessians_master = tf.reduce_mean(hessian, axis=0).numpy()
+        # just in case only 1 data point is provided and mess up the shape issue
+        if np.ndim(x) < len(input_shape_expectation) - 1:
+            x = np.expand_dims(x, 0)
+        total_num = x.shape[0]
+        batch_size = min(batch_size, total_num)
+
+        # traced once for all batches because the last batch is padded, and only once for all calls of the same key
+        if key is None:
+            gradient_func = tf.function(gradient_func)
         else:
-            hessians_master = hessian.numpy()
-
-        if denormalize:  # no need to denorm input scaling because of we assume first order dependence
-            if self.labels_std is not None:
-                try:
-                    hessians_master = hessians_master * self.labels_std
-                except ValueError:
-                    hessians_master = hessians_master * self.labels_std.reshape(-1, 1)
+            if key not in self._gradient_functions:
+                self._gradient_functions[key] = tf.function(gradient_func)
+            gradient_func = self._gradient_functions[key]
+
+        for start in range(0, total_num, batch_size):
+            end = min(start + batch_size, total_num)
+            if self.input_normalizer is not None:
+                x_data = self.input_normalizer.normalize({"input": x[start:end]}, calc=False)
+                x_data = x_data['input']
+            else:
+                # Prevent shallow copy issue
+                x_data = np.array(x[start:end])
+                x_data -= self.input_mean
+                x_data /= self.input_std
+
+            if len(input_shape_expectation) == 3:
+                x_data = np.atleast_3d(x_data)
+            elif len(x_data.shape) < 4:
+                x_data = x_data[:, :, :, np.newaxis]
+            if end - start < batch_size:
+                x_data = np.pad(x_data, [(0, batch_size - (end - start))] + [(0, 0)] * (x_data.ndim - 1), mode='edge')
 
-        print(f'Finished hessian calculation, {(time.time() - start_time):.{2}f} seconds elapsed')
-        return hessians_master
+            xtensor = tf.constant(x_data)
+            gradient = gradient_func(_model, xtensor).numpy()
+            for i in range(mc_num - 1):
+                gradient += gradient_func(_model, xtensor).numpy()
+            if mc_num > 1:
+                gradient /= mc_num
 
+            yield start, end, total_num, gradient[:end - start]
 
-    def jacobian(self, x=None, mean_output=False, mc_num=1, denormalize=False):
+    @cached_result
+    def jacobian(self, x=None, mean_output=False, mc_num=1, denormalize=False, batch_size=None, out=None,
+                 outputs=None, inputs=None):
         """
         | Calculate jacobian of gradient of output to input high performance calculation update on 15 April 2018
         |
         | Please notice that the de-normalize (if True) assumes the output depends on the input data first orderly
         | in which the equation is simply jacobian divided the input scaling, usually a good approx. if you use ReLU all the way
+        |
+        | Jacobian is calculated batch by batch so memory only scales with batch_size, jacobian can be written to a
+        | preallocated array or numpy.memmap by out if it is too large to be in memory
+        |
+        | Jacobian can be restricted to some outputs and some input elements (e.g. pixels in ASPCAP windows by
+        | ``astroNN.apogee.aspcap_mask``). Forward-mode differentiation is used if fewer inputs than outputs are
+        | selected, otherwise reverse-mode differentiation. Forward-mode needs a forward pass for every input, so
+        | reverse-mode differentiation is always used for models with Monte Carlo dropout to have the jacobian of a
+        | data from a single dropout mask
 
         :param x: Input Data
         :type x: ndarray
         :param mean_output: False to get all jacobian, True to get the mean
         :type mean_output: boolean
-        :param mc_num: Number of monte carlo integration
+        :param mc_num: Number of monte carlo integration, jacobian of each data is averaged over mc_num forward passes
         :type mc_num: int
         :param denormalize: De-normalize Jacobian
         :type denormalize: bool
+        :param batch_size: Number of data to calculate jacobian at once, None to use batch_size of the neural network
+        :type batch_size: Union[NoneType, int]
+        :param out: Array to write jacobian of all data to if mean_output=False, None to allocate a new array
+        :type out: Union[NoneType, ndarray]
+        :param outputs: Indices or names in targetname of outputs to calculate, None for all outputs
+        :type outputs: Union[NoneType, int, str, list]
+        :param inputs: Indices or boolean mask of flattened input of a data to calculate, None for all inputs
+        :type inputs: Union[NoneType, ndarray]
         :return: An array of Jacobian
         :rtype: ndarray
         :History:
@@ -472,83 +811,112 @@ class NeuralNetMaster(ABC):
         if x is None:
             raise ValueError('Please provide data to calculate the jacobian')
 
-        if mc_num < 1 or isinstance(mc_num, float):
-            raise ValueError('mc_num must be a positive integer')
-
-        if self.input_normalizer is not None:
-            x_data = self.input_normalizer.normalize({"input": x}, calc=False)
-            x_data = x_data['input']
-        else:
-            # Prevent shallow copy issue
-            x_data = np.array(x)
-            x_data -= self.input_mean
-            x_data /= self.input_std
-
-        _model = None
-        try:
-            input_tens = self.keras_model_predict.get_layer("input").input
-            output_tens = self.keras_model_predict.get_layer("output").output
-            input_shape_expectation = self.keras_model_predict.get_layer("input").input_shape
-            output_shape_expectation = self.keras_model_predict.get_layer("output").output_shape
-            _model = self.keras_model_predict
-        except AttributeError:
-            input_tens = self.keras_model.get_layer("input").input
-            output_tens = self.keras_model.get_layer("output").output
-            input_shape_expectation = self.keras_model.get_layer("input").input_shape
-            output_shape_expectation = self.keras_model.get_layer("output").output_shape
-            _model = self.keras_model
-        except ValueError:
-            raise ValueError("astroNN expects input layer is named as 'input' and output layer is named as 'output', "
-                             "but None is found.")
-
-        if len(input_shape_expectation) == 1:
-            input_shape_expectation = input_shape_expectation[0]
-
-        # just in case only 1 data point is provided and mess up the shape issue
-        if len(input_shape_expectation) == 3:
-            x_data = np.atleast_3d(x_data)
-        elif len(input_shape_expectation) == 4:
-            if len(x_data.shape) < 4:
-                x_data = x_data[:, :, :, np.newaxis]
-        else:
-            raise ValueError('Input data shape do not match neural network expectation')
+        output_idx, input_idx = self._output_idx(outputs), self._input_idx(inputs)
+        num_outputs = np.prod(self._gradient_model()[0].output_shape[1:]) if output_idx is None else len(output_idx)
+
+        def batch_jacobian(model, x_batch):
+            with tf.GradientTape(watch_accessed_variables=False) as tape:
+                tape.watch(x_batch)
+                temp = _select_outputs(model(x_batch), output_idx)
+            return _select_inputs(tape.batch_jacobian(temp, x_batch), input_idx, output_rank=len(temp.shape) - 1)
+
+        def batch_jacobian_forward(model, x_batch):
+            # one jacobian-vector product and so one forward pass for each selected input, only for deterministic model
+            columns = tf.TensorArray(x_batch.dtype, size=len(input_idx))
+            for i in tf.range(len(input_idx)):
+                with tf.autodiff.ForwardAccumulator(x_batch, _unit_vector(x_batch, tf.gather(input_idx, i))) as acc:
+                    temp = _select_outputs(model(x_batch), output_idx)
+                columns = columns.write(i, acc.jvp(temp))
+            columns = columns.stack()
+            return tf.transpose(columns, tf.concat([tf.range(1, tf.rank(columns)), [0]], axis=0))
 
-        total_num = x_data.shape[0]
+        start_time = time.time()
 
-        #TODO: move this to master??
-        input_dim = len(np.squeeze(np.ones(input_shape_expectation[1:])).shape)
-        output_dim = len(np.squeeze(np.ones(output_shape_expectation[1:])).shape)
-        if input_dim > 3 or output_dim > 3:
-            raise ValueError("Unsupported data dimension")
+        forward_mode = input_idx is not None and len(input_idx) < num_outputs and not _stochastic(
+            self._gradient_model()[0])
+        jacobian_master = self._collect_gradient(
+            self._gradient_batches(x, batch_jacobian_forward if forward_mode else batch_jacobian, mc_num=mc_num,
+                                   batch_size=batch_size,
+                                   key=('jacobian', forward_mode) + self._selection_key(output_idx, input_idx)),
+            mean_output=mean_output, out=out,
+            denormalize=(lambda jacobian: self._denormalize_jacobian(jacobian, output_idx, input_idx)) if denormalize
+            else None)
 
-        xtensor = tf.Variable(x_data)
+        print(f'Finished all gradient calculation, {(time.time() - start_time):.{2}f} seconds elapsed')
 
-        with tf.GradientTape(watch_accessed_variables=False) as tape:
-            tape.watch(xtensor)
-            temp = _model(xtensor)
+        return jacobian_master
 
-        start_time = time.time()
+    @staticmethod
+    def _collect_gradient(batches, mean_output=False, denormalize=None, out=None):
+        """
+        Collect gradient of batches from _gradient_batches to an array or take the mean
 
-        jacobian = tf.squeeze(tape.batch_jacobian(temp, xtensor))
+        :param batches: generator from _gradient_batches
+        :type batches: generator
+        :param mean_output: False to get gradient of all data, True to get the mean
+        :type mean_output: boolean
+        :param denormalize: function to de-normalize gradient of a batch, None to not de-normalize
+        :type denormalize: Union[NoneType, function]
+        :param out: Array to write gradient of all data to if mean_output=False, None to allocate a new array
+        :type out: Union[NoneType, ndarray]
+        :return: gradient
+        :rtype: ndarray
+        """
+        gradient_master = None
+        for start, end, total_num, gradient in batches:
+            # squeeze every dimension of size 1 except data
+            gradient = gradient.reshape((end - start,) + np.squeeze(np.ones(gradient.shape[1:])).shape)
+            if denormalize is not None:
+                gradient = denormalize(gradient)
+            if mean_output is True:
+                # running sum instead of holding gradient of all data
+                if gradient_master is None:
+                    gradient_master = np.zeros(gradient.shape[1:])
+                gradient_master += np.sum(gradient, axis=0)
+            else:
+                if out is None:
+                    out = np.zeros((total_num,) + gradient.shape[1:], dtype=gradient.dtype)
+                elif out.shape[1:] != gradient.shape[1:]:
+                    raise ValueError(f'out has shape {out.shape} but gradient of each data has shape '
+                                     f'{gradient.shape[1:]}')
+                out[start:end] = gradient
 
         if mean_output is True:
-            jacobian_master = tf.reduce_mean(jacobian, axis=0).numpy()
+            return (gradient_master / total_num).astype(np.float32)
         else:
-            jacobian_master = jacobian.numpy()
-
-        if denormalize:
-            if self.input_std is not None:
-                jacobian_master = jacobian_master / np.squeeze(self.input_std)
-
-            if self.labels_std is not None:
-                try:
-                    jacobian_master = jacobian_master * self.labels_std
-                except ValueError:
-                    jacobian_master = jacobian_master * self.labels_std.reshape(-1, 1)
-
-        print(f'Finished all gradient calculation, {(time.time() - start_time):.{2}f} seconds elapsed')
-
-        return jacobian_master
+            # squeezed if only 1 data point
+            return out if total_num > 1 else out[0]
+
+    def _denormalize_hessian(self, hessian, output_idx=None):
+        # no need to denorm input scaling because of we assume first order dependence
+        if self.labels_std is not None:
+            labels_std = self._labels_std_subset(output_idx)
+            try:
+                hessian = hessian * labels_std
+            except ValueError:
+                hessian = hessian * labels_std.reshape(-1, 1)
+        return hessian
+
+    def _denormalize_jacobian(self, jacobian, output_idx=None, input_idx=None):
+        if self.input_std is not None:
+            input_std = np.squeeze(self.input_std)
+            if input_idx is not None and input_std.ndim > 0:
+                input_std = input_std.ravel()[input_idx]
+            jacobian = jacobian / input_std
+
+        if self.labels_std is not None:
+            labels_std = self._labels_std_subset(output_idx)
+            try:
+                jacobian = jacobian * labels_std
+            except ValueError:
+                jacobian = jacobian * labels_std.reshape(-1, 1)
+        return jacobian
+
+    def _labels_std_subset(self, output_idx=None):
+        labels_std = np.asarray(self.labels_std)
+        if output_idx is not None and labels_std.ndim > 0 and labels_std.size > 1:
+            labels_std = labels_std[output_idx]
+        return labels_std
 
     def plot_dense_stats(self):
         """
@@ -431,13 +431,17 @@ class FastMCInference():
 
     :param n: Number of Monte Carlo integration
     :type n: int
+    :param chunk_size: Number of Monte Carlo integration to run at once with running mean and variance,
+                       None to run all at once
+    :type chunk_size: Union[NoneType, int]
     :return: A layer
     :rtype: object
     :History: 2018-Apr-13 - Written - Henry Leung (University of Toronto)
     """
 
-    def __init__(self, n, **kwargs):
+    def __init__(self, n, chunk_size=None, **kwargs):
         self.n = n
+        self.chunk_size = chunk_size
 
     def __call__(self, model):
         """
@@ -453,7 +457,10 @@ class FastMCInference():
         new_input = tfk.layers.Input(shape=(self.model.input_shape[1:]), name='input')
         mc_model = tfk.models.Model(inputs=self.model.inputs, outputs=self.model.outputs)
 
-        mc = FastMCInferenceMeanVar()(tfk.layers.TimeDistributed(mc_model)(FastMCRepeat(self.n)(new_input)))
+        if self.chunk_size is None or self.chunk_size >= self.n:
+            mc = FastMCInferenceMeanVar()(tfk.layers.TimeDistributed(mc_model)(FastMCRepeat(self.n)(new_input)))
+        else:
+            mc = FastMCChunkedMeanVar(mc_model, self.n, self.chunk_size)(new_input)
         new_mc_model = tfk.models.Model(inputs=new_input, outputs=mc)
 
         return new_mc_model
@@ -463,7 +470,7 @@ class FastMCInference():
         :return: Dictionary of configuration
         :rtype: dict
         """
-        config = {'n': self.n}
+        config = {'n': self.n, 'chunk_size': self.chunk_size}
         return config
 
 
@@ -554,6 +561,240 @@ class FastMCRepeat(Layer):
         return {**base_config.items(), **config}
 
 
+class FastMCChunkedMeanVar(Layer):
+    """
+    | Do Monte Carlo integration of a model in chunks and take mean and variance of the results
+    | Each chunk runs the model once on the input repeated chunk_size times along the batch axis, mean and variance are
+    | merged across chunks with Welford's algorithm so memory does not scale with the number of Monte Carlo integration
+
+    :param model: Keras model to do Monte Carlo integration with
+    :type model: Union[keras.Model, keras.Sequential]
+    :param n: Number of Monte Carlo integration
+    :type n: int
+    :param chunk_size: Number of Monte Carlo integration to run at once
+    :type chunk_size: int
+    :return: A layer
+    :rtype: object
+    """
+
+    def __init__(self, model, n, chunk_size, name=None, **kwargs):
+        self.model = model
+        self.n = n
+        self.chunk_size = min(chunk_size, n)
+        if not name:
+            prefix = self.__class__.__name__
+            name = prefix + '_' + str(tfk.backend.get_uid(prefix))
+        super().__init__(name=name, **kwargs)
+
+    def compute_output_shape(self, input_shape):
+        return self.model.compute_output_shape(input_shape) + (2,)
+
+    def _chunk_moments(self, inputs, n):
+        # repeat along batch axis so a chunk is one large call of the model with independent dropout on every row
+        outputs = self.model(tf.tile(inputs, tf.concat([[n], tf.ones_like(tf.shape(inputs))[1:]], axis=0)))
+        outputs = tf.reshape(outputs, tf.concat([[n, tf.shape(inputs)[0]], tf.shape(outputs)[1:]], axis=0))
+        mean, var = tf.nn.moments(outputs, axes=0)
+        return mean, var * n
+
+    @staticmethod
+    def _merge_moments(count, mean, m2, n, chunk_mean, chunk_m2):
+        total = count + n
+        delta = chunk_mean - mean
+        mean = mean + delta * (n / total)
+        m2 = m2 + chunk_m2 + tf.square(delta) * (count * n / total)
+        return total, mean, m2
+
+    def call(self, inputs, training=None):
+        """
+        :Note: Equivalent to __call__()
+        :param inputs: Tensor to be applied
+        :type inputs: tf.Tensor
+        :return: Tensor after applying the layer
+        :rtype: tf.Tensor
+        """
+        num_chunks, remainder = divmod(self.n, self.chunk_size)
+        mean, m2 = self._chunk_moments(inputs, self.chunk_size)
+        count = tf.constant(self.chunk_size, dtype=mean.dtype)
+
+        def body(i, count, mean, m2):
+            chunk_mean, chunk_m2 = self._chunk_moments(inputs, self.chunk_size)
+            return (i + 1,) + self._merge_moments(count, mean, m2, float(self.chunk_size), chunk_mean, chunk_m2)
+
+        _, count, mean, m2 = tf.while_loop(lambda i, *args: i < num_chunks, body, (tf.constant(1), count, mean, m2))
+        if remainder != 0:
+            chunk_mean, chunk_m2 = self._chunk_moments(inputs, remainder)
+            count, mean, m2 = self._merge_moments(count, mean, m2, float(remainder), chunk_mean, chunk_m2)
+
+        # same output as FastMCInferenceMeanVar
+        return tf.stack((tf.squeeze([mean]), tf.squeeze([m2 / count])), axis=-1)
+
+    def get_config(self):
+        """
+        :return: Dictionary of configuration
+        :rtype: dict
+        """
+        config = {'n': self.n, 'chunk_size': self.chunk_size}
+        base_config = super().get_config()
+        return {**dict(base_config.items()), **config}
+
+
+class MomentPropagation():
+    """
+    | Turn a model for deterministic approximate Monte Carlo (Dropout) Inference by moment propagation
+    | Mean and variance are propagated through the layers of the model in a single pass instead of Monte Carlo
+    | integration, using the variance of dropout and assuming every neurone is independent and normally distributed
+    | before non-linear activation. Only Dense, Conv1D, Activation, MaxPooling1D, MCDropout, MCGaussianDropout and layers
+    | only selecting or reshaping data like Flatten, Reshape, Concatenate and BoolMask are supported
+
+    :return: A layer
+    :rtype: object
+    """
+
+    def __call__(self, model):
+        """
+        :param model: Keras model to be accelerated
+        :type model: Union[keras.Model, keras.Sequential]
+        :return: Keras model with the same output as model accelerated by FastMCInference
+        :rtype: Union[keras.Model, keras.Sequential]
+        """
+        if isinstance(model, tfk.Model) or isinstance(model, tfk.Sequential):
+            self.model = model
+        else:
+            raise TypeError(f'MomentPropagation expects tensorflow.keras Model, you gave {type(model)}')
+        new_input = tfk.layers.Input(shape=(self.model.input_shape[1:]), name='input')
+        mc = MomentPropagationMeanVar(self.model)(new_input)
+        new_mc_model = tfk.models.Model(inputs=new_input, outputs=mc)
+
+        return new_mc_model
+
+    def get_config(self):
+        """
+        :return: Dictionary of configuration
+        :rtype: dict
+        """
+        config = {'None': None}
+        return config
+
+
+class MomentPropagationMeanVar(Layer):
+    """
+    Propagate mean and variance through the layers of a model, output has the same shape as FastMCInferenceMeanVar
+
+    :param model: Keras model to propagate mean and variance through
+    :type model: Union[keras.Model, keras.Sequential]
+    :return: A layer
+    :rtype: object
+    """
+
+    def __init__(self, model, name=None, **kwargs):
+        self.model = model
+        if not name:
+            prefix = self.__class__.__name__
+            name = prefix + '_' + str(tfk.backend.get_uid(prefix))
+        super().__init__(name=name, **kwargs)
+
+    def compute_output_shape(self, input_shape):
+        return self.model.compute_output_shape(input_shape) + (2,)
+
+    @staticmethod
+    def _activation_moments(activation, mean, var):
+        name = activations.serialize(activation)
+        if name == 'linear':
+            return mean, var
+        elif name == 'relu':
+            # mean and variance of rectified normal distribution
+            std = tf.sqrt(var + epsilon())
+            z = mean / std
+            cdf = 0.5 * (1. + tf.math.erf(z / math.sqrt(2.)))
+            pdf = tf.exp(-0.5 * tf.square(z)) / math.sqrt(2. * math.pi)
+            new_mean = mean * cdf + std * pdf
+            new_var = (tf.square(mean) + var) * cdf + mean * std * pdf - tf.square(new_mean)
+            return new_mean, tf.maximum(new_var, 0.)
+        elif name == 'softmax':
+            # first order approximation with diagonal of jacobian
+            new_mean = activation(mean)
+            return new_mean, tf.square(new_mean * (1. - new_mean)) * var
+        else:
+            # first order approximation of element-wise activation
+            with tf.GradientTape() as tape:
+                tape.watch(mean)
+                new_mean = activation(mean)
+            return new_mean, tf.square(tape.gradient(new_mean, mean)) * var
+
+    def _layer_moments(self, layer, mean, var):
+        if isinstance(layer, (tfk.layers.Flatten, tfk.layers.Reshape, tfk.layers.Concatenate, BoolMask)):
+            return layer(mean), layer(var)
+        elif isinstance(layer, MCDropout):
+            if layer.disable_layer is True:
+                return mean, var
+            # dropout scales kept neurones by 1 / (1 - rate)
+            return mean, (var + tf.square(mean)) / (1. - layer.rate) - tf.square(mean)
+        elif isinstance(layer, MCGaussianDropout):
+            if layer.disable_layer is True:
+                return mean, var
+            return mean, var + (var + tf.square(mean)) * (layer.rate / (1. - layer.rate))
+        elif isinstance(layer, tfk.layers.Activation):
+            return self._activation_moments(layer.activation, mean, var)
+        elif isinstance(layer, tfk.layers.Dense):
+            mean = tf.tensordot(mean, layer.kernel, axes=1)
+            var = tf.tensordot(var, tf.square(layer.kernel), axes=1)
+        elif isinstance(layer, tfk.layers.Conv1D) and layer.padding != 'causal' and \
+                layer.data_format == 'channels_last' and getattr(layer, 'groups', 1) == 1:
+            conv_kwargs = {'strides': layer.strides, 'padding': layer.padding.upper(),
+                           'dilations': layer.dilation_rate}
+            mean = tf.nn.convolution(mean, layer.kernel, **conv_kwargs)
+            var = tf.nn.convolution(var, tf.square(layer.kernel), **conv_kwargs)
+        elif isinstance(layer, tfk.layers.MaxPooling1D) and layer.padding == 'valid' and \
+                layer.data_format == 'channels_last' and layer.strides == layer.pool_size:
+            # moments of the neurone with the largest mean in each pool
+            pool_size = layer.pool_size[0]
+            num_pool = mean.shape[1] // pool_size
+            pool_shape = (-1, num_pool, pool_size, mean.shape[2])
+            mean = tf.reshape(mean[:, :num_pool * pool_size], pool_shape)
+            var = tf.reshape(var[:, :num_pool * pool_size], pool_shape)
+            largest = tf.one_hot(tf.argmax(mean, axis=2), pool_size, axis=2, dtype=mean.dtype)
+            return tf.reduce_sum(mean * largest, axis=2), tf.reduce_sum(var * largest, axis=2)
+        else:
+            raise TypeError(f'Moment propagation does not support layer {layer.name} of {type(layer).__name__}')
+
+        # Dense and Conv1D
+        if layer.use_bias:
+            mean = tf.nn.bias_add(mean, layer.bias)
+        return self._activation_moments(layer.activation, mean, var)
+
+    def call(self, inputs, training=None):
+        """
+        :Note: Equivalent to __call__()
+        :param inputs: Tensor to be applied
+        :type inputs: tf.Tensor
+        :return: Tensor after applying the layer
+        :rtype: tf.Tensor
+        """
+        # mean and variance of every tensor in the model by id, layers are in topological order
+        moments = {id(self.model.inputs[0]): (inputs, tf.zeros_like(inputs))}
+        for layer in self.model.layers:
+            if isinstance(layer, tfk.layers.InputLayer):
+                continue
+            layer_inputs = tf.nest.flatten(layer.input)
+            mean = [moments[id(tensor)][0] for tensor in layer_inputs]
+            var = [moments[id(tensor)][1] for tensor in layer_inputs]
+            mean, var = self._layer_moments(layer, mean if len(mean) > 1 else mean[0],
+                                            var if len(var) > 1 else var[0])
+            moments[id(layer.output)] = (mean, var)
+
+        mean, var = moments[id(self.model.outputs[0])]
+        return tf.stack((mean, var), axis=-1)
+
+    def get_config(self):
+        """
+        :return: Dictionary of configuration
+        :rtype: dict
+        """
+        config = {'None': None}
+        base_config = super().get_config()
+        return {**dict(base_config.items()), **config}
+
+
 class StopGrad(Layer):
     """
     Stop gradient backpropagation via this layer during training, act as an identity layer during testing by default.
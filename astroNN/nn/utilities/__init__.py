@@ -1 +1,2 @@
 from astroNN.nn.utilities.normalizer import Normalizer
+from astroNN.nn.utilities.normalizer import NormalizedView
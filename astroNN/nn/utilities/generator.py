@@ -1,31 +1,169 @@
+import itertools
+import multiprocessing
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    resource_tracker, shared_memory = None, None
+
 import numpy as np
 
+import tensorflow as tf
 import tensorflow.keras as tfk
 Sequence = tfk.utils.Sequence
 
+# generator in a worker process started by GeneratorMaster with n_workers > 0
+_worker_generator = None
+
+
+def _map_arrays(batch, func):
+    """
+    Apply func to every leaf of a batch, which is a nested structure of dict, list and tuple
+    """
+    if isinstance(batch, dict):
+        return {name: _map_arrays(value, func) for name, value in batch.items()}
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(_map_arrays(value, func) for value in batch)
+    else:
+        return func(batch)
+
+
+class _SharedArrayRef(object):
+    """
+    Reference to an array in a shared memory block, passed between processes instead of the array itself
+    """
+
+    def __init__(self, name, offset, shape, strides, dtype):
+        self.name = name
+        self.offset = offset
+        self.shape = shape
+        self.strides = strides
+        self.dtype = dtype
+
+
+def _attach_shared_memory(name):
+    """
+    Attach to an existing shared memory block which is kept track of by the process created it
+    """
+    try:
+        # Python 3.13 or above
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # worker processes share the resource tracker of the main process which keeps a set of names, so the block is
+        # registered again without effect, unregistering it here would also forget the registration of its creator
+        return shared_memory.SharedMemory(name=name)
+
+
+def _unlink_shared_memory(shm):
+    shm.close()
+    shm.unlink()
+
+
+def _init_worker(generator):
+    # generator is unpickled with numpy data attached from shared memory blocks of the main process
+    global _worker_generator
+    _worker_generator = generator
+    generator._shared_buffers = True
+
+
+def _worker_get_batch(idx_list_temp):
+    batch = _worker_generator._get_batch(idx_list_temp)
+    return _map_arrays(batch, _worker_generator._shared_array_ref)
+
 
 class GeneratorMaster(Sequence):
     """
     | Top-level class of astroNN data pipeline to generate data for NNs.
     | It is implemented based on Tensorflow data ``Sequence`` class.
 
-    You need to implement the ``__getitem__`` in the generator sub-class
+    You need to implement the ``_get_batch`` and ``__getitem__`` in the generator sub-class
 
     :History: 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
     """
 
-    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset):
+    def __init__(self, batch_size, shuffle, steps_per_epoch, data, manual_reset, idx=None, pad_last=False):
         self.batch_size = batch_size
         self.data = data
+        # indices of data to generate batches from, so a split like training set does not need to be copied from data
+        self.idx = idx
+        # pad the last incomplete batch by repeating its last data, so every batch has the same shape and a model is
+        # only traced once for inference of any number of data, padded results need to be trimmed
+        self.pad_last = pad_last
         self.shuffle = shuffle
         # see if it needs to be reset idx manually if on_epoch_end() cannot be reached like val_generator
         self.manual_reset = manual_reset
 
         self.steps_per_epoch = steps_per_epoch
 
+        # max_queue_size and workers of tensorflow fit() consuming this generator, they decide how many batches can
+        # be alive at once, see num_buffers
+        self.max_queue_size = 10
+        self.workers = os.cpu_count()
+        # number of batches to be read ahead by a background thread, useful if data are read from disk
+        self.prefetch = 0
+        # number of worker processes to assemble batches from data shared with this process instead of threads, numpy
+        # data are copied to shared memory once and batches are passed back in shared memory, workers are started by
+        # forkserver (or spawn) start method of multiprocessing
+        self.n_workers = 0
+        # shuffle blocks of this number of consecutive data instead of individual data, so a batch of out-of-core
+        # data only needs to read a few chunks from disk
+        self.shuffle_block = 1
+        # numpy data copied to shared memory blocks for worker processes by id of data, or attached in a worker
+        self._shared_data = {}
+        self._init_threading()
+
+    def _init_threading(self):
+        self._buffers = {}
+        self._buffer_counter = itertools.count()  # thread-safe
+        self._buffer_lock = threading.Lock()
+        self._prefetch_lock = threading.Lock()
+        self._executor = None
+        self._futures = {}
+        self._prefetch_idx_list = None
+        # shared memory blocks of batch buffers in a worker process or attached from workers, by name
+        self._shared_memory = {}
+        self._shared_buffers = False
+
+    def __getstate__(self):
+        # locks, threads and processes cannot be pickled, they are created again in the new process
+        state = self.__dict__.copy()
+        for name in ['_buffers', '_buffer_counter', '_buffer_lock', '_prefetch_lock', '_executor', '_futures',
+                     '_prefetch_idx_list', '_shared_memory', '_shared_buffers', '_shared_data']:
+            state.pop(name)
+        if self._shared_data:
+            # only references to numpy data in shared memory are pickled for worker processes
+            state = {name: _map_arrays(value, self._shared_data_ref) for name, value in state.items()}
+        return state
+
+    def __setstate__(self, state):
+        self._shared_data = {}
+        self.__dict__.update({name: _map_arrays(value, self._attach_shared_data) for name, value in state.items()})
+        self._init_threading()
+
     def __len__(self):
         return self.steps_per_epoch
 
+    @property
+    def num_buffers(self):
+        """
+        | Number of preallocated buffers in the ring batches are assembled into, a buffer is reused only after this
+        | number of batches. Batches alive at once are the ones queued by tensorflow (``max_queue_size``), the ones
+        | being assembled by its ``workers`` threads, the one being consumed by the model and the one being converted
+        | to tensors. In a worker process (``n_workers``), batches are copied out by the main process as soon as they
+        | are done, so fewer are alive than in the main process
+        """
+        return self.max_queue_size + self.workers + 2
+
+    def _data_idx(self, num_data):
+        """
+        Indices of data to generate batches from
+        """
+        return range(num_data) if self.idx is None else self.idx
+
     def _get_exploration_order(self, idx_list):
         """
         :param idx_list:
@@ -34,10 +172,194 @@ class GeneratorMaster(Sequence):
         # shuffle (if applicable) and find exploration order
         if self.shuffle is True:
             idx_list = np.copy(idx_list)
-            np.random.shuffle(idx_list)
+            if self.shuffle_block > 1:
+                blocks = np.random.permutation(int(np.ceil(idx_list.shape[0] / self.shuffle_block)))
+                idx_list = np.concatenate([idx_list[i * self.shuffle_block:(i + 1) * self.shuffle_block]
+                                           for i in blocks])
+            else:
+                np.random.shuffle(idx_list)
 
         return idx_list
 
+    def _batch_idx(self, index):
+        idx_list_temp = self.idx_list[index * self.batch_size: (index + 1) * self.batch_size]
+        if self.pad_last and len(idx_list_temp) < self.batch_size:
+            idx_list_temp = np.pad(np.asarray(idx_list_temp), (0, self.batch_size - len(idx_list_temp)), mode='edge')
+        return idx_list_temp
+
+    def _prefetched_batch(self, index):
+        """
+        | Batch ``index`` of the current epoch, read ahead by a background thread if ``prefetch`` is larger than 0 so
+        | reading data from disk overlaps with training
+        | If ``n_workers`` is larger than 0, batches are assembled and read ahead by worker processes instead
+        """
+        if self.n_workers > 0:
+            get_batch, prefetch = _worker_get_batch, max(self.prefetch, self.n_workers)
+        elif self.prefetch > 0:
+            get_batch, prefetch = self._get_batch, self.prefetch
+        else:
+            return self._get_batch(self._batch_idx(index))
+        with self._prefetch_lock:
+            if self._executor is None:
+                self._executor = self._start_executor()
+            if self._prefetch_idx_list is not self.idx_list:
+                # a new epoch with new exploration order, discard batches read ahead in the old order
+                self._futures = {}
+                self._prefetch_idx_list = self.idx_list
+            # indices of batches are sent to workers, so workers always follow the exploration order of this epoch
+            for i in range(index, min(index + prefetch + 1, len(self))):
+                if i not in self._futures:
+                    self._futures[i] = self._executor.submit(get_batch, self._batch_idx(i))
+            future = self._futures.pop(index) if index in self._futures else \
+                self._executor.submit(get_batch, self._batch_idx(index))
+        batch = future.result()
+        return _map_arrays(batch, self._shared_array) if self.n_workers > 0 else batch
+
+    def _start_executor(self):
+        if self.n_workers <= 0:
+            return ThreadPoolExecutor(max_workers=1)
+        if shared_memory is None:
+            raise RuntimeError('n_workers > 0 requires multiprocessing.shared_memory of Python 3.8 or above')
+        # workers share the resource tracker of this process which keeps track of shared memory blocks
+        resource_tracker.ensure_running()
+        self._share_data()
+        # worker processes are not forked from this process because tensorflow has started its threads
+        context = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(max_workers=self.n_workers, mp_context=multiprocessing.get_context(context),
+                                   initializer=_init_worker, initargs=(self,))
+
+    def _share_data(self):
+        """
+        Copy numpy data to shared memory blocks once, so worker processes attach to them instead of unpickling copies
+        """
+        def _share(array):
+            if isinstance(array, np.ndarray) and not array.dtype.hasobject and id(array) not in self._shared_data:
+                shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+                # unlinked by close(), or at exit if close() is never reached
+                self._shared_data[id(array)] = (_SharedArrayRef(shm.name, 0, array.shape, None, array.dtype),
+                                                weakref.finalize(self, _unlink_shared_memory, shm))
+            return array
+
+        _map_arrays(self.data, _share)
+
+    def _shared_data_ref(self, array):
+        if isinstance(array, np.ndarray) and id(array) in self._shared_data:
+            return self._shared_data[id(array)][0]
+        return array
+
+    def _attach_shared_data(self, ref):
+        """
+        Numpy data in a shared memory block of the main process, in a worker process
+        """
+        if not isinstance(ref, _SharedArrayRef):
+            return ref
+        if ref.name not in self._shared_data:
+            shm = _attach_shared_memory(ref.name)
+            self._shared_data[ref.name] = (shm, np.ndarray(ref.shape, dtype=ref.dtype, buffer=shm.buf))
+        return self._shared_data[ref.name][1]
+
+    def _shared_array_ref(self, array):
+        """
+        Reference to the array if it is in a shared memory block of batch buffers, otherwise the array itself
+        """
+        if isinstance(array, np.ndarray):
+            address = array.__array_interface__['data'][0]
+            for name, (shm, start) in self._shared_memory.items():
+                if start <= address < start + shm.size:
+                    return _SharedArrayRef(name, address - start, array.shape, array.strides, array.dtype)
+        return array
+
+    def _shared_array(self, ref):
+        """
+        Copy of the array referenced in a shared memory block of a worker, so the worker can reuse its buffer
+        """
+        if not isinstance(ref, _SharedArrayRef):
+            return ref
+        if ref.name not in self._shared_memory:
+            shm = _attach_shared_memory(ref.name)
+            self._shared_memory[ref.name] = (shm, None)
+        buffer = self._shared_memory[ref.name][0].buf
+        return np.array(np.ndarray(ref.shape, dtype=ref.dtype, buffer=buffer, offset=ref.offset, strides=ref.strides))
+
+    def close(self):
+        """
+        Stop background thread or worker processes reading ahead batches and release shared memory
+
+        """
+        with self._prefetch_lock:
+            try:
+                for future in self._futures.values():
+                    future.cancel()
+                if self._executor is not None:
+                    self._executor.shutdown(wait=True)
+            finally:
+                self._executor = None
+                self._futures = {}
+                self._prefetch_idx_list = None
+                for shm, _ in self._shared_memory.values():
+                    shm.close()
+                self._shared_memory = {}
+                for _, finalizer in self._shared_data.values():
+                    finalizer()
+                self._shared_data = {}
+
+    def _get_batch(self, idx_list_temp):
+        """
+        Generate a batch of data of the given indices, the batch can be any nested structure of numpy arrays
+
+        :param idx_list_temp: indices of data in the batch
+        :type idx_list_temp: ndarray
+        """
+        raise NotImplementedError
+
+    def tf_dataset(self, seed=None, num_parallel_calls=tf.data.experimental.AUTOTUNE):
+        """
+        | ``tf.data`` pipeline of this generator as an alternative to Tensorflow ``Sequence``
+        | Indices are shuffled (if applicable) and batched by ``tf.data``, batches are gathered in parallel threads
+        | outside of Tensorflow ``Sequence`` and prefetched with autotuning, batch order is deterministic.
+
+        :param seed: random seed of shuffling, same seed gives the same order of batches in every epoch
+        :type seed: Union[NoneType, int]
+        :param num_parallel_calls: number of batches to gather in parallel, default is autotune by tensorflow
+        :type num_parallel_calls: int
+        :return: dataset with the same batches as this generator in each iteration
+        :rtype: tf.data.Dataset
+        """
+        num_data = len(self.idx_list)
+        # structure, dtype and shape of a batch
+        sample = self._get_batch(np.arange(min(self.batch_size, num_data)))
+        flat_sample = tf.nest.flatten(sample)
+        dtypes = [tf.as_dtype(np.asarray(x).dtype) for x in flat_sample]
+        shapes = [(None,) + np.shape(x)[1:] for x in flat_sample]
+
+        def _gather(idx_list_temp):
+            idx_list_temp = idx_list_temp.numpy()
+            if self.idx is not None:
+                idx_list_temp = np.asarray(self.idx)[idx_list_temp]
+            # copy out of the ring buffers because prefetched tensors could share memory with numpy arrays
+            return [np.array(x) for x in tf.nest.flatten(self._get_batch(idx_list_temp))]
+
+        def _tf_gather(idx_list_temp):
+            flat_batch = tf.py_function(_gather, [idx_list_temp], dtypes)
+            for tensor, shape in zip(flat_batch, shapes):
+                tensor.set_shape(shape)
+            return tf.nest.pack_sequence_as(sample, flat_batch)
+
+        dataset = tf.data.Dataset.range(num_data)
+        if self.shuffle is True:
+            # reshuffle every time the dataset is iterated, i.e. every epoch, like on_epoch_end()
+            dataset = dataset.shuffle(num_data, seed=seed, reshuffle_each_iteration=True)
+        if self.pad_last and num_data % self.batch_size != 0:
+            padding = np.full(self.batch_size - num_data % self.batch_size, num_data - 1, dtype=np.int64)
+            dataset = dataset.concatenate(tf.data.Dataset.from_tensor_slices(padding))
+        dataset = dataset.batch(self.batch_size).take(self.steps_per_epoch)
+        dataset = dataset.map(_tf_gather, num_parallel_calls=num_parallel_calls)
+
+        options = tf.data.Options()
+        options.experimental_deterministic = True
+        return dataset.with_options(options).prefetch(tf.data.experimental.AUTOTUNE)
+
     def sparsify(self, y):
         """Returns labels in binary NumPy array"""
         # n_classes =  # Enter number of classes
@@ -45,26 +367,72 @@ class GeneratorMaster(Sequence):
         #                  for i in range(y.shape[0])])
         pass
 
+    def _batch_buffer(self, data, slot):
+        """
+        Preallocated buffer in the ring of ``data`` with the same dtype as ``data`` for a full batch
+        """
+        # buffers are for a specific data array, inputs and labels could have the same names, shape and dtype are
+        # part of the key in case id is reused by another array
+        key = (id(data), tuple(data.shape[1:]), np.dtype(data.dtype))
+        # allocate lazily so generators with few steps like train_on_batch() only allocate what they use
+        if self._buffers.get(key, {}).get(slot) is None:
+            with self._buffer_lock:
+                self._buffers.setdefault(key, {})
+                if self._buffers[key].get(slot) is None:
+                    shape, dtype = (self.batch_size,) + tuple(data.shape[1:]), np.dtype(data.dtype)
+                    if self._shared_buffers:
+                        # in a worker process, batches are passed back to the main process in shared memory
+                        shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+                        # name is removed when the worker exits, the main process keeps its own mapping
+                        multiprocessing.util.Finalize(shm, shm.unlink, exitpriority=0)
+                        buffer = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                        self._shared_memory[shm.name] = (shm, buffer.__array_interface__['data'][0])
+                    else:
+                        buffer = np.empty(shape, dtype=dtype)
+                    self._buffers[key][slot] = buffer
+        return self._buffers[key][slot]
+
+    @staticmethod
+    def _check_idx(idx_list_temp, num_data):
+        """
+        Raise IndexError if any index is out of range of data like numpy fancy indexing does, negative indices are
+        converted to the non-negative indices of the same data
+
+        :return: non-negative indices
+        :rtype: ndarray
+        """
+        idx_list_temp = np.asarray(idx_list_temp)
+        if len(idx_list_temp) > 0 and (np.min(idx_list_temp) < -num_data or np.max(idx_list_temp) >= num_data):
+            raise IndexError(f'Indices of batch are out of range of data with {num_data} data')
+        return np.where(idx_list_temp < 0, idx_list_temp + num_data, idx_list_temp)
+
     def input_d_checking(self, inputs, idx_list_temp):
+        """
+        Gather a batch of every named inputs into a preallocated buffer of the same dtype without intermediate copy,
+        a channel axis is added to 2D and 3D inputs as a view
+
+        :param inputs: dictionary of named inputs
+        :type inputs: dict
+        :param idx_list_temp: indices of data in the batch
+        :type idx_list_temp: Union[ndarray, range]
+        :return: dictionary of named batch
+        :rtype: dict
+        """
+        # batches read ahead are not consumed yet either
+        slot = next(self._buffer_counter) % (self.num_buffers + self.prefetch)
         x_dict = {}
         for name in inputs.keys():
-            if inputs[name].ndim == 2:
-                x = np.empty((len(idx_list_temp), inputs[name].shape[1], 1))
-                # Generate data
-                x[:, :, 0] = inputs[name][idx_list_temp]
-
-            elif inputs[name].ndim == 3:
-                x = np.empty((len(idx_list_temp), inputs[name].shape[1], inputs[name].shape[2], 1))
-                # Generate data
-                x[:, :, :, 0] = inputs[name][idx_list_temp]
-
-            elif inputs[name].ndim == 4:
-                x = np.empty((len(idx_list_temp), inputs[name].shape[1], inputs[name].shape[2], inputs[name].shape[3]))
-                # Generate data
-                x[:, :, :, :] = inputs[name][idx_list_temp]
-            else:
+            if inputs[name].ndim not in [2, 3, 4]:
                 raise ValueError(f"Unsupported data dimension, your data has {inputs[name].ndim} dimension")
-
-            x_dict.update({name: x})
+            x = self._batch_buffer(inputs[name], slot)[:len(idx_list_temp)]
+            if isinstance(inputs[name], np.ndarray):
+                # clip mode so numpy does not buffer the output to check indices, indices are checked here instead
+                # and negative indices are converted because clip mode would clip them to the first data
+                np.take(inputs[name], self._check_idx(idx_list_temp, inputs[name].shape[0]), axis=0, out=x,
+                        mode='clip')
+            else:
+                # array-like such as H5DatasetView
+                x[:] = inputs[name][np.asarray(idx_list_temp)]
+            x_dict.update({name: x if inputs[name].ndim == 4 else x[..., np.newaxis]})
 
         return x_dict
@@ -36,7 +36,10 @@ class Normalizer(object):
         self._custom_norm_func = None
         self._custom_denorm_func = None
 
-    def mode_checker(self, data):
+        # running featurewise count, mean and sum of squared difference from mean of data fitted by partial_fit()
+        self._fit_stats = {}
+
+    def mode_checker(self, data, inplace=False):
         if type(data) is not dict:
             dict_flag = False
             data = {"Temp": data}
@@ -49,10 +52,11 @@ class Normalizer(object):
         if type(self.normalization_mode) is not dict:
             self.normalization_mode = list_to_dict(data.keys(), to_iterable(self.normalization_mode))
         for name in data.keys():  # normalize data for each named inputs
-            if data[name].ndim == 1:
-                data_array = np.expand_dims(data[name], 1)
-            else:
-                data_array = np.array(data[name])
+            data_array = np.asarray(data[name])
+            # no copy only for float32 numpy array, other dtype like uint8 image cannot hold normalized values so they
+            # are always normalized as a float32 copy
+            no_copy = (inplace is True or (type(inplace) is not bool and name in inplace)) and \
+                data_array.dtype == np.float32
 
             self.normalization_mode.update({name: str(self.normalization_mode[name])})  # just to prevent unnecessary type issue
 
@@ -61,7 +65,10 @@ class Normalizer(object):
                     warnings.warn("Data type is detected as bool, setting normalization_mode to 0 which is "
                                   "doing nothing because no normalization can be done on bool")
                     self.normalization_mode[name] = '0'
-            data_array = data_array.astype(np.float32, copy=False)  # need to convert data to float in every case
+            # need to convert data to float in every case, array-like like H5DatasetView is already read to a new array
+            data_array = data_array.astype(np.float32, copy=isinstance(data[name], np.ndarray) and not no_copy)
+            if data_array.ndim == 1:
+                data_array = np.expand_dims(data_array, 1)
 
             if self.normalization_mode[name] == '0':
                 self.featurewise_center.update({name: False})
@@ -115,8 +122,21 @@ class Normalizer(object):
 
         return master_data, dict_flag
 
-    def normalize(self, data, calc=True):
-        data_array, dict_flag = self.mode_checker(data)
+    def normalize(self, data, calc=True, inplace=False):
+        """
+        Normalize data
+
+        :param data: data to be normalized
+        :type data: Union[ndarray, dict]
+        :param calc: whether to calculate normalization or use the existing one
+        :type calc: bool
+        :param inplace: whether to normalize float32 numpy array inplace without copying, or names of data to do so,
+                        data of other dtype are normalized as a float32 copy
+        :type inplace: Union[bool, list]
+        :return: normalized data
+        :rtype: Union[ndarray, dict]
+        """
+        data_array, dict_flag = self.mode_checker(data, inplace=inplace)
 
         for name in data_array.keys():  # normalize data for each named inputs
             magic_mask = [(data_array[name] == MAGIC_NUMBER)]
@@ -166,6 +186,117 @@ class Normalizer(object):
 
         return data_array
 
+    def partial_fit(self, data):
+        """
+        | Accumulate normalization statistics of a chunk of data with Welford's algorithm, so normalization of data
+        | larger than memory can be calculated chunk by chunk like from a h5 file. Magic number is ignored and the
+        | mean and standard deviation are the same as ``normalize(calc=True)`` on all data at once
+        | ``mean_labels`` and ``std_labels`` are updated after every chunk, use ``normalize(calc=False)`` to normalize
+
+        :param data: a chunk of data
+        :type data: Union[ndarray, dict]
+        :return: the normalizer itself
+        :rtype: Normalizer
+        """
+        # no copy because the chunk is not modified
+        data_array, dict_flag = self.mode_checker(data, inplace=True)
+
+        for name in data_array.keys():
+            magic_mask = (data_array[name] != MAGIC_NUMBER)
+            count = np.sum(magic_mask, axis=0)
+            mean = np.sum(np.where(magic_mask, data_array[name], 0.), axis=0, dtype=np.float64) / np.maximum(count, 1)
+            m2 = np.sum(np.where(magic_mask, data_array[name] - mean, 0.) ** 2, axis=0)
+            self._merge_stats(name, count, mean, m2)
+
+        if not dict_flag:
+            self.mean_labels = self.mean_labels['Temp']
+            self.std_labels = self.std_labels['Temp']
+
+        return self
+
+    def merge(self, other):
+        """
+        Merge normalization statistics accumulated by partial_fit() of another normalizer like from another worker
+
+        :param other: normalizer with the same normalization mode
+        :type other: Normalizer
+        :return: the normalizer itself
+        :rtype: Normalizer
+        """
+        dict_flag = 'Temp' not in other._fit_stats
+        other_mean_labels, other_std_labels = other.mean_labels, other.std_labels
+        if not dict_flag:
+            self.mean_labels = {'Temp': self.mean_labels} if self._fit_stats else {}
+            self.std_labels = {'Temp': self.std_labels} if self._fit_stats else {}
+            other_mean_labels, other_std_labels = {'Temp': other_mean_labels}, {'Temp': other_std_labels}
+        if self.normalization_mode is None:
+            self.normalization_mode = other.normalization_mode
+        for attr in ['featurewise_center', 'datasetwise_center', 'featurewise_stdalization',
+                     'datasetwise_stdalization']:
+            getattr(self, attr).update(getattr(other, attr))
+        if self._custom_norm_func is None:
+            self._custom_norm_func = other._custom_norm_func
+            self._custom_denorm_func = other._custom_denorm_func
+
+        for name, stats in other._fit_stats.items():
+            if name not in self._fit_stats:  # labels not calculated from statistics like mode 255
+                self.mean_labels.update({name: other_mean_labels[name]})
+                self.std_labels.update({name: other_std_labels[name]})
+            self._merge_stats(name, stats['count'], stats['mean'], stats['m2'])
+
+        if not dict_flag:
+            self.mean_labels = self.mean_labels['Temp']
+            self.std_labels = self.std_labels['Temp']
+
+        return self
+
+    def reset(self):
+        """
+        Forget normalization statistics accumulated by partial_fit()
+
+        """
+        self._fit_stats = {}
+
+    def _merge_stats(self, name, count_b, mean_b, m2_b):
+        """
+        Merge featurewise count, mean and sum of squared difference from mean to the running statistics of name with
+        Chan et al. parallel algorithm and update mean_labels and std_labels from them
+        """
+        if name not in self._fit_stats:
+            count, mean, m2 = count_b, mean_b, m2_b
+        else:
+            count_a, mean_a, m2_a = (self._fit_stats[name][key] for key in ['count', 'mean', 'm2'])
+            count = count_a + count_b
+            delta = mean_b - mean_a
+            mean = mean_a + delta * (count_b / np.maximum(count, 1))
+            m2 = m2_a + m2_b + delta ** 2 * (count_a * count_b / np.maximum(count, 1))
+        self._fit_stats[name] = {'count': count, 'mean': mean, 'm2': m2}
+
+        if self.featurewise_center[name] is True:
+            self.mean_labels.update({name: mean})
+        elif self.datasetwise_center[name] is True:
+            self.mean_labels.update({name: self._datasetwise_stats(count, mean, m2)[0]})
+        if self.featurewise_stdalization[name] is True:
+            self.std_labels.update({name: np.sqrt(m2 / np.maximum(count, 1))})
+        elif self.datasetwise_stdalization[name] is True:
+            self.std_labels.update({name: self._datasetwise_stats(count, mean, m2)[1]})
+
+        # same default as normalize(), empty dict is the initial labels wrapped by mode_checker() for non-dict data
+        if type(self.mean_labels.get(name, {})) is dict:
+            self.mean_labels.update({name: np.array([0.])})
+        if type(self.std_labels.get(name, {})) is dict:
+            self.std_labels.update({name: np.array([1.])})
+
+    @staticmethod
+    def _datasetwise_stats(count, mean, m2):
+        """
+        Datasetwise mean and standard deviation by merging featurewise statistics
+        """
+        total = np.sum(count)
+        dataset_mean = np.sum(count * mean) / total
+        dataset_m2 = np.sum(m2) + np.sum(count * (mean - dataset_mean) ** 2)
+        return dataset_mean, np.sqrt(dataset_m2 / total)
+
     def denormalize(self, data):
         data_array, dict_flag = self.mode_checker(data)
         for name in data_array.keys():  # normalize data for each named inputs
@@ -184,3 +315,77 @@ class Normalizer(object):
             self.std_labels = self.std_labels['Temp']
 
         return data_array
+
+
+class NormalizedView(object):
+    """
+    | Lazy view of array-like data normalized by the given mean and standard derivation
+    | Data are only read and normalized when indexed, e.g. to normalize batches of out-of-core data like
+    | ``astroNN.datasets.H5DatasetView`` on the fly during training
+
+    :param data: array-like data supporting numpy-like indexing on the first axis
+    :type data: Union[ndarray, astroNN.datasets.H5DatasetView]
+    :param mean: mean to be subtracted, broadcastable to a row of data
+    :type mean: Union[float, ndarray]
+    :param std: standard derivation to be divided, broadcastable to a row of data
+    :type std: Union[float, ndarray]
+    :param magic: whether to keep magic number unchanged as ``Normalizer`` does
+    :type magic: bool
+    """
+
+    def __init__(self, data, mean=0., std=1., magic=True):
+        self.data = data
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.std = np.asarray(std, dtype=np.float32)
+        self.magic = magic
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        rows = self.data[key[0]]
+        # copy if data is a numpy array so it will not be normalized inplace
+        rows = np.array(rows, dtype=np.float32) if isinstance(self.data, np.ndarray) else \
+            np.asarray(rows, dtype=np.float32)
+        if self.magic is True:
+            magic_mask = (rows == MAGIC_NUMBER)
+        rows -= self.mean
+        rows /= self.std
+        if self.magic is True:
+            rows[magic_mask] = MAGIC_NUMBER
+        return rows[key[1:]] if rows.ndim < self.ndim else rows[(slice(None),) + key[1:]]
+
+    def __array__(self, dtype=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    def subset(self, index):
+        """
+        View of a subset of rows of this view without reading anything if data is out-of-core
+
+        :param index: indices of rows of this view
+        :type index: Union[ndarray, slice]
+        :return: the view
+        :rtype: NormalizedView
+        """
+        if hasattr(self.data, 'subset'):
+            data = self.data.subset(index)
+        elif isinstance(self.data, np.ndarray) and self.data.ndim > 0 and self.data.strides[0] == 0:
+            # broadcasted constant rows like zero uncertainty, keep it broadcasted
+            data = np.broadcast_to(self.data[:1], (np.arange(self.shape[0])[index].shape[0],) + self.shape[1:])
+        else:
+            data = self.data[index]
+        return NormalizedView(data, mean=self.mean, std=self.std, magic=self.magic)
@@ -0,0 +1,209 @@
+# ---------------------------------------------------------#
+#   astroNN.shared.result_cache: on-disk cache of results
+# ---------------------------------------------------------#
+import functools
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from astroNN.config import astroNN_CACHE_DIR
+
+
+class ResultCache(object):
+    """
+    | On-disk cache of results of neural network methods like ``test()``, ``jacobian()`` and ``hessian()``
+    | Results are stored as compressed npz files keyed by a hash of model weights, arguments and input data, least
+    | recently used results are removed once the total size of the cache exceeds max_size
+
+    :param cache_dir: Directory to store results, default to ``results`` folder in astroNN cache directory
+    :type cache_dir: Union[NoneType, str]
+    :param max_size: Maximum total size of cached results in bytes
+    :type max_size: int
+    """
+
+    def __init__(self, cache_dir=None, max_size=2 * 1024 ** 3):
+        self.cache_dir = os.path.join(astroNN_CACHE_DIR, 'results') if cache_dir is None else cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(cache_dir={self.cache_dir!r}, max_size={self.max_size}, ' \
+               f'hits={self.hits}, misses={self.misses})'
+
+    @staticmethod
+    def key(*objs):
+        """
+        Hash of objects like arrays, lazy out-of-core data, dict, list and python scalars
+
+        :return: hex digest
+        :rtype: str
+        """
+        h = hashlib.sha256()
+        for obj in objs:
+            _hash_update(h, obj)
+        return h.hexdigest()
+
+    def get(self, key, func):
+        """
+        Get cached result by key, or call func to get result and cache it
+
+        :param key: key from key()
+        :type key: str
+        :param func: function without argument to get result if not cached
+        :type func: function
+        :return: result
+        """
+        path = os.path.join(self.cache_dir, f'{key}.npz')
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                result = _unflatten(json.loads(str(npz['__structure__'])), npz)
+            os.utime(path)  # last used time for eviction
+            self.hits += 1
+            return result
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            # truncated or foreign file is a miss, remove it so it will be replaced
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        self.misses += 1
+        result = func()
+        arrays = {}
+        structure = _flatten(result, arrays)
+        if structure is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write to a temporary file first so an interrupted write will not leave a corrupted result
+            fd, temp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, __structure__=np.array(json.dumps(structure)), **arrays)
+            os.replace(temp_path, path)
+            self.evict()
+        return result
+
+    def evict(self):
+        """
+        Remove least recently used results until the total size is not larger than max_size
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
+
+    def clear(self):
+        """
+        Remove all cached results
+        """
+        if os.path.isdir(self.cache_dir):
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.npz'):
+                    os.remove(entry.path)
+
+
+def _hash_update(h, obj):
+    if obj is None or isinstance(obj, (bool, int, float, str, np.generic)):
+        h.update(f'{type(obj).__name__}:{obj!r};'.encode())
+    elif isinstance(obj, dict):
+        h.update(b'dict:')
+        for k in sorted(obj.keys(), key=str):
+            _hash_update(h, k)
+            _hash_update(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        h.update(f'{type(obj).__name__}:{len(obj)}:'.encode())
+        for item in obj:
+            _hash_update(h, item)
+    elif hasattr(obj, 'h5path') and hasattr(obj, 'index'):
+        # out-of-core H5DatasetView, identified by files, their modification time and rows instead of content
+        h.update(f'h5:{obj.name}:'.encode())
+        for path in obj._h5paths:
+            stat = os.stat(path)
+            _hash_update(h, (os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+        _hash_update(h, obj.index)
+    elif hasattr(obj, 'data') and hasattr(obj, 'mean') and hasattr(obj, 'std') and hasattr(obj, 'magic'):
+        # NormalizedView
+        _hash_update(h, ('normalized', obj.data, obj.mean, obj.std, obj.magic))
+    else:
+        array = np.asarray(obj)
+        h.update(f'array:{array.dtype.str}:{array.shape}:'.encode())
+        if array.ndim > 0 and 0 in array.strides:  # broadcasted array like zero uncertainty, no need to expand it
+            array = array[tuple(slice(None) if stride != 0 else slice(0, 1) for stride in array.strides)]
+        h.update(np.ascontiguousarray(array).data)
+
+
+def _flatten(result, arrays):
+    """
+    Structure of result as json and its arrays, None if result cannot be cached
+    """
+    if isinstance(result, tuple) or isinstance(result, list):
+        items = [_flatten(item, arrays) for item in result]
+        return None if None in items else {'type': type(result).__name__, 'items': items}
+    elif isinstance(result, dict):
+        items = {str(k): _flatten(v, arrays) for k, v in result.items()}
+        return None if None in items.values() else {'type': 'dict', 'items': items}
+    elif isinstance(result, (np.ndarray, np.generic, int, float)):
+        array = np.asarray(result)
+        if array.dtype == object:
+            return None
+        key = f'array_{len(arrays)}'
+        arrays[key] = array
+        return {'type': 'scalar' if array.ndim == 0 and not isinstance(result, np.ndarray) else 'array', 'key': key}
+    else:
+        return None
+
+
+def _unflatten(structure, npz):
+    if structure['type'] == 'tuple':
+        return tuple(_unflatten(item, npz) for item in structure['items'])
+    elif structure['type'] == 'list':
+        return [_unflatten(item, npz) for item in structure['items']]
+    elif structure['type'] == 'dict':
+        return {k: _unflatten(v, npz) for k, v in structure['items'].items()}
+    elif structure['type'] == 'scalar':
+        return npz[structure['key']][()]
+    else:
+        return npz[structure['key']]
+
+
+def cached_result(method):
+    """
+    Decorator to cache results of a method of neural network by its ``result_cache`` if it is not None
+
+    :param method: method of neural network
+    :type method: function
+    :return: method with result cache
+    :rtype: function
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.result_cache:
+            return method(self, *args, **kwargs)
+        arguments = signature.bind(self, *args, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(arguments.arguments)
+        del arguments['self']
+        if arguments.get('out', None) is not None:  # results written to given array are not cached
+            return method(self, *args, **kwargs)
+
+        if self.result_cache is True:
+            self.result_cache = ResultCache()
+        key = self.result_cache.key(self._result_cache_identity(), method.__qualname__, arguments)
+        return self.result_cache.get(key, lambda: method(self, *args, **kwargs))
+
+    return wrapper
@@ -0,0 +1,66 @@
+# ---------------------------------------------------------#
+#   Benchmark post-processing of classification uncertainty
+#   of Bayesian neural networks after Monte Carlo inference
+#
+#   python bcnn_classification_postprocess.py
+#
+#   Compare vectorized post-processing used by test() to a
+#   loop over every data, for classification and binary
+#   classification
+# ---------------------------------------------------------#
+import time
+
+import numpy as np
+
+from astroNN.models.base_bayesian_cnn import BayesianCNNBase
+from astroNN.nn.numpy import sigmoid
+
+num_classes = 10
+repeat = 3
+
+rng = np.random.RandomState(42)
+
+
+def loop_uncertainty(predictions, predictions_var):
+    predicted_class = np.argmax(predictions, axis=1)
+    mc_dropout_uncertainty = np.ones_like(predicted_class, dtype=float)
+    predictive_uncertainty = np.ones_like(predicted_class, dtype=float)
+    predictions_var = predictions_var - 1.
+    for i in range(predicted_class.shape[0]):
+        all_prediction = np.array(predictions[i, :])
+        mc_dropout_uncertainty[i] = - np.sum(all_prediction * np.log(all_prediction))
+        predictive_uncertainty[i] = predictions_var[i, predicted_class[i]]
+    return predicted_class, mc_dropout_uncertainty, predictive_uncertainty
+
+
+def loop_binary_uncertainty(predictions, predictions_var):
+    predicted_class = np.ones_like(predictions)
+    mc_dropout_uncertainty = np.zeros(predictions.shape[1])
+    for i in range(predictions.shape[0]):
+        predicted_class[i] = np.rint(sigmoid(predictions[i, :]))
+        mc_dropout_uncertainty -= predictions[i, :] * np.log(predictions[i, :])
+    return predicted_class, mc_dropout_uncertainty, predictions_var
+
+
+print(f'{"Task":<24}{"Data":>10}{"Loop (s)":>12}{"Vectorized (s)":>16}{"Speedup":>10}')
+for num_data in (10000, 100000, 1000000):
+    logits = rng.normal(0., 2., (num_data, num_classes))
+    predictions = np.exp(logits) / np.sum(np.exp(logits), axis=1, keepdims=True)
+    predictions_var = np.exp(rng.normal(0., 1., (num_data, num_classes)))
+
+    tasks = {'classification': (predictions, loop_uncertainty, BayesianCNNBase._classification_uncertainty),
+             'binary_classification': (predictions, loop_binary_uncertainty,
+                                       BayesianCNNBase._binary_classification_uncertainty)}
+    for task, (task_predictions, loop_func, vectorized_func) in tasks.items():
+        timing = {}
+        for name, func in (('loop', loop_func), ('vectorized', vectorized_func)):
+            start_time = time.time()
+            for _ in range(repeat):
+                result = func(task_predictions, predictions_var)
+            timing[name] = (time.time() - start_time) / repeat
+            if name == 'loop':
+                expected = result
+            else:
+                assert all(np.allclose(a, b) for a, b in zip(expected, result))
+        print(f'{task:<24}{num_data:>10}{timing["loop"]:>12.4f}{timing["vectorized"]:>16.4f}'
+              f'{timing["loop"] / timing["vectorized"]:>10.1f}')
@@ -0,0 +1,64 @@
+# ---------------------------------------------------------#
+#   Benchmark calibration and speed of moment propagation
+#   against Monte Carlo Dropout Variational Inference of
+#   ApogeeBCNN (moment_propagation = True)
+#
+#   python bcnn_moment_propagation.py
+#
+#   ApogeeBCNN is trained on synthetic spectra with absorption
+#   lines depending on labels, then test set is inferred with
+#   both and compared to each other and to the truth
+# ---------------------------------------------------------#
+import time
+
+import numpy as np
+
+from astroNN.models import ApogeeBCNN
+
+num_train = 5000
+num_test = 5000
+total_pix = 7514
+mc_num = 100
+
+rng = np.random.RandomState(42)
+line_depth = rng.beta(0.5, 5, (3, total_pix)).astype(np.float32)
+
+
+def synthetic_spectra(num):
+    labels = rng.normal(0., 1., (num, 3)).astype(np.float32)
+    spectra = 1. - 0.1 * (1.5 + labels) @ line_depth
+    spectra += rng.normal(0., 0.01, spectra.shape).astype(np.float32)
+    return spectra, labels
+
+
+train_spectra, train_labels = synthetic_spectra(num_train)
+test_spectra, test_labels = synthetic_spectra(num_test)
+
+bcnn = ApogeeBCNN()
+bcnn.targetname = ['teff', 'logg', 'M']
+bcnn.max_epochs = 20
+bcnn.train(train_spectra, train_labels)
+
+results = {}
+for name, moment_propagation in (('Monte Carlo', False), ('moment propagation', True)):
+    bcnn.mc_num = mc_num
+    bcnn.moment_propagation = moment_propagation
+    bcnn.test(test_spectra[:bcnn.batch_size])  # exclude building and tracing the model
+    start_time = time.time()
+    pred, pred_err = bcnn.test(test_spectra)
+    results[name] = (pred, pred_err, time.time() - start_time)
+
+mc_pred, mc_err, mc_time = results['Monte Carlo']
+print(f'{num_test} spectra, {total_pix} pixels, {mc_num} Monte Carlo forward passes')
+print(f'{"Inference":<20}{"Time (s)":>10}{"Median model":>14}{"Median total":>14}{"Within 1 sigma":>16}')
+for name, (pred, pred_err, elapsed) in results.items():
+    # fraction of truth within total uncertainty, about 68% if calibrated
+    within = np.mean(np.abs(pred - test_labels) < pred_err['total'])
+    print(f'{name:<20}{elapsed:>10.2f}{np.median(pred_err["model"]):>14.4f}{np.median(pred_err["total"]):>14.4f}'
+          f'{within:>16.1%}')
+
+pred, pred_err, _ = results['moment propagation']
+print(f'Median |difference| of prediction to Monte Carlo in Monte Carlo model uncertainty: '
+      f'{np.median(np.abs(pred - mc_pred) / mc_err["model"]):.3f}')
+print(f'Median ratio of model uncertainty to Monte Carlo: {np.median(pred_err["model"] / mc_err["model"]):.3f}')
+print(f'Median ratio of total uncertainty to Monte Carlo: {np.median(pred_err["total"] / mc_err["total"]):.3f}')
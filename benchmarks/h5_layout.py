@@ -0,0 +1,80 @@
+# ---------------------------------------------------------#
+#   Benchmark read throughput of spectra stored with different
+#   h5 chunk layouts and compression filters of H5Compiler
+#
+#   python h5_layout.py [compiled_dataset.h5]
+#
+#   Spectra are taken from a compiled dataset if provided,
+#   otherwise from random APOGEE-like spectra
+# ---------------------------------------------------------#
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from astroNN.datasets.h5 import _H5BlockWriter, _spectra_layout
+
+num_spectra = 20000
+batch_size = 64
+num_batches = 50
+# chunk cache large enough to hold a few chunks, so a chunk is decompressed once per batch
+chunk_cache = 64 * 1024 ** 2
+total_pix = 7514
+
+rng = np.random.RandomState(42)
+
+if len(sys.argv) > 1:
+    with h5py.File(sys.argv[1], 'r') as F:
+        spectra = F['spectra'][:num_spectra].astype(np.float32)
+    num_spectra, total_pix = spectra.shape
+else:
+    # continuum normalized spectra with absorption lines and noise
+    lines = 1. - 0.3 * rng.beta(0.5, 5, total_pix).astype(np.float32)
+    spectra = lines + rng.normal(0., 0.01, (num_spectra, total_pix)).astype(np.float32)
+
+layouts = {'h5py auto chunk': _spectra_layout(total_pix),
+           f'{batch_size} rows chunk': _spectra_layout(total_pix, chunk_rows=batch_size),
+           'lzf': _spectra_layout(total_pix, chunk_rows=batch_size, compression='lzf'),
+           'gzip': _spectra_layout(total_pix, chunk_rows=batch_size, compression='gzip'),
+           'shuffle + gzip': _spectra_layout(total_pix, chunk_rows=batch_size, compression='gzip', shuffle=True),
+           'shuffle + lzf': _spectra_layout(total_pix, chunk_rows=batch_size, compression='lzf', shuffle=True)}
+try:
+    layouts['blosc'] = _spectra_layout(total_pix, chunk_rows=batch_size, compression='blosc')
+except ImportError:
+    print('hdf5plugin not installed, skipped blosc')
+
+# random batches like a shuffled training generator, rows are read in sorted order
+random_batches = [np.sort(rng.choice(num_spectra, batch_size, replace=False)) for _ in range(num_batches)]
+# contiguous batches in random order like a generator shuffling chunk aligned batches
+block_batches = rng.randint(0, num_spectra // batch_size, num_batches) * batch_size
+
+print(f'{num_spectra} spectra, {total_pix} pixels, {num_batches} batches of {batch_size}')
+print(f'{"Layout":<20}{"Size (MB)":>12}{"Write (s)":>12}{"Random rows (MB/s)":>22}{"Chunk aligned (MB/s)":>24}')
+with tempfile.TemporaryDirectory() as tmpdir:
+    for name, layout in layouts.items():
+        path = os.path.join(tmpdir, 'benchmark.h5')
+        start_time = time.time()
+        with h5py.File(path, 'w') as F:
+            writer = _H5BlockWriter(F, block_size=1000)
+            writer.add_dataset('spectra', shape=(total_pix,), **layout)
+            writer.append({'spectra': spectra}, num_spectra)
+            writer.flush()
+        write_time = time.time() - start_time
+        size = os.path.getsize(path) / 1024 ** 2
+
+        throughput = []
+        for batches in [random_batches, block_batches]:
+            with h5py.File(path, 'r', rdcc_nbytes=chunk_cache) as F:
+                dataset = F['spectra']
+                start_time = time.time()
+                for batch in batches:
+                    if np.ndim(batch) == 0:
+                        dataset[batch:batch + batch_size]
+                    else:
+                        dataset[batch]
+                throughput.append(num_batches * batch_size * total_pix * 4 / 1024 ** 2 / (time.time() - start_time))
+        os.remove(path)
+        print(f'{name:<20}{size:>12.1f}{write_time:>12.2f}{throughput[0]:>22.1f}{throughput[1]:>24.1f}')
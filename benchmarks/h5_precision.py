@@ -0,0 +1,61 @@
+# ---------------------------------------------------------#
+#   Accuracy report of spectra stored with reduced precision
+#   spectra_dtype of H5Compiler
+#
+#   python h5_precision.py [compiled_dataset.h5]
+#
+#   Spectra are taken from a float32 compiled dataset if
+#   provided, otherwise from random APOGEE-like spectra
+# ---------------------------------------------------------#
+import sys
+
+import h5py
+import numpy as np
+
+from astroNN.datasets.h5 import _spectra_codec, _encode_spectra, _decode_spectra
+
+num_spectra = 5000
+total_pix = 7514
+spectra_range = (0., 2.)  # default H5Compiler.spectra_range
+spectra_err_range = (0., 1.)  # default H5Compiler.spectra_err_range
+
+rng = np.random.RandomState(42)
+
+if len(sys.argv) > 1:
+    with h5py.File(sys.argv[1], 'r') as F:
+        if F['spectra'].dtype != np.float32:
+            raise ValueError(f'{sys.argv[1]} is not compiled with spectra_dtype="float32"')
+        spectra = F['spectra'][:num_spectra]
+        spectra_err = F['spectra_err'][:num_spectra]
+    num_spectra, total_pix = spectra.shape
+else:
+    # continuum normalized spectra with absorption lines and noise
+    lines = 1. - 0.3 * rng.beta(0.5, 5, total_pix).astype(np.float32)
+    spectra_err = rng.uniform(0.003, 0.03, (num_spectra, total_pix)).astype(np.float32)
+    spectra = lines + rng.normal(0., 1., (num_spectra, total_pix)).astype(np.float32) * spectra_err
+
+print(f'{num_spectra} spectra, {total_pix} pixels')
+print(f'{"spectra_dtype":<16}{"Bytes/pixel":>12}{"Max |err|":>12}{"RMS err":>12}{"Max |err|/sigma":>18}'
+      f'{"Max rel err of spectra_err":>28}{"Clipped (%)":>14}')
+for spectra_dtype in ['float32', 'float16', 'uint16']:
+    dtype, attrs = _spectra_codec(spectra_dtype, spectra_range)
+    err_dtype, err_attrs = _spectra_codec(spectra_dtype, spectra_err_range)
+    decoded = _decode_spectra(_encode_spectra(spectra, dtype, attrs), attrs)
+    decoded_err = _decode_spectra(_encode_spectra(spectra_err, err_dtype, err_attrs), err_attrs)
+
+    # pixels outside the representable range of uint16 are clipped, they are reported separately
+    inside = np.ones(spectra.shape, dtype=bool)
+    if 'scale' in attrs:
+        inside &= (spectra >= spectra_range[0]) & (spectra <= spectra_range[1])
+    if 'scale' in err_attrs:
+        inside &= (spectra_err >= spectra_err_range[0]) & (spectra_err <= spectra_err_range[1])
+    good = inside & (spectra_err > 0.)
+
+    diff = np.abs(decoded - spectra)[inside]
+    # round-trip error in unit of the uncertainty of the pixel, should be negligible compared to 1
+    sigma_diff = np.abs(decoded - spectra)[good] / spectra_err[good]
+    err_rel_diff = np.abs(decoded_err - spectra_err)[good] / spectra_err[good]
+    clipped = 100. * (1. - np.mean(inside))
+
+    print(f'{spectra_dtype:<16}{dtype.itemsize:>12}{diff.max():>12.2e}{np.sqrt(np.mean(diff ** 2)):>12.2e}'
+          f'{sigma_diff.max():>18.2e}{err_rel_diff.max():>28.2e}{clipped:>14.3f}')
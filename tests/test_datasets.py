@@ -1,10 +1,100 @@
+import os
+import tempfile
+import types
 import unittest
 
+import h5py
 import requests
 import numpy as np
+import numpy.testing as npt
 from astroNN.data import datapath, data_description
 from astroNN.datasets.galaxy10 import _G10_ORIGIN
 from astroNN.datasets.galaxy10 import galaxy10cls_lookup, galaxy10_confusion
+from astroNN.datasets.h5 import H5Compiler, H5Loader, H5DatasetView
+
+
+def synthetic_allstar(spectra_dir, num=40, seed=0):
+    """
+    Write combined spectra of a synthetic allStar catalog to spectra_dir, some stars have no spectra file
+    """
+    rng = np.random.RandomState(seed)
+    catalog = {'APOGEE_ID': np.array([f'2M{seed:04d}{i:04d}' for i in range(num)]),
+               'LOCATION_ID': np.full(num, 4000), 'VSCATTER': rng.uniform(0., 1.2, num),
+               'SNR': rng.uniform(150., 400., num), 'STARFLAG': np.zeros(num), 'ASPCAPFLAG': np.zeros(num),
+               'PARAM': rng.uniform(3900., 5600., (num, 9)), 'X_H': rng.uniform(-1., 0.5, (num, 26)),
+               'X_H_ERR': rng.uniform(0., 0.1, (num, 26)), 'RA': rng.uniform(0., 360., num),
+               'DEC': rng.uniform(-90., 90., num), 'K': rng.uniform(5., 12., num), 'AK_TARG': rng.uniform(0., 1., num),
+               'TEFF_ERR': rng.uniform(0., 100., num), 'LOGG_ERR': rng.uniform(0., 0.1, num),
+               'M_H_ERR': rng.uniform(0., 0.1, num), 'ALPHA_M_ERR': rng.uniform(0., 0.1, num)}
+    for i, apogee_id in enumerate(catalog['APOGEE_ID']):
+        if i % 9 != 4:
+            write_star(spectra_dir, apogee_id, rng.uniform(0.5, 1.5, (1, 7514)), catalog['SNR'][i])
+    return catalog
+
+
+def write_star(spectra_dir, apogee_id, spectra, snr):
+    np.savez(os.path.join(spectra_dir, f'{apogee_id}.npz'), spectra=spectra.astype(np.float32),
+             spectra_err=(spectra / 100.).astype(np.float32), SNR=snr)
+
+
+class SyntheticH5Compiler(H5Compiler):
+    """
+    H5Compiler reading a synthetic allStar catalog and spectra files without downloading anything
+    """
+
+    def __init__(self, catalog, spectra_dir, n_workers=1):
+        super().__init__(n_workers=n_workers)
+        self.catalog = catalog
+        self.spectra_dir = spectra_dir
+        self.apogee_dr = 14
+        self.continuum = False
+        self.use_esa_gaia = False
+        self.block_size = 4
+
+    def load_allstar(self):
+        return [None, types.SimpleNamespace(data=self.catalog)]
+
+    def spectra_path(self, d_args):
+        path = os.path.join(self.spectra_dir, f'{d_args["apogee"]}.npz')
+        return path if os.path.isfile(path) else False
+
+    def star_spectra(self, path):
+        with np.load(path) as f:
+            return f['spectra'], f['spectra_err'], f['SNR'], 1
+
+
+class InterruptedH5Compiler(SyntheticH5Compiler):
+    """
+    SyntheticH5Compiler which crashes after reading some stars
+    """
+
+    def __init__(self, catalog, spectra_dir, num_stars):
+        super().__init__(catalog, spectra_dir)
+        self.num_stars = num_stars
+
+    def star_spectra(self, path):
+        if self.num_stars == 0:
+            raise RuntimeError('Interrupted')
+        self.num_stars -= 1
+        return super().star_spectra(path)
+
+
+def compile_h5(compiler, filename, mode='w'):
+    compiler.filename = filename
+    compiler.mode = mode
+    compiler.compile()
+    return f'{filename}.h5'
+
+
+def assert_h5_equal(path1, path2):
+    with h5py.File(path1, 'r') as F1, h5py.File(path2, 'r') as F2:
+        names1, names2 = [], []
+        F1.visit(names1.append)
+        F2.visit(names2.append)
+        assert sorted(names1) == sorted(names2)
+        for name in names1:
+            if isinstance(F1[name], h5py.Dataset):
+                npt.assert_array_equal(F1[name][()], F2[name][()], err_msg=name)
 
 
 class DatasetTestCase(unittest.TestCase):
@@ -49,6 +139,178 @@ class DatasetTestCase(unittest.TestCase):
         os.path.isdir(datapath())
         data_description()
 
+    def test_h5compiler(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            catalog = synthetic_allstar(tmpdir)
+            serial = compile_h5(SyntheticH5Compiler(catalog, tmpdir), os.path.join(tmpdir, 'serial'))
+            parallel = compile_h5(SyntheticH5Compiler(catalog, tmpdir, n_workers=3), os.path.join(tmpdir, 'parallel'))
+            # multiprocessing should give exactly the same dataset
+            assert_h5_equal(serial, parallel)
+
+            compiler = SyntheticH5Compiler(catalog, tmpdir)
+            selected = [i for i in compiler.filter_apogeeid_list(compiler.load_allstar())
+                        if compiler.spectra_path({'apogee': catalog['APOGEE_ID'][i]}) is not False]
+            self.assertTrue(0 < len(selected) < catalog['SNR'].shape[0])
+            expected = np.concatenate([np.load(os.path.join(tmpdir, f'{catalog["APOGEE_ID"][i]}.npz'))['spectra']
+                                       for i in selected])
+
+            h5loader = H5Loader(serial, target=['teff', 'Fe'])
+            x, y = h5loader.load()
+            npt.assert_array_equal(x, expected)
+            npt.assert_array_equal(y, np.column_stack([catalog['PARAM'][selected, 0],
+                                                       catalog['X_H'][selected, 17]]).astype(np.float32))
+            npt.assert_array_equal(h5loader.load_entry('SNR'), catalog['SNR'][selected].astype(np.float32))
+
+            # unknown mode
+            compiler.mode = 'append'
+            compiler.filename = os.path.join(tmpdir, 'serial')
+            self.assertRaises(ValueError, compiler.compile)
+
+    def test_h5compiler_resume(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            catalog = synthetic_allstar(tmpdir)
+            fresh = compile_h5(SyntheticH5Compiler(catalog, tmpdir), os.path.join(tmpdir, 'fresh'))
+            filename = os.path.join(tmpdir, 'resumed')
+            with self.assertRaises(RuntimeError):
+                compile_h5(InterruptedH5Compiler(catalog, tmpdir, num_stars=10), filename)
+            with h5py.File(f'{filename}.h5', 'r') as F:
+                self.assertFalse(F['manifest'].attrs['complete'])
+                self.assertTrue(0 < F['manifest/allstar_index'].shape[0] < 10)
+            # an interrupted resume is not complete even if the file was marked complete before
+            with h5py.File(f'{filename}.h5', 'a') as F:
+                F['manifest'].attrs['complete'] = True
+            with self.assertRaises(RuntimeError):
+                compile_h5(InterruptedH5Compiler(catalog, tmpdir, num_stars=5), filename, mode='resume')
+            with h5py.File(f'{filename}.h5', 'r') as F:
+                self.assertFalse(F['manifest'].attrs['complete'])
+            resumed = compile_h5(SyntheticH5Compiler(catalog, tmpdir), filename, mode='resume')
+            assert_h5_equal(fresh, resumed)
+            with h5py.File(resumed, 'r') as F:
+                self.assertTrue(F['manifest'].attrs['complete'])
+
+            # stars selected are different now, so cannot be resumed
+            with self.assertRaises(RuntimeError):
+                compile_h5(InterruptedH5Compiler(catalog, tmpdir, num_stars=10), filename)
+            compiler = SyntheticH5Compiler(catalog, tmpdir)
+            compiler.teff_low = 4500
+            self.assertRaises(ValueError, compile_h5, compiler, filename, mode='resume')
+
+            # resuming a file compiled with other settings
+            compiler = SyntheticH5Compiler(catalog, tmpdir)
+            compiler.spectra_dtype = 'float16'
+            self.assertRaises(ValueError, compile_h5, compiler, os.path.join(tmpdir, 'fresh'), mode='resume')
+
+    def test_h5compiler_update(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            catalog = synthetic_allstar(tmpdir)
+            filename = os.path.join(tmpdir, 'updated')
+            compile_h5(SyntheticH5Compiler(catalog, tmpdir), filename)
+
+            # spectra of a star is changed, another star is removed and some stars have new spectra
+            compiler = SyntheticH5Compiler(catalog, tmpdir)
+            selected = compiler.filter_apogeeid_list(compiler.load_allstar())
+            write_star(tmpdir, catalog['APOGEE_ID'][selected[0]], np.ones((1, 7514)), 300.)
+            os.remove(os.path.join(tmpdir, f'{catalog["APOGEE_ID"][selected[1]]}.npz'))
+            for i in selected:
+                if not os.path.isfile(os.path.join(tmpdir, f'{catalog["APOGEE_ID"][i]}.npz')) and i != selected[1]:
+                    write_star(tmpdir, catalog['APOGEE_ID'][i], np.full((1, 7514), 0.9), 250.)
+
+            updated = compile_h5(SyntheticH5Compiler(catalog, tmpdir), filename, mode='update')
+            fresh = compile_h5(SyntheticH5Compiler(catalog, tmpdir), os.path.join(tmpdir, 'fresh'))
+            assert_h5_equal(fresh, updated)
+            self.assertFalse(os.path.isfile(f'{updated}.tmp'))
+            x, y = H5Loader(updated, target=['teff']).load()
+            npt.assert_array_equal(x[0], np.ones(7514))
+
+    def test_h5loader_filters(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            catalog = synthetic_allstar(tmpdir)
+            filename = compile_h5(SyntheticH5Compiler(catalog, tmpdir), os.path.join(tmpdir, 'filters'))
+
+            h5loader = H5Loader(filename, target=['teff', 'logg'])
+            x, y = h5loader.load()
+            snr = h5loader.load_entry('SNR')
+            mask = (snr > 250.) & (y[:, 0] <= 5000.)
+            self.assertTrue(0 < np.count_nonzero(mask) < mask.shape[0])
+
+            h5loader.filters = [('SNR', '>', 250.), ('teff', '<=', 5000.)]
+            x_filtered, y_filtered = h5loader.load()
+            npt.assert_array_equal(x_filtered, x[mask])
+            npt.assert_array_equal(y_filtered, y[mask])
+            npt.assert_array_equal(h5loader.load_entry('SNR'), snr[mask])
+            npt.assert_array_equal(h5loader.load_allowed_index(), np.flatnonzero(mask))
+
+            h5loader.filters = [('SNR', '~', 250.)]
+            self.assertRaises(ValueError, h5loader.load)
+            h5loader.filters = [('spectra', '>', 1.)]
+            self.assertRaises(ValueError, h5loader.load)
+
+    def test_h5loader_multifile(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = [compile_h5(SyntheticH5Compiler(synthetic_allstar(tmpdir, num=num, seed=seed), tmpdir),
+                                    os.path.join(tmpdir, f'part{seed}')) for seed, num in [(1, 30), (2, 20)]]
+            parts = [H5Loader(filename, target=['teff', 'M']) for filename in filenames]
+            for h5loader in parts:
+                h5loader.filters = [('SNR', '>', 250.)]
+                h5loader.load_err = True
+            h5loader = H5Loader(filenames, target=['teff', 'M'])
+            h5loader.filters = [('SNR', '>', 250.)]
+            h5loader.load_err = True
+
+            # multiple h5 datasets are loaded as if they were concatenated
+            for combined, separated in zip(h5loader.load(), zip(*[part.load() for part in parts])):
+                npt.assert_array_equal(combined, np.concatenate(separated))
+            npt.assert_array_equal(h5loader.load_entry('SNR'),
+                                   np.concatenate([part.load_entry('SNR') for part in parts]))
+
+            h5loader.lazy = True
+            x, y, x_err, y_err = h5loader.load()
+            self.assertIsInstance(x, H5DatasetView)
+            npt.assert_array_equal(np.asarray(x), np.concatenate([part.load()[0] for part in parts]))
+            npt.assert_array_equal(np.asarray(x_err), np.concatenate([part.load()[2] for part in parts]))
+
+    def test_h5loader_lazy(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            catalog = synthetic_allstar(tmpdir)
+            compiler = SyntheticH5Compiler(catalog, tmpdir)
+            compiler.spectra_dtype = 'uint16'
+            filename = compile_h5(compiler, os.path.join(tmpdir, 'lazy'))
+
+            h5loader = H5Loader(filename, target=['teff'])
+            h5loader.filters = [('teff', '>', 4500.)]
+            x, y = h5loader.load()
+            h5loader.lazy = True
+            x_lazy, y_lazy = h5loader.load()
+            self.assertIsInstance(x_lazy, H5DatasetView)
+            self.assertEqual(x_lazy.shape, x.shape)
+            self.assertEqual(x_lazy.dtype, np.float32)
+            npt.assert_array_equal(y_lazy, y)
+            npt.assert_array_equal(np.asarray(x_lazy), x)
+            # spectra are stored as uint16
+            npt.assert_allclose(x, np.clip(x, 0., 2.), atol=0.)
+            self.assertTrue(np.all(np.abs(x - 1.) < 0.51))
+
+            # only rows indexed are read, in the order given
+            idx = np.array([5, 0, 3, 3, len(x) - 1])
+            npt.assert_array_equal(x_lazy[idx], x[idx])
+            npt.assert_array_equal(x_lazy[2], x[2])
+            npt.assert_array_equal(x_lazy[1:7, 100:200], x[1:7, 100:200])
+            subset = x_lazy.subset(idx)
+            self.assertEqual(len(subset), idx.shape[0])
+            npt.assert_array_equal(np.asarray(subset), x[idx])
+
+            # out of range rows raise like numpy, negative rows count from the end
+            npt.assert_array_equal(x_lazy[-1], x[-1])
+            npt.assert_array_equal(x_lazy[np.array([-2, 1])], x[np.array([-2, 1])])
+            self.assertRaises(IndexError, x_lazy.__getitem__, len(x))
+            self.assertRaises(IndexError, x_lazy.__getitem__, np.array([0, -len(x) - 1]))
+            all_rows = H5DatasetView(filename, 'spectra')
+            npt.assert_array_equal(all_rows.read(np.array([-1, 0])), all_rows.read(np.array([len(all_rows) - 1, 0])))
+            self.assertRaises(IndexError, all_rows.read, np.array([0, len(all_rows)]))
+            self.assertRaises(IndexError, all_rows.read, np.array([-len(all_rows) - 1]))
+            all_rows.close()
+            x_lazy.close()
+
 
 if __name__ == '__main__':
     unittest.main()
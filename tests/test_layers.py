@@ -287,6 +287,94 @@ class LayerCase(unittest.TestCase):
         # make sure accelerated model has no variance (uncertainty) on deterministic model prediction
         self.assertAlmostEqual(np.sum(sy[:, :, 1]), 0.)
 
+    def test_FastMCChunkedMeanVar(self):
+        print('==========FastMCChunkedMeanVar tests==========')
+        from astroNN.nn.layers import FastMCInference, FastMCChunkedMeanVar, MCDropout
+
+        # Data preparation
+        random_xdata = np.random.normal(0, 1, (100, 7514))
+
+        input = Input(shape=[7514])
+        dense = Dense(100)(input)
+        output = Dense(25)(dense)
+        model = Model(inputs=input, outputs=output)
+
+        # make sure chunked Monte Carlo has the same result as running all at once on deterministic model
+        y = FastMCInference(10)(model).predict(random_xdata)
+        chunked_model = FastMCInference(10, chunk_size=3)(model)
+        self.assertTrue(any(isinstance(layer, FastMCChunkedMeanVar) for layer in chunked_model.layers))
+        y_chunked = chunked_model.predict(random_xdata)
+        self.assertEqual(y_chunked.shape, y.shape)
+        npt.assert_array_almost_equal(y_chunked[:, :, 0], y[:, :, 0], decimal=4)
+        npt.assert_array_almost_equal(y_chunked[:, :, 1], 0., decimal=4)
+        # chunk_size not smaller than n is the same as running all at once
+        self.assertFalse(any(isinstance(layer, FastMCChunkedMeanVar) for layer in
+                             FastMCInference(10, chunk_size=10)(model).layers))
+
+        # dropout of rate 0.5 then sum, so mean is the sum of input and variance is the sum of squared input
+        random_xdata = np.random.normal(0, 1, (10, 20))
+        input = Input(shape=[20])
+        dropout = MCDropout(0.5)(input)
+        output = Dense(2, use_bias=False, kernel_initializer='ones')(dropout)
+        model = Model(inputs=input, outputs=output)
+        expected_mean = np.sum(random_xdata, axis=1)
+        expected_var = np.sum(random_xdata ** 2, axis=1)
+
+        # make sure chunks are merged to the same mean and variance, tolerance is many times the standard error
+        for mc_model in [FastMCInference(5000)(model), FastMCInference(5000, chunk_size=700)(model)]:
+            y = mc_model.predict(random_xdata)
+            self.assertEqual(y.shape, (10, 2, 2))
+            npt.assert_allclose(y[:, 0, 0], expected_mean, atol=0.5)
+            npt.assert_allclose(y[:, 0, 1], expected_var, rtol=0.15)
+
+    def test_MomentPropagation(self):
+        print('==========MomentPropagation tests==========')
+        from astroNN.nn.layers import FastMCInference, MomentPropagation, MCDropout
+
+        # Data preparation
+        random_xdata = np.random.normal(0, 1, (100, 200))
+
+        input = Input(shape=[200])
+        reshape = tfk.layers.Reshape((200, 1))(input)
+        conv = Conv1D(4, 5, activation='relu')(reshape)
+        conv = MCDropout(0.2)(conv)
+        pool = tfk.layers.MaxPooling1D(4)(conv)
+        flat = Flatten()(pool)
+        dense = Dense(32, activation='tanh')(flat)
+        dense = MCDropout(0.2)(dense)
+        output = Dense(3)(dense)
+        model = Model(inputs=input, outputs=output)
+
+        # same output shape as FastMCInference in a single deterministic pass
+        mp_model = MomentPropagation()(model)
+        y = mp_model.predict(random_xdata)
+        self.assertEqual(y.shape, FastMCInference(10)(model).predict(random_xdata).shape)
+        self.assertEqual(y.shape, (100, 3, 2))
+        npt.assert_array_equal(mp_model.predict(random_xdata), y)
+        self.assertTrue(np.all(y[:, :, 1] > 0.))
+
+        # classification model
+        input = Input(shape=[200])
+        dense = Dense(32, activation='relu')(input)
+        dense = MCDropout(0.5)(dense)
+        output = Dense(10, activation='softmax')(dense)
+        y = MomentPropagation()(Model(inputs=input, outputs=output)).predict(random_xdata)
+        self.assertEqual(y.shape, (100, 10, 2))
+        npt.assert_array_almost_equal(np.sum(y[:, :, 0], axis=1), 1., decimal=5)
+
+        # moment propagation is exact for dropout followed by a linear layer
+        random_xdata = np.random.normal(0, 1, (10, 20))
+        input = Input(shape=[20])
+        dropout = MCDropout(0.5)(input)
+        output = Dense(2, use_bias=False, kernel_initializer='ones')(dropout)
+        y = MomentPropagation()(Model(inputs=input, outputs=output)).predict(random_xdata)
+        self.assertEqual(y.shape, (10, 2, 2))
+        npt.assert_array_almost_equal(y[:, 0, 0], np.sum(random_xdata, axis=1), decimal=4)
+        npt.assert_array_almost_equal(y[:, 0, 1], np.sum(random_xdata ** 2, axis=1), decimal=4)
+
+        # assert error raised for things other than keras model
+        self.assertRaises(TypeError, MomentPropagation(), '123')
+
     def test_TensorInput(self):
         print('==========BoolMask tests==========')
         from astroNN.nn.layers import TensorInput
@@ -11,6 +11,7 @@ import astroNN
 from astroNN.config import config_path
 from astroNN.models import Cifar10CNN, Galaxy10CNN, MNIST_BCNN
 from astroNN.models import load_folder
+from astroNN.models.base_master_nn import _stochastic
 from astroNN.nn.callbacks import ErrorOnNaN
 
 mnist = tfk.datasets.mnist
@@ -94,7 +95,7 @@ class Models_TestCase2(unittest.TestCase):
         mnist_reloaded = load_folder("cifar10_test")
         prediction_loaded = mnist_reloaded.test(x_test[:200])
         mnist_reloaded.jacobian(x_test[:2], mean_output=True, mc_num=2)
-        # mnist_reloaded.hessian_diag(x_test[:10], mean_output=True, mc_num=2)
+        mnist_reloaded.hessian_diag(x_test[:10], mean_output=True, mc_num=2)
 
         # Cifar10_CNN is deterministic
         np.testing.assert_array_equal(prediction, prediction_loaded)
@@ -203,5 +204,121 @@ class Models_TestCase6(unittest.TestCase):
         self.assertRaises(IOError, load_folder, 'i_am_not_a_fodler')
 
 
+
+class Models_TestCase7(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Cifar10_CNN is deterministic with softmax output so hessian is not all zeros
+        cls.net = Cifar10CNN()
+        cls.net.max_epochs = 1
+        cls.net.train(x_train[:200], y_train[:200])
+
+    def test_jacobian(self):
+        x = x_test[:3]
+        jacobian = self.net.jacobian(x)
+        self.assertEqual(jacobian.shape, (3, 10, 28, 28))
+
+        # batch by batch with the last batch padded
+        np.testing.assert_array_almost_equal(self.net.jacobian(x, batch_size=2), jacobian, decimal=5)
+        np.testing.assert_array_almost_equal(self.net.jacobian(x, mean_output=True), np.mean(jacobian, axis=0),
+                                             decimal=5)
+        out = np.zeros_like(jacobian)
+        self.net.jacobian(x, batch_size=2, out=out)
+        np.testing.assert_array_almost_equal(out, jacobian, decimal=5)
+        self.assertRaises(ValueError, self.net.jacobian, x, out=np.zeros((3, 10, 28)))
+
+        # deterministic model so Monte Carlo integration does not change jacobian
+        np.testing.assert_array_almost_equal(self.net.jacobian(x, mc_num=2), jacobian, decimal=5)
+        self.assertRaises(ValueError, self.net.jacobian, x, mc_num=0)
+
+    def test_hessian_diag(self):
+        x = x_test[:2]
+
+        # exact hessian diagonal is the diagonal of full hessian
+        hessian = self.net.hessian(x)
+        self.assertEqual(hessian.shape, (2, 10, 28, 28, 28, 28))
+        hessian_diag = np.diagonal(hessian.reshape(2, 10, 784, 784), axis1=2, axis2=3)
+        self.assertFalse(np.all(hessian_diag == 0.))
+        hessian_diag_exact = self.net.hessian_diag(x, n_samples=None)
+        self.assertEqual(hessian_diag_exact.shape, (2, 10, 28, 28))
+        np.testing.assert_array_almost_equal(hessian_diag_exact.reshape(2, 10, -1), hessian_diag, decimal=5)
+
+        # Hutchinson's estimate
+        self.assertEqual(self.net.hessian_diag(x, n_samples=5).shape, (2, 10, 28, 28))
+        self.assertRaises(ValueError, self.net.hessian_diag, x, n_samples=0)
+
+    def test_gradient_subset(self):
+        x = x_test[:3]
+        flat_jacobian = self.net.jacobian(x).reshape(3, 10, -1)
+        flat_jacobian_denorm = self.net.jacobian(x, denormalize=True).reshape(3, 10, -1)
+
+        # subset of outputs and inputs, more outputs than inputs uses forward-mode differentiation
+        outputs = [1, 2, 7]
+        for inputs in [np.array([3, 100, 400]), np.array([3, 100]), np.arange(784) % 37 == 0]:
+            input_idx = np.flatnonzero(inputs) if inputs.dtype == bool else inputs
+            jacobian_subset = self.net.jacobian(x, outputs=outputs, inputs=inputs)
+            self.assertEqual(jacobian_subset.shape, (3, 3, input_idx.shape[0]))
+            np.testing.assert_array_almost_equal(jacobian_subset, flat_jacobian[:, outputs][:, :, input_idx],
+                                                 decimal=5)
+            np.testing.assert_array_almost_equal(self.net.jacobian(x, outputs=outputs, inputs=inputs,
+                                                                   denormalize=True),
+                                                 flat_jacobian_denorm[:, outputs][:, :, input_idx], decimal=5)
+        np.testing.assert_array_almost_equal(self.net.jacobian(x, mean_output=True, outputs=outputs),
+                                             np.mean(flat_jacobian[:, outputs], axis=0).reshape(3, 28, 28),
+                                             decimal=5)
+
+        inputs = np.array([300, 301, 400, 500])
+        hessian_diag = self.net.hessian_diag(x[:2], n_samples=None).reshape(2, 10, -1)
+        hessian_diag_subset = self.net.hessian_diag(x[:2], n_samples=None, outputs=outputs, inputs=inputs)
+        self.assertEqual(hessian_diag_subset.shape, (2, 3, 4))
+        np.testing.assert_array_almost_equal(hessian_diag_subset, hessian_diag[:, outputs][:, :, inputs], decimal=5)
+        self.assertEqual(self.net.hessian_diag(x[:2], n_samples=5, outputs=outputs, inputs=inputs).shape, (2, 3, 4))
+
+
+class Models_TestCase8(unittest.TestCase):
+    def test_bayesian_mc_tol(self):
+        net = MNIST_BCNN()
+        net.task = 'classification'
+        net.max_epochs = 1
+        net.train(x_train[:1000], y_train[:1000])
+
+        net.mc_num = 40
+        net.mc_chunk_size = 10
+        pred, pred_err = net.test(x_test[:100])
+        # every data has all Monte Carlo passes without mc_tol
+        np.testing.assert_array_equal(pred_err['mc_num'], 40)
+
+        # every data stops after the first round of mc_chunk_size passes
+        net.mc_tol = np.inf
+        pred_tol, pred_err_tol = net.test(x_test[:100])
+        np.testing.assert_array_equal(pred_err_tol['mc_num'], 10)
+        self.assertEqual(pred_tol.shape, pred.shape)
+        self.assertEqual(pred_err_tol['total'].shape, pred_err['total'].shape)
+
+        # no data converge so every data has all passes
+        net.mc_tol = 0.
+        pred_tol, pred_err_tol = net.test(x_test[:100])
+        np.testing.assert_array_equal(pred_err_tol['mc_num'], 40)
+
+    def test_bayesian_jacobian_subset(self):
+        net = MNIST_BCNN()
+        net.task = 'classification'
+        net.max_epochs = 1
+        net.train(x_train[:200], y_train[:200])
+
+        # Monte Carlo dropout model always uses reverse-mode differentiation so a data has a single dropout mask
+        self.assertTrue(_stochastic(net._gradient_model()[0]))
+        inputs = np.array([3, 100, 400])
+        self.assertEqual(net.jacobian(x_test[:3], outputs=[1, 2, 7, 8], inputs=inputs).shape, (3, 4, 3))
+        self.assertIn(('jacobian', False), [key[:2] for key in net._gradient_functions])
+
+        # number of passes of each data is in rounds of mc_chunk_size up to mc_num
+        net.mc_tol = 0.01
+        pred_tol, pred_err_tol = net.test(x_test[:100])
+        self.assertEqual(pred_err_tol['mc_num'].shape, (100,))
+        self.assertTrue(np.all(np.isin(pred_err_tol['mc_num'], [10, 20, 30, 40])))
+        self.assertTrue(np.all(np.isfinite(pred_err_tol['total'])))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -70,6 +70,142 @@ class UtilitiesTestCase(unittest.TestCase):
         errorous_norm = Normalizer(mode=-1234)
         self.assertRaises(ValueError, errorous_norm.normalize, data)
 
+    def test_normalizer_partial_fit(self):
+        from astroNN.nn.utilities.normalizer import Normalizer
+        from astroNN.config import MAGIC_NUMBER
+        import numpy as np
+
+        data = np.random.normal(2., 3., (1000, 10)).astype(np.float32)
+        data[np.random.randint(0, 1000, 50), np.random.randint(0, 10, 50)] = MAGIC_NUMBER
+
+        for mode in [0, 1, 2, 3, 4, 255]:
+            normer = Normalizer(mode=mode)
+            norm_data = normer.normalize(data)
+
+            # statistics accumulated chunk by chunk should be the same as the one of all data at once
+            chunk_normer = Normalizer(mode=mode)
+            for chunk in np.array_split(data, 7):
+                chunk_normer.partial_fit(chunk)
+            for labels in ['mean_labels', 'std_labels']:
+                if type(getattr(normer, labels)) is not dict:  # labels not used by the mode are left empty
+                    npt.assert_array_almost_equal(getattr(chunk_normer, labels), getattr(normer, labels), decimal=4)
+            npt.assert_array_almost_equal(chunk_normer.normalize(data, calc=False), norm_data, decimal=4)
+
+            # statistics of different workers merged together
+            normers = [Normalizer(mode=mode).partial_fit(chunk) for chunk in np.array_split(data, 3)]
+            merged_normer = Normalizer(mode=mode)
+            for other in normers:
+                merged_normer.merge(other)
+            for labels in ['mean_labels', 'std_labels']:
+                if type(getattr(normer, labels)) is not dict:  # labels not used by the mode are left empty
+                    npt.assert_array_almost_equal(getattr(merged_normer, labels), getattr(normer, labels), decimal=4)
+            npt.assert_array_almost_equal(merged_normer.normalize(data, calc=False), norm_data, decimal=4)
+            self.assertEqual(merged_normer.denormalize(norm_data)[data == MAGIC_NUMBER].tolist(),
+                             [MAGIC_NUMBER] * np.sum(data == MAGIC_NUMBER))
+
+            # forget statistics
+            chunk_normer.reset()
+            chunk_normer.partial_fit(data[:10])
+            chunk_normer.partial_fit(data[10:])
+            npt.assert_array_almost_equal(chunk_normer.normalize(data, calc=False), norm_data, decimal=4)
+
+        # named inputs
+        data_dict = {'input': data, 'aux': np.where(data[:, :2] == MAGIC_NUMBER, MAGIC_NUMBER, data[:, :2] * 10.)}
+        normer = Normalizer(mode={'input': 1, 'aux': 2})
+        norm_data_dict = normer.normalize(data_dict)
+        chunk_normer = Normalizer(mode={'input': 1, 'aux': 2})
+        for i in range(0, 1000, 300):
+            chunk_normer.partial_fit({name: value[i:i + 300] for name, value in data_dict.items()})
+        norm_chunk_dict = chunk_normer.normalize(data_dict, calc=False)
+        for name in data_dict.keys():
+            npt.assert_array_almost_equal(chunk_normer.mean_labels[name], normer.mean_labels[name], decimal=4)
+            npt.assert_array_almost_equal(chunk_normer.std_labels[name], normer.std_labels[name], decimal=4)
+            npt.assert_array_almost_equal(norm_chunk_dict[name], norm_data_dict[name], decimal=4)
+
+    def test_result_cache(self):
+        from astroNN.shared.result_cache import ResultCache
+        import tempfile
+        import numpy as np
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ResultCache(cache_dir=tmpdir)
+            data = np.random.normal(0, 1, (100, 10))
+            calls = []
+
+            def func():
+                calls.append(1)
+                return data.mean(axis=0), {'std': data.std(axis=0), 'num': 100}
+
+            # same objects give the same key, different objects give different keys
+            key = cache.key(data, 'test', {'batch_size': 32})
+            self.assertEqual(key, cache.key(data.copy(), 'test', {'batch_size': 32}))
+            self.assertNotEqual(key, cache.key(data, 'test', {'batch_size': 64}))
+            self.assertNotEqual(key, cache.key(data + 1e-6, 'test', {'batch_size': 32}))
+            self.assertNotEqual(key, cache.key(data.astype(np.float32), 'test', {'batch_size': 32}))
+
+            # miss then hit
+            result = cache.get(key, func)
+            cached = cache.get(key, func)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertIsInstance(cached, tuple)
+            npt.assert_array_equal(cached[0], result[0])
+            npt.assert_array_equal(cached[1]['std'], result[1]['std'])
+            self.assertEqual(cached[1]['num'], 100)
+
+            # truncated file is a miss and will be replaced
+            path = os.path.join(tmpdir, f'{key}.npz')
+            with open(path, 'r+b') as f:
+                f.truncate(10)
+            npt.assert_array_equal(cache.get(key, func)[0], result[0])
+            self.assertEqual((len(calls), cache.hits, cache.misses), (2, 1, 2))
+            npt.assert_array_equal(cache.get(key, func)[0], result[0])
+            self.assertEqual((len(calls), cache.hits, cache.misses), (2, 2, 2))
+
+            # result cannot be stored is not cached
+            cache.get(cache.key('object'), lambda: np.array([None]))
+            self.assertFalse(os.path.isfile(os.path.join(tmpdir, f'{cache.key("object")}.npz')))
+
+            # least recently used result is evicted
+            cache.clear()
+            self.assertEqual(os.listdir(tmpdir), [])
+            keys = [cache.key(i) for i in range(3)]
+            for i, k in enumerate(keys):
+                cache.get(k, lambda: np.random.normal(0, 1, 1000))
+                os.utime(os.path.join(tmpdir, f'{k}.npz'), (i, i))
+            size = os.path.getsize(os.path.join(tmpdir, f'{keys[0]}.npz'))
+            cache.get(keys[0], func)  # keys[0] is used so keys[1] is the least recently used one
+            cache.max_size = size * 2.5
+            cache.evict()
+            self.assertEqual(sorted(os.listdir(tmpdir)), sorted([f'{keys[0]}.npz', f'{keys[2]}.npz']))
+
+    def test_generator_batch(self):
+        from astroNN.nn.utilities.generator import GeneratorMaster
+        import numpy as np
+
+        class Generator(GeneratorMaster):
+            def _get_batch(self, idx_list_temp):
+                return self.input_d_checking(self.data[0], idx_list_temp)
+
+        inputs = {'input': np.arange(20, dtype=np.float32).reshape(10, 2), 'aux': np.arange(10).reshape(10, 1)}
+        generator = Generator(batch_size=4, shuffle=False, steps_per_epoch=3, data=[inputs], manual_reset=False)
+        # make sure batch is the same as numpy fancy indexing, including negative indices
+        for idx in [np.array([0, 3, 9, 2]), np.array([-1, -10, 5, -3]), np.array([7, 7]), range(2, 6)]:
+            x = generator._get_batch(idx)
+            for name in inputs.keys():
+                self.assertEqual(x[name].dtype, inputs[name].dtype)
+                npt.assert_array_equal(x[name][..., 0], inputs[name][idx])
+        self.assertRaises(IndexError, generator._get_batch, np.array([0, 10]))
+        self.assertRaises(IndexError, generator._get_batch, np.array([-11, 0]))
+
+        # buffers are never reused for data of another shape or dtype
+        for data in [np.arange(30, dtype=np.float64).reshape(10, 3), np.arange(10, dtype=np.int8).reshape(10, 1)]:
+            generator.data = [{'input': data}]
+            x = generator._get_batch(np.array([1, 5]))
+            self.assertEqual(x['input'].dtype, data.dtype)
+            npt.assert_array_equal(x['input'][..., 0], data[[1, 5]])
+        self.assertEqual(generator.num_buffers, generator.max_queue_size + generator.workers + 2)
+
     def test_cpu_gpu_management(self):
         from astroNN.shared.nn_tools import cpu_fallback
 